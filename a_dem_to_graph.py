@@ -1,20 +1,22 @@
+import os
 import cv2
 import numpy as np
 from PIL import Image
-import sys
-import scipy
-import scipy.ndimage
-from skimage.morphology import skeletonize, medial_axis, skeletonize_3d
-from scipy.ndimage.morphology import generate_binary_structure
-import sknw
-import matplotlib.pyplot as plt
+import itertools
+from multiprocessing import shared_memory
+import skeleton_graph
+from skeleton_graph import assign_edge_ids, get_node_coords
+import raster_store
 import networkx as nx
 from scipy import ndimage
 from datetime import datetime
+import logging
+import run_metrics
 
-startTime = datetime.now()
+# skimage, sknw, joblib and matplotlib are imported where
+# they are needed, so reading and saving graphs stays fast
 
-np.set_printoptions(threshold=sys.maxsize)
+startTime = datetime.now()
 
 def read_data(img):
     ''' helper function to make reading in DEMs easier '''
@@ -49,46 +51,275 @@ def detrender(dem, trend_size):
 
 
 def small_cluster_elim(in_img, cluster_size):
-    ''' determine the number of distinct features.
-    Prepares for then eliminating those clusters with
-    < n pixels (to remove potential noise)
+    ''' eliminate the clusters (8-connected) with
+    <= cluster_size pixels (to remove potential noise)
+
+    :param in_img: binary image (foreground != 0)
+    :param cluster_size: clusters with <= n pixels are removed
+    :return result: bool mask of the remaining pixels
+    '''
+    return _elim_small_clusters(np.uint8(np.asarray(in_img) != 0), cluster_size).view(bool)
+
+
+def _elim_small_clusters(buf, cluster_size):
+    ''' remove clusters with <= cluster_size pixels
+    (8-connected) in place. The uint8 buffer holds
+    1 for all remaining pixels afterwards, so it can
+    be viewed as a bool mask.
+
+    :param buf: contiguous np.uint8 array, modified
+    :param cluster_size: clusters with <= n pixels are removed
+    :return buf: the cleaned buffer
+    '''
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(buf, connectivity=8)
+    keep = stats[:, cv2.CC_STAT_AREA] > cluster_size
+    keep[0] = False
+    np.take(keep, labels, out=buf.view(bool))
+    return buf
+
+
+def _zhang_suen_luts():
+    ''' lookup tables of the two sub-iterations of
+    the Zhang-Suen thinning: for each of the 256
+    codes of a 3x3 neighbourhood, whether the center
+    pixel is deleted. Bit k of a code is the
+    neighbour k of P2..P9 (clockwise from north). '''
+    codes = np.arange(256)
+    p2, p3, p4, p5, p6, p7, p8, p9 = p = [(codes >> k) & 1 for k in range(8)]
+    # number of foreground neighbours and of 0 -> 1 transitions around the pixel
+    b = sum(p)
+    a = sum((p[k] == 0) & (p[(k + 1) % 8] == 1) for k in range(8))
+    deletable = (b >= 2) & (b <= 6) & (a == 1)
+    first = deletable & (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+    second = deletable & (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+    return first, second
+
+
+_THINNING_LUTS = [np.uint8(lut) for lut in _zhang_suen_luts()]
+# weights of the neighbours P2..P9, so that a correlation with the image gives the codes
+_THINNING_KERNEL = np.zeros((3, 3), np.float32)
+for k, (dr, dc) in enumerate(((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))):
+    _THINNING_KERNEL[dr + 1, dc + 1] = 1 << k
+
+
+def thinning(img):
+    ''' 2D Zhang-Suen thinning. Uses OpenCV's
+    ximgproc.thinning if opencv-contrib is installed,
+    else a lookup table implementation: every
+    sub-iteration computes the neighbourhood codes of
+    all pixels with one filter2D pass and looks up the
+    pixels to delete, all on uint8 buffers.
+
+    :param img: binary image (foreground != 0)
+    :return skel: np.uint8 skeleton (0/1)
+    '''
+    if hasattr(cv2, 'ximgproc'):
+        skel = cv2.ximgproc.thinning(np.uint8(img > 0) * 255, thinningType=cv2.ximgproc.THINNING_ZHANGSUEN)
+        return np.uint8(skel > 0)
+
+    skel = np.uint8(img > 0)
+    codes = np.empty_like(skel)
+    delete = np.empty_like(skel)
+    changed = True
+    while changed:
+        changed = False
+        for lut in _THINNING_LUTS:
+            cv2.filter2D(skel, cv2.CV_8U, _THINNING_KERNEL, dst=codes, borderType=cv2.BORDER_CONSTANT)
+            cv2.LUT(codes, lut, dst=delete)
+            cv2.bitwise_and(delete, skel, dst=delete)
+            if cv2.countNonZero(delete):
+                cv2.subtract(skel, delete, dst=skel)
+                changed = True
+    return skel
+
+
+def _skeletonize(img, method=None):
+    from skimage.morphology import skeletonize
+    try:
+        return skeletonize(img, method=method)
+    except TypeError:
+        # scikit-image < 0.16 (as pinned in environment.yml) has no method
+        # keyword: skeletonize is Zhang's algorithm, skeletonize_3d Lee's
+        if method != 'lee':
+            return skeletonize(img)
+        from skimage.morphology import skeletonize_3d
+        return skeletonize_3d(img) > 0
+
+
+# skeletonization algorithms of the morphology stage
+SKELETON_METHODS = {'lee': lambda img: _skeletonize(img, method='lee'),
+                    'zhang': _skeletonize,
+                    'thinning': thinning}
+
+
+def segment_troughs(img_det, block_size=133, c=11, cluster_size_thresh=15, its=2, cluster_size_skel=25,
+                    method='lee', skeleton_of='closed', keep_steps=True):
+    ''' binarize the microtopographic image with
+    an adaptive threshold, remove noise and
+    skeletonize the trough features.
+
+    All masks are 0/1 uint8 buffers for OpenCV, in place
+    where possible, and returned as bool views of them
+    (1 byte per pixel, no copies); the raster store
+    bit-packs them when they are saved.
+
+    :param img_det: detrended DEM as uint8 (microtopography)
+    :param block_size: neighborhood size of the adaptive
+    threshold (must be odd)
+    :param c: constant subtracted from the weighted
+    mean of the adaptive threshold
+    :param cluster_size_thresh: clusters of the binarized
+    image with <= n pixels are removed
+    :param its: number of dilation iterations for closing
+    :param cluster_size_skel: clusters of the skeleton
+    with <= n pixels are removed
+    :param method: skeletonization algorithm, one of
+    SKELETON_METHODS: 'lee' (default), 'zhang' or
+    'thinning' (fast 2D thinning, see thinning())
+    :param skeleton_of: 'closed' skeletonizes the closed image;
+    'dilated' skeletonizes the dilated image instead, as the
+    published graphs in ./data were made
+    :param keep_steps: keep all intermediate images; with
+    False their buffers are reused and only the final
+    skeleton is valid (e.g. for parameter sweeps)
+    :return thresh2, thresh_unclustered, closed, img_skel,
+    skel_clu_elim_25: bool masks of all intermediate steps
+    of the segmentation (the last one is the final skeleton)
+    '''
+    # doing adaptive thresholding on the input image (troughs --> 1)
+    thresh2 = cv2.adaptiveThreshold(img_det, 1, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
+                                    block_size, c)
+    thresh_unclustered = _elim_small_clusters(thresh2.copy() if keep_steps else thresh2, cluster_size_thresh)
+
+    # close the features (dilate, then erode) to deal with white noise.
+    kernel = np.ones((5, 5), np.uint8)
+    dilated = cv2.dilate(thresh_unclustered, kernel, iterations=its)
+    closed = cv2.erode(dilated, kernel, dst=None if keep_steps else thresh_unclustered, iterations=1)
+
+    img_skel = SKELETON_METHODS[method](closed if skeleton_of == 'closed' else dilated).view(np.uint8)
+
+    # then eliminate small clusters < 25 pixels total (aka noise)
+    skel_clu_elim_25 = _elim_small_clusters(img_skel.copy() if keep_steps else img_skel, cluster_size_skel)
+    return tuple(step.view(bool) for step in (thresh2, thresh_unclustered, closed, img_skel, skel_clu_elim_25))
+
+
+def skeleton_to_graph(skel, builder='native', tile_size=None):
+    ''' build the graph of the skeleton: nodes at
+    the junctions and ends, edges along the troughs.
+
+    :param skel: skeleton raster, trough pixels != 0
+    :param builder: 'native' (skeleton_graph, array based,
+    can read the raster in tiles) or 'sknw'; both give
+    the same graph
+    :param tile_size: read the raster in tiles of this
+    size (always with the native builder)
+    :return G: nx.Graph with node centers 'o' and
+    edge pixels 'pts' (as lists) and lengths 'weight'
     '''
-    s = generate_binary_structure(2, 2)
-
-    # labeled_array give back the same array with each pixel in a cluster getting the same number
-    # but each cluster getting different numbers
-    # num_features returns the number of clusters in the array
-    labeled_array, num_features = scipy.ndimage.measurements.label(in_img, structure=s)
-
-    # get value assigned to all pixels in this cluster and number of pixels per cluster
-    # print(cluster_sizes[0]) --> value assigned to all pixels in this cluster
-    # print(cluster_sizes[1]) --> number of pixels per cluster
-    cluster_sizes = np.unique(labeled_array, return_index=False, return_inverse=False, return_counts=True)
-
-    # initialize empty array for setting troughs and non-troughs
-    result = np.zeros_like(labeled_array)
-
-    # creates list, that will read True for any clusters with more than x pixels
-    trough_bool = []
-
-    for i in cluster_sizes[1]:
-        if i > cluster_size:
-            trough_bool.append(True)
-        else:
-            trough_bool.append(False)
-
-    # for loop going through all pixels of the image 'labeled_array'
-    # and writing information in 'results'
-    for i in range(labeled_array.shape[0]):
-        for j in range(labeled_array.shape[1]):
-            # if it's larger than cluster_size, make it 1
-            if trough_bool[labeled_array[i][j]] and labeled_array[i][j] != 0:
-                result[i][j] = 1
-            else:
-                result[i][j] = 0
+    if builder == 'sknw' and tile_size is None:
+        import sknw
+        G = sknw.build_sknw(skel, multi=False)
+        # need to avoid np.arrays - so we convert it to a list
+        for (s, e) in G.edges():
+            G[s][e]['pts'] = G[s][e]['pts'].tolist()
+        return G
+    return skeleton_graph.arrays_to_graph(skeleton_graph.build_graph_arrays(skel, tile_size))
+
+
+def get_graph_stats(graph):
+    ''' gather the basic statistics of a
+    trough network graph.
+
+    :param graph: nx.DiGraph with the length of
+    each trough as edge weight 'weight'
+    :return stats: dictionary with number of
+    nodes, edges, connected components and the
+    total channel length [m]
+    '''
+    stats = {'num_nodes': graph.number_of_nodes(),
+             'num_edges': graph.number_of_edges(),
+             'num_components': nx.number_connected_components(graph.to_undirected(as_view=True)),
+             'total_length': round(float(sum(w for (s, e, w) in graph.edges(data='weight', default=0))), 2)}
+    return stats
+
+
+def _sweep_worker(shm_names, shape, dtypes, params):
+    ''' run one parameter combination of the sweep
+    on the rasters in shared memory.
+
+    :param shm_names: names of the shared memory
+    blocks holding (img_det, dem)
+    :param shape: shape of both rasters
+    :param dtypes: dtypes of (img_det, dem)
+    :param params: dict of keyword arguments
+    for segment_troughs()
+    :return result: params and graph stats combined
+    '''
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    try:
+        img_det = np.ndarray(shape, dtype=dtypes[0], buffer=shms[0].buf)
+        dem = np.ndarray(shape, dtype=dtypes[1], buffer=shms[1].buf)
+        skel = segment_troughs(img_det, keep_steps=False, **params)[-1]
+        G = skeleton_to_graph(skel)
+        H = make_directed(G, dem)
+        result = dict(params)
+        result.update(get_graph_stats(H))
+        # the arrays are views into the shared buffers and must be gone before closing
+        del img_det, dem
+    finally:
+        for shm in shms:
+            shm.close()
     return result
 
 
+def parameter_sweep(img_det, dem, param_grid, n_jobs=-1):
+    ''' evaluate a grid of segmentation parameters
+    in parallel. The detrended image and the DEM are
+    placed in shared memory once and every worker
+    reads them from there instead of receiving a copy.
+
+    :param img_det: detrended DEM as uint8 (microtopography)
+    :param dem: original DEM (for the edge directions)
+    :param param_grid: dict with keyword arguments of
+    segment_troughs() as keys and lists of values to test,
+    e.g. {'block_size': [101, 133], 'its': [1, 2]}
+    :param n_jobs: number of parallel jobs/CPU cores
+    :return results: list of dicts, one per parameter
+    combination, with the parameters and the graph stats
+    '''
+    from joblib import Parallel, delayed
+    keys = list(param_grid.keys())
+    combinations = [dict(zip(keys, vals)) for vals in itertools.product(*[param_grid[k] for k in keys])]
+
+    arrays = [np.ascontiguousarray(img_det), np.ascontiguousarray(dem)]
+    shms = []
+    try:
+        for arr in arrays:
+            shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            shms.append(shm)
+        shm_names = [shm.name for shm in shms]
+        dtypes = [arr.dtype for arr in arrays]
+        results = Parallel(n_jobs=n_jobs)(delayed(_sweep_worker)(shm_names, img_det.shape, dtypes, params)
+                                          for params in combinations)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return results
+
+
+def print_sweep_results(results):
+    ''' print the results of parameter_sweep()
+    as a table, one row per parameter combination '''
+    if not results:
+        return
+    cols = list(results[0].keys())
+    print("\t".join(cols))
+    for res in results:
+        print("\t".join(str(res[col]) for col in cols))
+
+
 def make_directed(graph, dem):
     """ convert graph from nx.Graph()
     to nx.DiGraph() - for each edge (u, v)
@@ -122,48 +353,25 @@ def make_directed(graph, dem):
         elev_end = dem[int(G_help.nodes()[e]['o'][0]), int(G_help.nodes()[e]['o'][1])]
         if elev_start < elev_end:
             G_d.remove_edge(s, e)
-    return G_d
-
+    return assign_edge_ids(G_d)
 
-def get_node_coord_dict(graph):
-    ''' create dictionary with node ID as key
-    and node coordinates as values
 
-    :param graph: nx.DiGraph
-    :return dictionary:
-    dictionary with Node IDs as keys,
-    and pixel coordinates of the nodes as values.
-    '''
-    nodes = graph.nodes()
-    # get pixel coordinates of nodes --> ps
-    ps = np.array([nodes[i]['o'] for i in nodes])
-    # get node ID --> keys
-    keys = list(range(len(nodes)))
-    keys_str = []
-    for i in keys:
-        keys_str.append(str(i))
-    keys = keys_str
-    values = ps.tolist()
-    dictionary = dict(zip(keys, values))
-    return dictionary
-
-
-def save_graph_with_coords(graph, dict, location):
+def save_graph_with_coords(graph, coords, location):
     ''' save graph as edgelist to disk
-    and coords for nodes as dictionary
+    and coords for nodes as array
 
     :param graph: nx.DiGraph representing the
     trough network
-    :param dict:
+    :param coords: node coordinates from get_node_coords()
     :return NA: function just for saving
     '''
     # save and write Graph as list of edges
     # edge weight 'weight' stores the actual length of the trough in meter
     nx.write_edgelist(graph, location + '.edgelist', data=True)
 
-    # and save coordinates of graph as npy dict to disk
+    # and save coordinates of graph as npy array to disk
     fname = location + '_node-coords'
-    np.save(fname, dict)
+    np.save(fname, coords)
 
 
 def make_process_plot(img_orig, img_det, thresh2, thresh_unclustered, closed, img_skel, skel_clu_elim_25, skel_transp,
@@ -171,7 +379,8 @@ def make_process_plot(img_orig, img_det, thresh2, thresh_unclustered, closed, im
     ''' plot the 7 substeps of the
     analysis in one plot
     '''
-    fig, axs = plt.subplots(nrows=2, ncols=3, figsize=(10, 10), sharex='all', sharey='all')
+    import matplotlib.pyplot as plt
+    fig, axs = plt.subplots(nrows=4, ncols=2, figsize=(10, 10), sharex='all', sharey='all')
 
     # DTM
     axs[0, 0].imshow(img_orig, cmap='Greens')
@@ -201,6 +410,61 @@ def make_process_plot(img_orig, img_det, thresh2, thresh_unclustered, closed, im
     plt.setp(plt.gcf().get_axes(), xticks=[], yticks=[])
     plt.savefig(save_loc, dpi=900, bbox_inches='tight', pad_inches=0)
 
+# names of the substeps of segment_troughs() in the raster store
+SUBSTEPS = ('img_det', 'thresh2', 'thresh_unclustered', 'closed', 'img_skel', 'skel_clu_elim_25')
+
+
+def save_substeps(location, **substeps):
+    ''' save the substeps of the segmentation as
+    compressed, chunked rasters (see raster_store),
+    one file per substep in the directory location,
+    e.g. save_substeps(loc, img_det=img_det, closed=closed)
+    '''
+    for name, arr in substeps.items():
+        raster_store.save_raster(os.path.join(location, name), arr)
+
+
+def load_substeps(location, window=None):
+    ''' load the stored substeps of the segmentation
+
+    :param location: directory of the substeps
+    :param window: (row_start, row_stop, col_start, col_stop)
+    to read only a part of the rasters, None for all
+    :return substeps: dictionary name --> np.array for
+    all substeps found in location
+    '''
+    return {name: raster_store.read_raster(os.path.join(location, name), window) for name in SUBSTEPS
+            if raster_store.is_raster(os.path.join(location, name))}
+
+
+def skeleton_overlay(skel):
+    ''' transparent RGBA raster with only the trough
+    pixels of the skeleton in white '''
+    skel_transp = np.zeros((skel.shape[0], skel.shape[1], 4))
+    skel_transp[skel == 1] = 255
+    return skel_transp
+
+
+def render_substeps(location, save_loc, window=None, img_orig=None):
+    ''' plot the substeps of the segmentation from the
+    raster store (see make_process_plot()), without
+    running the segmentation again
+
+    :param location: directory of the stored substeps
+    :param save_loc: path of the figure
+    :param window: (row_start, row_stop, col_start, col_stop)
+    of the area to plot, None for all
+    :param img_orig: the DTM (of the window), if it should
+    be plotted as well
+    '''
+    steps = load_substeps(location, window)
+    if img_orig is None:
+        img_orig = np.zeros_like(steps['img_det'])
+    make_process_plot(img_orig, steps['img_det'], steps['thresh2'], steps['thresh_unclustered'], steps['closed'],
+                      steps['img_skel'], steps['skel_clu_elim_25'], skeleton_overlay(steps['skel_clu_elim_25']),
+                      save_loc)
+
+
 def save_all_substeps(img_orig, img_det, thresh2, thresh_unclustered, closed, img_skel, skel_clu_elim_25, skel_transp):
     # original DTM
     # img_orig = Image.fromarray(img_orig)
@@ -228,7 +492,8 @@ def save_all_substeps(img_orig, img_det, thresh2, thresh_unclustered, closed, im
     skel_transp.save("./figures/substeps/skel_transp.png")
 
 
-def do_analysis(year):
+def do_analysis(year, method='lee', builder='native'):
+    import matplotlib.pyplot as plt
     its = 2
     if year == 2009:
         img_orig = read_data('./data/a_2009/arf_dtm_2009.tif')
@@ -240,65 +505,42 @@ def do_analysis(year):
         print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
 
     # detrend the image to return microtopographic image only
-    img_det = detrender(img_orig, 16)
-    # save microtopographic image for later use
-    im = Image.fromarray(img_det)
+    with run_metrics.stage_timer('detrend'):
+        img_det = detrender(img_orig, 16)
+    # binarize, clean and skeletonize the microtopographic image
+    with run_metrics.stage_timer('segment'):
+        thresh2, thresh_unclustered, closed, img_skel, skel_clu_elim_25 = segment_troughs(img_det, its=its, method=method)
+
+    # save the microtopography and all substeps (compressed, chunked) for later use,
+    # e.g. the skeleton for the polygon extraction or render_substeps() for the figures
     if year == 2009:
-        im.save("./data/a_2009/arf_microtopo_2009.tif")
+        substeps_loc = './data/a_2009/arf_substeps_2009'
     elif year == 2019:
-        im.save("./data/b_2019/arf_microtopo_2019.tif")
-
-    # doing adaptive thresholding on the input image
-    thresh2 = cv2.adaptiveThreshold(img_det, img_det.max(), cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
-                                    133, 11)
-    thresh_unclustered = small_cluster_elim(thresh2, 15)
-
-    # erode and dilate the features to deal with white noise.
-    kernel = np.ones((5, 5), np.uint8)
-    for i in range(1):
-        img = cv2.dilate(np.uint8(thresh_unclustered), kernel, iterations=its)
-        closed = cv2.erode(img, kernel, iterations=1)
-
-    # prepare for both possible skeletonization algorithms
-    zhang = skeletonize(img)
-    lee = skeletonize_3d(img)
-
-    img_skel = lee
+        substeps_loc = './data/b_2019/arf_substeps_2019'
+    with run_metrics.stage_timer('store'):
+        save_substeps(substeps_loc, img_det=img_det, thresh2=thresh2, thresh_unclustered=thresh_unclustered,
+                      closed=closed, img_skel=img_skel, skel_clu_elim_25=skel_clu_elim_25)
 
-    # then eliminate small clusters < 25 pixels total (aka noise)
-    skel_clu_elim_25 = small_cluster_elim(img_skel, 25)
+    # make a transparent raster with only trough pixels in red.
+    skel_transp = skeleton_overlay(skel_clu_elim_25)
 
-    im = Image.fromarray(skel_clu_elim_25)
+    with run_metrics.stage_timer('graph') as counts:
+        # build graph from skeletonized image
+        G = skeleton_to_graph(skel_clu_elim_25, builder=builder)
 
-    # make a transparent raster with only trough pixels in red.
-    skel_transp = np.zeros((skel_clu_elim_25.shape[0], skel_clu_elim_25.shape[1], 4))
-    for i in range(skel_clu_elim_25.shape[0]):
-        for j in range(skel_clu_elim_25.shape[1]):
-            if skel_clu_elim_25[i, j] == 1:
-                skel_transp[i, j, 0] = 255
-                skel_transp[i, j, 1] = 255
-                skel_transp[i, j, 2] = 255
-                skel_transp[i, j, 3] = 255
-
-    # build graph from skeletonized image
-    G = sknw.build_sknw(skel_clu_elim_25, multi=False)
-
-    # need to avoid np.arrays - so we convert it to a list
-    for (s, e) in G.edges():
-        G[s][e]['pts'] = G[s][e]['pts'].tolist()
-
-    # and make it a directed graph, since water only flows downslope
-    # flow direction is based on elevation information of DEM heights
-    dem = img_orig
-    H = make_directed(G, dem)
+        # and make it a directed graph, since water only flows downslope
+        # flow direction is based on elevation information of DEM heights
+        dem = img_orig
+        H = make_directed(G, dem)
+        counts.update(get_graph_stats(H))
 
     # save graph and node coordinates
-    dictio = get_node_coord_dict(H)
+    coords = get_node_coords(H)
 
     # if year == 2009:
-    #     save_graph_with_coords(H, dictio, './data/a_2009/arf_graph_2009')
+    #     save_graph_with_coords(H, coords, './data/a_2009/arf_graph_2009')
     # elif year == 2019:
-    #     save_graph_with_coords(H, dictio, './data/b_2019/arf_graph_2019')
+    #     save_graph_with_coords(H, coords, './data/b_2019/arf_graph_2019')
 
     plt.figure(figsize=(2.5, 2), dpi=300)
     plt.imshow(img_det, cmap='Greens_r', alpha=0.7)
@@ -307,14 +549,39 @@ def do_analysis(year):
     plt.savefig("./figures/substeps/skel_transp_on_img_det.png", bbox_inches='tight')
     # if year == 2019:
     #     save_all_substeps(img_orig, img_det, thresh2, thresh_unclustered, closed, img_skel, skel_clu_elim_25, skel_transp)
-    return H, dictio
+    return H, coords
+
+
+def do_sweep(year, param_grid, n_jobs=-1):
+    ''' run a parameter sweep of the segmentation
+    for the DEM of a given year and print the
+    resulting graph stats per parameter combination.
+    '''
+    if year == 2009:
+        img_orig = read_data('./data/a_2009/arf_dtm_2009.tif')
+    elif year == 2019:
+        img_orig = read_data('./data/b_2019/arf_dtm_2019.tif')
+    else:
+        print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
+        return []
+
+    img_det = detrender(img_orig, 16)
+    results = parameter_sweep(img_det, img_orig, param_grid, n_jobs=n_jobs)
+    print_sweep_results(results)
+    return results
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    logging.basicConfig(level=logging.WARNING)
     plt.figure()
-    # H_09, dictio_09 = do_analysis(2009)
-    H_19, dictio_19 = do_analysis(2019)
+    # H_09, coords_09 = do_analysis(2009)
+    H_19, coords_19 = do_analysis(2019)
+    # sweep_19 = do_sweep(2019, {'block_size': [101, 133, 165], 'c': [9, 11, 13],
+    #                            'cluster_size_thresh': [15], 'its': [1, 2], 'cluster_size_skel': [25]})
 
+    run_metrics.print_summary()
+    run_metrics.save_summary('./data/run_summary_dem_to_graph.json')
     # print time needed for script execution
     print(datetime.now() - startTime)
     plt.show()
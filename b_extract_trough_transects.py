@@ -1,38 +1,115 @@
 import numpy as np
-from PIL import Image
-import matplotlib.pyplot as plt
-import sys
 import networkx as nx
 import pickle
+import hashlib
 
 from datetime import datetime
-np.set_printoptions(threshold=sys.maxsize)
+import logging
+import run_metrics
+from skeleton_graph import assign_edge_ids
 
-def read_graph(edgelist_loc, coord_dict_loc):
-    ''' load graph and dict containing coords
-    of graph nodes
+logger = logging.getLogger(__name__)
+
+def read_edgelist(edgelist_loc):
+    ''' load a graph from its edgelist, with
+    integer node IDs and edge ids 'eid'. Edgelists
+    saved before the edges were numbered get their
+    ids here (see a_dem_to_graph.assign_edge_ids()).
 
     :param edgelist_loc: path on disk to the
     graph's edgelist
-    :param coord_dict_loc: path on disk to
-    the coord_dict_loc
     :return G: rebuilt nx.DiGraph from edgelist
-    :return: coord_dict: dictionary with node
-    coordinates
     '''
-    # read edgelist to build graph
     # we don't use 'read_weighted_edgelist' bc we have two weights and we want
     # to gather both. rwe somehow cannot cope with this.
     # the first weight 'weight' actually characterizes the length in pixels of the trough.
+    G = nx.read_edgelist(edgelist_loc, data=True, create_using=nx.DiGraph(), nodetype=int)
+    if any(eid is None for (s, e, eid) in G.edges(data='eid')):
+        assign_edge_ids(G)
+    return G
+
+
+def read_graph(edgelist_loc, coord_dict_loc):
+    ''' load graph and array containing coords
+    of graph nodes
 
+    :param edgelist_loc: path on disk to the
+    graph's edgelist
+    :param coord_dict_loc: path on disk to
+    the node coordinates
+    :return G: rebuilt nx.DiGraph from edgelist
+    (see read_edgelist())
+    :return: coords: np.array with the pixel
+    coordinates of node i in row i
+    '''
     # original dataset
-    G = nx.read_edgelist(edgelist_loc, data=True, create_using=nx.DiGraph())
-    coord_dict = np.load(coord_dict_loc, allow_pickle=True).item()
+    G = read_edgelist(edgelist_loc)
+    coords = np.load(coord_dict_loc, allow_pickle=True)
+    if coords.dtype == object:
+        # older runs saved a dictionary with the node IDs as strings
+        coord_dict = coords.item()
+        coords = np.array([coord_dict[str(i)] for i in range(len(coord_dict))], dtype=float).reshape(-1, 2)
+    return G, coords
+
+
+def key_by_edge_id(edge_dict, graph):
+    ''' re-key a dictionary of per-edge results
+    (transects, fits, averages) saved before the
+    edges were numbered, i.e. keyed by edge (s, e)
+    with string node IDs, by the edge ids of graph.
+    Dictionaries that are keyed by edge id already
+    are returned as they are.
+
+    :param edge_dict: dictionary edge --> value
+    :param graph: nx.DiGraph the dict belongs to
+    :return edge_dict: dictionary edge id --> value
+    (edges not in graph are dropped)
+    '''
+    if not any(isinstance(edge, tuple) for edge in edge_dict):
+        return edge_dict
+    return {graph[int(s)][int(e)]['eid']: val for (s, e), val in edge_dict.items()
+            if graph.has_edge(int(s), int(e))}
+
+
+def transect_indices(ps, stride=1, spacing=None):
+    ''' select the trough pixels of an edge at
+    which transects are extracted. The first and
+    last pixel are always skipped.
+
+    For quick-look runs, only every stride-th pixel
+    is used, or (if spacing is given) one pixel per
+    spacing meters along the edge. Per-trough stats
+    should then be averaged with
+    c_transect_analysis.get_trough_avgs_gauss(weighted=True).
+    On the 2009 data, stride=10 (spacing=10) keeps 15 % (17 %)
+    of the transects and fits 4.6x faster; the median
+    per-trough deviation is 0.7 m in mean width and 3 cm in
+    mean depth, and 72 % (75 %) of the troughs with stats
+    in the full run still get stats. Every edge with more
+    than two pixels keeps at least one transect, so the
+    speedup is limited by the many short edges.
 
-    return G, coord_dict
+    :param ps: pixel coordinates of the edge
+    :param stride: int --> use every k-th pixel
+    :param spacing: float --> distance between transects
+    along the edge [m], overrides stride
+    :return: indices of the selected pixels in ps
+    '''
+    n = len(ps)
+    if n < 3:
+        return np.arange(0)
+    if spacing is None:
+        return np.arange(1, n - 1, stride)
+    # distance along the edge up to each pixel
+    steps = np.hypot(*np.diff(np.asarray(ps, dtype=float), axis=0).T)
+    dist = np.concatenate(([0.], np.cumsum(steps)))
+    # take the first pixel of each spacing-long bin
+    bins = np.floor(dist[1:n - 1] / spacing)
+    first = np.concatenate(([True], bins[1:] != bins[:-1]))
+    return np.arange(1, n - 1)[first]
 
 
-def get_transects(graph, dem, width):
+def get_transects(graph, dem, width, stride=1, spacing=None):
     ''' extract the height from DEM along transects
     perpendicular to the trough line (the graph edge)
 
@@ -48,8 +125,11 @@ def get_transects(graph, dem, width):
     :param graph: nx.DiGraph (the trough network graph)
     :param dem: np.array of the DEM image
     :param width: int --> how wide should the transect be?
+    :param stride: int --> only use every k-th trough pixel
+    :param spacing: float --> or one trough pixel every
+    spacing meters (see transect_indices())
     :return dict_outer: a dictionary with
-    - outer_keys: edge (s, e) and
+    - outer_keys: edge id 'eid' of the edge (s, e) and
     - outer_values: dict of transects
     with:
     - inner_keys: pixel-coords of trough pixels (x, y)
@@ -71,7 +151,7 @@ def get_transects(graph, dem, width):
         ps = graph[s][e]['pts']  # pixel coordinates for all trough pixels between edge (s, e)
         # iterate through all pixels of a trough except the first and last one and retrieve transect information
         # this skips troughs with length (2 pixels), but they do not hold much information anyway.
-        for i in range(1, len(ps)-1):
+        for i in transect_indices(ps, stride, spacing):
             water = False
             keys_inner.append((ps[i][0], ps[i][1]))  # x and y coordinates of each of my current edge pixels
             px_current = (ps[i][0], ps[i][1])  # coords of pixel p
@@ -284,55 +364,322 @@ def get_transects(graph, dem, width):
                     values_inner.append([transect_heights, transect_loc, t_type, t_cat, water])
                 # for catching errors...
                 else:
-                    print("I messed up an edge case...")
-                    print("px_prev = {0}, px_current = {1}, px_subs = {2}".format(px_prev, px_current, px_subs))
+                    run_metrics.count('extract', 'unknown_scenario')
+                    logger.debug("I messed up an edge case... px_prev = {0}, px_current = {1}, px_subs = {2}".format(
+                        px_prev, px_current, px_subs))
             else:
-                pass
-                # print(s, e)  # these are the border cases, but they still have some transects, so all good
+                # these are the border cases, but they still have some transects, so all good
+                run_metrics.count('extract', 'border_skipped')
         # now recombine all elements to the inner transect dict
         dict_inner = dict(zip(keys_inner, values_inner))  # values_inner ist auch schon leer
+        run_metrics.count('extract', 'water_filled', sum(val[4] for val in values_inner))
 
         inner_dictio.append(dict_inner)
-        edge_val.append((s, e))
+        edge_val.append(graph[s][e]['eid'])
     # combine the extracted transects as dicts to the previously inputted outer-dict.
     dict_outer = dict(zip(edge_val, inner_dictio))
     return dict_outer
 
 
+def get_transects_interp(graph, dem, width, smooth=2, stride=1, spacing=None):
+    ''' extract the height from DEM along transects
+    perpendicular to the local trough direction, at
+    any angle and with sub-pixel precision.
+
+    The trough direction at pixel p_i is estimated
+    from the pixels p_(i-smooth) and p_(i+smooth) of
+    the same edge (clamped at the edge ends). Along the
+    perpendicular, width*2 + 1 heights are sampled at
+    a spacing of 1 pixel with bilinear interpolation,
+    so all transects have the same length in meters
+    (no sqrt(2) stretch for diagonals). All transects
+    of all edges are sampled in a single vectorized
+    map_coordinates call. Transects don't depend on
+    the orientation of the edge: they run towards
+    increasing columns (towards increasing rows if
+    the trough runs along a row).
+
+    :param graph: nx.DiGraph (the trough network graph)
+    :param dem: np.array of the DEM image
+    :param width: int --> how wide should the transect be?
+    :param smooth: int --> half size of the pixel window
+    used to estimate the trough direction
+    :param stride: int --> only use every k-th trough pixel
+    :param spacing: float --> or one trough pixel every
+    spacing meters (see transect_indices())
+    :return dict_outer: same structure as get_transects(),
+    but with:
+        - [1]: (sub-pixel) coordinates of transect (xi, yi)
+        - [2]: "perpendicular"
+        - [3]: direction of the trough in degrees (-180, 0]
+    '''
+    edges = [eid for (s, e, eid) in graph.edges(data='eid')]
+    pts_list = [np.asarray(pts, dtype=float).reshape(-1, 2) for (s, e, pts) in graph.edges(data='pts')]
+    lengths = np.array([len(ps) for ps in pts_list], dtype=np.int64)
+    dict_outer = {edge: {} for edge in edges}
+    if lengths.sum() == 0:
+        return dict_outer
+    pts = np.concatenate(pts_list)
+    # index of the first and last pixel of each edge within pts
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    edge_idx = np.repeat(np.arange(len(edges)), lengths)
+
+    # like get_transects(), skip the first and last pixel of each edge (and decimate if requested)
+    if stride == 1 and spacing is None:
+        idx = np.arange(len(pts))
+        interior = (idx > starts[edge_idx]) & (idx < ends[edge_idx] - 1)
+        idx = idx[interior]
+        edge_idx = edge_idx[interior]
+    else:
+        idx = np.concatenate([start + transect_indices(ps, stride, spacing)
+                              for start, ps in zip(starts, pts_list)]).astype(np.int64)
+        edge_idx = edge_idx[idx]
+
+    # make sure to not consider any cases at the border of the image
+    # to avoid only partial transects
+    centers = pts[idx]
+    inside = ((width < centers[:, 0]) & (centers[:, 0] < dem.shape[0] - width) &
+              (width < centers[:, 1]) & (centers[:, 1] < dem.shape[1] - width))
+    run_metrics.count('extract', 'border_skipped', int((~inside).sum()))
+    idx = idx[inside]
+    edge_idx = edge_idx[inside]
+    centers = centers[inside]
+
+    # local trough direction from a window of +- smooth pixels along the edge
+    prev_idx = np.maximum(idx - smooth, starts[edge_idx])
+    subs_idx = np.minimum(idx + smooth, ends[edge_idx] - 1)
+    direction = pts[subs_idx] - pts[prev_idx]
+    norm = np.hypot(direction[:, 0], direction[:, 1])
+    norm[norm == 0] = 1
+    direction = direction / norm[:, None]
+    # orient every transect the same way, whichever way the edge runs: the normal
+    # (dcol, -drow) points to increasing columns, or to increasing rows if it is
+    # vertical (like the vertical and horizontal transects of get_transects())
+    flip = (direction[:, 0] > 0) | ((direction[:, 0] == 0) & (direction[:, 1] < 0))
+    direction[flip] *= -1
+    normal = np.stack([direction[:, 1], -direction[:, 0]], axis=1)
+
+    # sample all transects at once: shape (num_transects, width*2 + 1)
+    from scipy.ndimage import map_coordinates
+    offsets = np.arange(-width, width + 1, dtype=float)
+    rows = centers[:, 0, None] + offsets[None, :] * normal[:, 0, None]
+    cols = centers[:, 1, None] + offsets[None, :] * normal[:, 1, None]
+    heights = map_coordinates(dem, [rows.ravel(), cols.ravel()], order=1, mode='nearest').reshape(rows.shape)
+
+    # if more then half of the transect pixels have the same height value, we assume that there is water
+    # in the trough.
+    heights_sorted = np.sort(heights, axis=1)
+    num_unique = (np.diff(heights_sorted, axis=1) != 0).sum(axis=1) + 1
+    water = num_unique <= width
+    run_metrics.count('extract', 'water_filled', int(water.sum()))
+    angles = np.round(np.degrees(np.arctan2(direction[:, 0], direction[:, 1])), 1)
+
+    # now recombine all transects to the inner and outer dicts
+    for k in range(len(idx)):
+        key = (int(centers[k, 0]), int(centers[k, 1]))
+        transect_loc = list(zip(rows[k].tolist(), cols[k].tolist()))
+        dict_outer[edges[edge_idx[k]]][key] = [heights[k], transect_loc, "perpendicular", float(angles[k]),
+                                               bool(water[k])]
+    return dict_outer
+
+
 def save_obj(obj, name):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
 
 
-def do_analysis(year):
+def load_obj(name):
+    with open(name + '.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+def edge_pts_hash(pts):
+    ''' hash the pixel coordinates of a
+    trough to detect changed edges.
+
+    :param pts: list of pixel coordinates
+    of an edge (graph[s][e]['pts'])
+    :return: hex digest of the coordinates
+    '''
+    return hashlib.sha1(np.asarray(pts, dtype=np.int64).tobytes()).hexdigest()
+
+
+def _edge_key(pts):
+    ''' the pixel coordinates of the ends of an
+    edge (its node centers) and the hash of its pixel
+    coordinates, both independent of the order of pts '''
+    pts = np.asarray(pts, dtype=np.int64).reshape(-1, 2)
+    if tuple(pts[0]) > tuple(pts[-1]):
+        pts = pts[::-1]
+    return (tuple(pts[0].tolist()), tuple(pts[-1].tolist())), edge_pts_hash(pts)
+
+
+def diff_graphs(graph_old, graph_new):
+    ''' compare two versions of the trough
+    network by the content of the edges: the pixel
+    coordinates of their ends and the hash of all
+    their pixel coordinates. Node ids are not
+    compared, as re-skeletonizing renumbers them.
+    The results of an edge only depend on its pixels,
+    so a flat trough (an edge in both directions)
+    matches either of its two old edges.
+
+    :param graph_old: nx.DiGraph the stored
+    transects were extracted from
+    :param graph_new: nx.DiGraph after editing
+    or re-skeletonizing (parts of) the site
+    :return added: ids of the edges only in graph_new
+    :return changed: ids (in graph_new) of the edges
+    between the same end points in both graphs, but
+    with different pixel coordinates
+    :return removed: ids of the edges only in graph_old
+    :return kept: list of (s, e, id in graph_old, id in
+    graph_new) of the unchanged edges, with the nodes
+    (s, e) of graph_old
+    '''
+    old_pts = {}
+    for (s, e, data) in graph_old.edges(data=True):
+        old_pts.setdefault(_edge_key(data['pts']), []).append((s, e, data['eid']))
+    kept = []
+    rest = []
+    for (s, e, data) in graph_new.edges(data=True):
+        key = _edge_key(data['pts'])
+        if old_pts.get(key):
+            s_old, e_old, eid_old = old_pts[key].pop(0)
+            kept.append((s_old, e_old, eid_old, data['eid']))
+        else:
+            rest.append((key[0], data['eid']))
+    # the remaining edges of graph_old, by their ends
+    old_ends = {}
+    for (ends, h), edges in old_pts.items():
+        old_ends.setdefault(ends, []).extend(eid for (s, e, eid) in edges)
+    added, changed = [], []
+    for ends, eid in rest:
+        if old_ends.get(ends):
+            old_ends[ends].pop(0)
+            changed.append(eid)
+        else:
+            added.append(eid)
+    removed = sorted(eid for eids in old_ends.values() for eid in eids)
+    return added, changed, removed, kept
+
+
+def apply_delta(edge_dict, delta):
+    ''' carry a dictionary of per-edge results
+    (transects, fits, averages) of graph_old over to
+    graph_new of a delta: the unchanged edges move to
+    their ids in graph_new, all others are dropped.
+    edge_dict is patched in place.
+
+    :param edge_dict: dictionary edge id --> value
+    (or edge (s, e) --> value, if saved before the
+    edges were numbered)
+    :param delta: dict from update_transects()
+    :return edge_dict: the patched dictionary
+    '''
+    moved = {}
+    for (s, e, old, new) in delta['kept']:
+        for key in (old, (str(s), str(e))):
+            if key in edge_dict:
+                moved[new] = edge_dict[key]
+                break
+    edge_dict.clear()
+    edge_dict.update(moved)
+    return edge_dict
+
+
+def update_transects(transect_dict, graph_old, graph_new, dem, width, sampler=None, **kwargs):
+    ''' incrementally update the transects of a
+    previous run: only added and changed edges are
+    extracted again, removed edges are dropped.
+    transect_dict is patched in place.
+
+    :param transect_dict: dictionary of transects
+    as returned by get_transects() for graph_old
+    :param graph_old: nx.DiGraph of the previous run
+    :param graph_new: nx.DiGraph of the current run
+    :param dem: np.array of the DEM image
+    :param width: int --> how wide should the transect be?
+    :param sampler: transect function to use (defaults
+    to get_transects)
+    :param kwargs: further arguments for the sampler
+    (e.g. stride or spacing)
+    :return transect_dict: the patched dictionary,
+    keyed by the edge ids of graph_new
+    :return delta: dict with the lists of 'updated'
+    (added + changed, ids in graph_new), 'removed' (ids
+    in graph_old) and 'kept' edges (see diff_graphs()),
+    so that the fitting only needs to touch these.
+    '''
+    if sampler is None:
+        sampler = get_transects
+    added, changed, removed, kept = diff_graphs(graph_old, graph_new)
+    updated = added + changed
+    delta = {'updated': updated, 'removed': removed, 'kept': kept}
+    apply_delta(transect_dict, delta)
+    updated_set = set(updated)
+    transect_dict.update(sampler(graph_new.edge_subgraph((s, e) for (s, e, eid) in graph_new.edges(data='eid')
+                                                         if eid in updated_set), dem, width, **kwargs))
+    return transect_dict, delta
+
+
+def do_analysis(year, prev_edgelist_loc=None, interpolate=False, stride=1, spacing=None):
+    ''' extract the transects for all troughs of
+    the given year. If prev_edgelist_loc points to
+    the edgelist the stored transect dict was
+    extracted from, only the edges that differ from
+    it are extracted again and the stored dict is
+    patched (and the delta saved for the fitting).
+    With interpolate=True, the arbitrary-angle
+    sampler get_transects_interp() is used.
+    stride/spacing decimate the transects for
+    quick-look runs (see transect_indices()).
+    '''
     if year == 2009:
-        H, coord_dict = read_graph(edgelist_loc='./data/a_2009/arf_graph_2009.edgelist',
-                                   coord_dict_loc='./data/a_2009/arf_graph_2009_node-coords.npy')
-
-        img1 = Image.open('./data/a_2009/arf_dtm_2009.tif')
-        img1 = np.array(img1)
-        # extract transects of 9 meter width (trough_width*2 + 1 == 9)
-        trough_width = 4
-        transect_dict = get_transects(H, img1, trough_width)
-        save_obj(transect_dict, './data/a_2009/arf_transect_dict_2009')
+        edgelist_loc = './data/a_2009/arf_graph_2009.edgelist'
+        coord_dict_loc = './data/a_2009/arf_graph_2009_node-coords.npy'
+        dem_loc = './data/a_2009/arf_dtm_2009.tif'
+        transect_loc = './data/a_2009/arf_transect_dict_2009'
+        delta_loc = './data/a_2009/arf_transect_delta_2009'
     elif year == 2019:
-        H, coord_dict = read_graph(edgelist_loc='./data/b_2019/arf_graph_2019.edgelist',
-                                   coord_dict_loc='./data/b_2019/arf_graph_2019_node-coords.npy')
-
-        img1 = Image.open('./data/b_2019/arf_dtm_2019.tif')
-        img1 = np.array(img1)
-        # extract transects of 9 meter width (trough_width*2 + 1 == 9)
-        trough_width = 4
-        transect_dict = get_transects(H, img1, trough_width)
-        save_obj(transect_dict, './data/b_2019/arf_transect_dict_2019')
+        edgelist_loc = './data/b_2019/arf_graph_2019.edgelist'
+        coord_dict_loc = './data/b_2019/arf_graph_2019_node-coords.npy'
+        dem_loc = './data/b_2019/arf_dtm_2019.tif'
+        transect_loc = './data/b_2019/arf_transect_dict_2019'
+        delta_loc = './data/b_2019/arf_transect_delta_2019'
     else:
         print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
+        return
+
+    H, coord_dict = read_graph(edgelist_loc=edgelist_loc, coord_dict_loc=coord_dict_loc)
+
+    from PIL import Image
+    img1 = Image.open(dem_loc)
+    img1 = np.array(img1)
+    # extract transects of 9 meter width (trough_width*2 + 1 == 9)
+    trough_width = 4
+    sampler = get_transects_interp if interpolate else get_transects
+    with run_metrics.stage_timer('extract'):
+        if prev_edgelist_loc is not None:
+            H_prev = read_edgelist(prev_edgelist_loc)
+            transect_dict = load_obj(transect_loc)
+            transect_dict, delta = update_transects(transect_dict, H_prev, H, img1, trough_width, sampler,
+                                                     stride=stride, spacing=spacing)
+            save_obj(delta, delta_loc)
+        else:
+            transect_dict = sampler(H, img1, trough_width, stride=stride, spacing=spacing)
+    save_obj(transect_dict, transect_loc)
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    logging.basicConfig(level=logging.WARNING)
     startTime = datetime.now()
 
     do_analysis(2009)
     do_analysis(2019)
 
+    run_metrics.print_summary()
+    run_metrics.save_summary('./data/run_summary_extract_transects.json')
     print(datetime.now() - startTime)
     plt.show()
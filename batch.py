@@ -0,0 +1,246 @@
+''' batch processing of many DTM tiles.
+
+The tiles are listed in a manifest (csv with the columns
+'tile' and 'dtm'; relative DTM paths are relative to the
+manifest). Every tile runs the graph, extract, fit and
+network stages of iwd.py with the tunables of a site
+config, in a pool of worker processes:
+
+    python batch.py sites/anaktuvuk_river_fire.toml tiles.csv --jobs 16
+
+Each finished stage is recorded in an SQLite journal
+(<output_dir>/batch_journal.sqlite by default); when the
+batch is started again, it resumes with the stages that
+have not finished yet (failed stages are retried). In the
+end, the network statistics of all tiles are aggregated.
+'''
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import numpy as np
+import iwd
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('graph', 'extract', 'fit', 'network')
+
+
+def read_manifest(location):
+    ''' read the tiles of a batch
+
+    :param location: path of the manifest csv
+    :return tiles: list of epochs (in the sense of the
+    site config) with the tile id as 'name' and 'dir'
+    '''
+    base = os.path.dirname(os.path.abspath(location))
+    tiles = []
+    with open(location, newline='') as f:
+        for row in csv.DictReader(f):
+            tile = row['tile'].strip()
+            tiles.append({'name': tile, 'dir': tile, 'dtm': os.path.join(base, row['dtm'].strip())})
+    if len({tile['name'] for tile in tiles}) != len(tiles):
+        raise ValueError("the manifest {} lists tiles more than once".format(location))
+    return tiles
+
+
+def open_journal(location):
+    ''' open (or create) the journal of a batch
+
+    :param location: path of the SQLite database
+    :return con: sqlite3.Connection with the tables
+    - stages: one row per tile and stage with the status
+    ('done' or 'failed'), run time and error message
+    - network: the network statistics per tile (json)
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(location)), exist_ok=True)
+    con = sqlite3.connect(location)
+    con.execute('''CREATE TABLE IF NOT EXISTS stages (tile TEXT, stage TEXT, status TEXT, seconds REAL,
+                   error TEXT, finished TEXT, PRIMARY KEY (tile, stage))''')
+    con.execute('CREATE TABLE IF NOT EXISTS network (tile TEXT PRIMARY KEY, stats TEXT)')
+    con.commit()
+    return con
+
+
+def record_stage(con, tile, stage, status, seconds, error=None, stats=None):
+    ''' record a finished (or failed) stage of a tile '''
+    with con:
+        con.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)',
+                    (tile, stage, status, seconds, error, datetime.now().isoformat(timespec='seconds')))
+        if stats is not None:
+            con.execute('INSERT OR REPLACE INTO network VALUES (?, ?)', (tile, json.dumps(stats)))
+
+
+def next_stages(con, tiles):
+    ''' the first unfinished stage per tile
+
+    :return todo: list of (tile, index of the stage in
+    STAGES) for all tiles that are not done yet
+    '''
+    done = {(tile, stage) for tile, stage in con.execute("SELECT tile, stage FROM stages WHERE status = 'done'")}
+    todo = []
+    for tile in tiles:
+        for i, stage in enumerate(STAGES):
+            if (tile['name'], stage) not in done:
+                todo.append((tile, i))
+                break
+    return todo
+
+
+def run_stage(config, tile, stage, tile_size, cache_dir):
+    ''' run one stage of a tile (in a worker process).
+    The parallelism is over the tiles, so the stages
+    themselves run with a single job.
+
+    :return seconds: run time of the stage
+    :return stats: network statistics (for the
+    network stage, else None)
+    '''
+    import d_network_analysis
+    start = time.perf_counter()
+    stats = None
+    if stage == 'network':
+        G = iwd.load_epoch_graph(config, tile)
+        report = d_network_analysis.get_network_report(G, expensive=config['network']['expensive'],
+                                                       cache_dir=cache_dir)
+        stats = d_network_analysis.report_scalars(report)
+    else:
+        args = argparse.Namespace(jobs=1, tile_size=tile_size, cache_dir=cache_dir)
+        {'graph': iwd.stage_graph, 'extract': iwd.stage_extract, 'fit': iwd.stage_fit}[stage](config, tile, args)
+    return time.perf_counter() - start, stats
+
+
+def run_batch(config, tiles, con, jobs=4, tile_size=None, cache_dir=None):
+    ''' run all unfinished stages of the tiles with
+    at most jobs stages at a time. The next stage of
+    a tile is started as soon as its previous stage is
+    done, before new tiles are started, so only a few
+    tiles are in progress at any time.
+
+    :return failed: list of (tile, stage, error)
+    '''
+    queue = deque(next_stages(con, tiles))
+    print("{0} of {1} tiles to process".format(len(queue), len(tiles)))
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while queue or running:
+            while queue and len(running) < jobs:
+                tile, i = queue.popleft()
+                running[pool.submit(run_stage, config, tile, STAGES[i], tile_size, cache_dir)] = (tile, i)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                tile, i = running.pop(future)
+                try:
+                    seconds, stats = future.result()
+                except Exception as e:
+                    logger.warning("tile %s failed in stage %s: %r", tile['name'], STAGES[i], e)
+                    record_stage(con, tile['name'], STAGES[i], 'failed', None, error=repr(e))
+                    failed.append((tile['name'], STAGES[i], repr(e)))
+                    continue
+                record_stage(con, tile['name'], STAGES[i], 'done', seconds, stats=stats)
+                if i + 1 < len(STAGES):
+                    queue.appendleft((tile, i + 1))
+    return failed
+
+
+def aggregate_network_stats(con, tiles=None):
+    ''' aggregate the network statistics of the tiles
+    in the journal
+
+    :param tiles: only these tiles (ids), None for all
+    :return tiles: list of the tile ids
+    :return stats: dictionary metric --> np.array with
+    the value per tile (nan where a tile lacks it)
+    '''
+    rows = con.execute('SELECT tile, stats FROM network ORDER BY tile').fetchall()
+    if tiles is not None:
+        rows = [row for row in rows if row[0] in set(tiles)]
+    tiles = [tile for tile, _ in rows]
+    per_tile = [json.loads(s) for _, s in rows]
+    names = []
+    for s in per_tile:
+        names.extend(name for name in s if name not in names)
+    stats = {name: np.array([s.get(name, np.nan) for s in per_tile], dtype=float) for name in names}
+    return tiles, stats
+
+
+def print_network_stats(tiles, stats):
+    ''' print sum, median, min and max of
+    each metric over the tiles '''
+    print("network statistics of {} tiles".format(len(tiles)))
+    print("{0:<48}{1:>16}{2:>16}{3:>16}{4:>16}".format('metric', 'sum', 'median', 'min', 'max'))
+    for name, values in stats.items():
+        print("{0:<48}{1:>16.6g}{2:>16.6g}{3:>16.6g}{4:>16.6g}".format(
+            name, np.nansum(values), np.nanmedian(values), np.nanmin(values), np.nanmax(values)))
+
+
+def save_network_stats(tiles, stats, location):
+    ''' save the network statistics per tile as csv '''
+    with open(location, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['tile'] + list(stats))
+        for i, tile in enumerate(tiles):
+            writer.writerow([tile] + [stats[name][i] for name in stats])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='batch', description="run the analysis for many DTM tiles")
+    parser.add_argument('config', help="site configuration (.toml, .yaml) with the tunables")
+    parser.add_argument('manifest', help="csv with the columns 'tile' and 'dtm'")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help="read the skeleton in tiles of this size when building the graph")
+    parser.add_argument('--cache-dir', default=None,
+                        help="cache of the network reports (default: <output_dir>/cache)")
+    parser.add_argument('--journal', default=None,
+                        help="SQLite journal of the batch (default: <output_dir>/batch_journal.sqlite)")
+    parser.add_argument('--stats', default=None, help="save the network statistics per tile (csv) to this path")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log progress")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    start_time = datetime.now()
+
+    # the epochs of the site config are replaced by the tiles
+    try:
+        config = iwd.load_config(args.config, require_epochs=False)
+    except ImportError as err:
+        print(err)
+        return 1
+    tiles = read_manifest(args.manifest)
+    overwritten = iwd.writes_bundled_data(config, tiles)
+    if overwritten:
+        print("the outputs of the tiles {} would overwrite the bundled data; set another output_dir "
+              "in the site config".format(', '.join(overwritten)))
+        return 1
+    output_dir = config['site']['output_dir']
+    cache_dir = args.cache_dir or os.path.join(output_dir, 'cache')
+    con = open_journal(args.journal or os.path.join(output_dir, 'batch_journal.sqlite'))
+
+    failed = run_batch(config, tiles, con, jobs=args.jobs, tile_size=args.tile_size, cache_dir=cache_dir)
+    for tile, stage, error in failed:
+        print("tile {0} failed in stage {1}: {2}".format(tile, stage, error))
+
+    tile_ids, stats = aggregate_network_stats(con, [tile['name'] for tile in tiles])
+    if tile_ids:
+        print_network_stats(tile_ids, stats)
+        if args.stats:
+            save_network_stats(tile_ids, stats, args.stats)
+    con.close()
+    print(datetime.now() - start_time)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
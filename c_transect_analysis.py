@@ -1,42 +1,22 @@
-import sys
 import pickle
 import numpy as np
-from PIL import Image
-from scipy.optimize import curve_fit
-from sklearn.metrics import r2_score
 from datetime import datetime
-import matplotlib.pyplot as plt
-from joblib import Parallel, delayed
+import time
+import logging
+from collections import Counter
+import run_metrics
+import profile_models
+
+logger = logging.getLogger(__name__)
 
 startTime = datetime.now()
-np.set_printoptions(threshold=sys.maxsize)
 
 def load_obj(name):
     with open(name + '.pkl', 'rb') as f:
         return pickle.load(f)
 
 
-def read_data(img1):
-    ''' helper function to make reading in DEMs easier '''
-    # this is the original DEM
-    if img1 == "original":
-        # img1 = Image.open('D:/01_anaktuvuk_river_fire/00_working/01_processed-data/00_study-area'
-        #                   '/li-dem_1m_sa3_fill.tif')
-        img1 = Image.open('D:/01_anaktuvuk_river_fire/00_working/01_processed-data/00_study-area/bens_data'
-                          '/ben_2009_DTM_1m_small-sa.tif')
-        img1 = np.array(img1)
-
-    # this is the microtopo image:
-    if img1 == "detrended":
-        # img1 = Image.open('D:/01_anaktuvuk_river_fire/00_working/01_processed-data/02_microtopography'
-        #                   '/awi_2019_DTM_1m_reproj_300x300_02_microtopo_16m.tif')
-        img1 = Image.open("D:/01_anaktuvuk_river_fire/00_working/01_processed-data/02_microtopography/"
-                          "ben_2009_DTM_1m_small-sa_detrended_16m.tif")
-        img1 = np.array(img1)
-    return img1
-
-
-def inner(key, val, out_key):
+def inner(key, val, out_key, counts=None, profile=None, seed=None):
     ''' fits a gaussian to every transect
     height profile and adds transect parameters
     to the dictionary.
@@ -45,19 +25,44 @@ def inner(key, val, out_key):
     (determines center of transect)
     :param val: list of transect heights,
     coords, and directionality/type
-    :param out_key: current edge with (s, e)
+    :param out_key: current edge id (edge (s, e))
+    :param counts: Counter for the outcome of the
+    fit ('fitted', 'fit_failed', 'water_filled_unfitted',
+    'fit_error', 'empty_transect')
+    :param profile: list; if given, a record with
+    the outcome, the number of function evaluations
+    and the time spent in curve_fit/r2_score/total is
+    appended (see fit_profile_report())
+    :param seed: (skip_reason, p0) from screen_transects();
+    if skip_reason is set, the transect isn't fitted,
+    otherwise p0 is used as initial guess
     :return val: updated val with:
     - val[5] = fwhm_gauss --> transect width
     - val[6] = mean_gauss --> transect depth
     - val[7] = cod_gauss --> r2 of fit
     '''
+    from scipy.optimize import curve_fit
+    from sklearn.metrics import r2_score
+    if counts is None:
+        counts = Counter()
+    start = time.perf_counter()
+    record = {'edge': out_key, 'coords': key, 'status': 'empty_transect', 'reason': '',
+              'fit_seconds': 0., 'r2_seconds': 0.}
+    # number of evaluations of the model (incl. those for the finite difference jacobian)
+    nfev = [0]
+
     # implement the gaussian function
     def my_gaus(x, a, mu, sigma):
+        nfev[0] += 1
         return a * np.exp(-(x - mu) ** 2 / (2 * sigma ** 2))
 
     # check if there's a transect to fit in the first place
     # (some transects at the image edge/corner might be empty) --> but there are none
-    if len(val[0]) != 0:
+    if seed is not None and seed[0] is not None:
+        # screened out before fitting, as it would be discarded anyway
+        counts['screened_' + seed[0]] += 1
+        record['status'] = 'screened_' + seed[0]
+    elif len(val[0]) != 0:
         # flip the transect along x-axis to be able to fit the Gaussian
         data = val[0] * (-1) + np.max(val[0])
         N = len(data)  # number of data points (corresponds to width*2 + 1)
@@ -73,87 +78,180 @@ def inner(key, val, out_key):
                                 # (lowest point within the trough)
         sigma = np.sqrt(sum(data * (t - mean) ** 2) / N) + 1  # estimate for sigma is determined via the underlying data
                                                               # + 1 to avoid division by 0 for flat transects
+        p0 = [1, mean, sigma]
+        # or take the data-driven guesses of the screening
+        if seed is not None:
+            p0 = seed[1]
 
         # now fit the Gaussian & raise error for those that can't be fitted
+        fit_start = time.perf_counter()
         try:
-            gauss_fit = curve_fit(my_gaus, t, data, p0=[1, mean, sigma], maxfev=500000,
+            gauss_fit = curve_fit(my_gaus, t, data, p0=p0, maxfev=500000,
                                   bounds=[(-np.inf, -np.inf, 0.01), (np.inf, np.inf, 8.5)])
-        except RuntimeError:
-            print('RuntimeError is raised with edge: {0} coords {1} and elevations: {2}'.format(out_key, key, val))
-            # pass
+        except RuntimeError as err:
+            gauss_fit = None
+            counts['fit_failed'] += 1
+            record['status'], record['reason'] = 'fit_failed', str(err)
+            logger.debug('RuntimeError is raised with edge: {0} coords {1} and elevations: {2}'.format(out_key, key, val))
+        record['fit_seconds'] = time.perf_counter() - fit_start
 
         try:
-            # recreate the fitted curve using the optimized parameters
-            data_gauss_fit = my_gaus(t, *gauss_fit[0])
-
-            # and finally get depth and width and r2 of fit for adding to original dictionary (val)
-            max_gauss = np.max(data_gauss_fit)
-            fwhm_gauss = 2 * np.sqrt(2 * np.log(2)) * abs(gauss_fit[0][2])
-            cod_gauss = r2_score(data, data_gauss_fit)
-            # append the parameters to val
-            val.append(fwhm_gauss)
-            val.append(max_gauss)
-            val.append(cod_gauss)
-
-            plotting=True
-            if key[0]==15 and key[1]==610:
-                plt.plot(t, data, '+:', label='DTM elevation', color='darkslategrey')
-                plt.plot(t, data_gauss_fit, color='lightseagreen',
-                         label='fitted Gaussian')
-                # , d={0}, w={1}, r2={2}'.format(round(max_gauss, 2),
-                #                                                                     round(fwhm_gauss, 2),
-                #                                                                     round(cod_gauss, 2)
-                plt.legend(frameon=False)
-                plt.ylabel("depth below ground [m]")
-                plt.xlabel("transect length [m]")
-                plt.xticks(np.arange(9), np.arange(1, 10))
-                plt.text(0, 0.25, f'trough width: {round(fwhm_gauss, 2)} m', fontsize=8)
-                plt.text(0, 0.235, f'trough depth: {round(max_gauss, 2)} m', fontsize=8)
-                plt.text(0, 0.22, f'$r^2$ of fit: {round(cod_gauss, 2)}', fontsize=8)
-                # plt.title("direction: {0}, category: {1}".format(val[2], val[3]))
-                plt.savefig('./figures/fitted_to_coords_{0}_{1}.png'.format(key[0], key[1]), dpi=300)
-                plt.close()
-        except:
+            if gauss_fit is not None:
+                # recreate the fitted curve using the optimized parameters
+                data_gauss_fit = my_gaus(t, *gauss_fit[0])
+
+                # and finally get depth and width and r2 of fit for adding to original dictionary (val)
+                max_gauss = np.max(data_gauss_fit)
+                fwhm_gauss = 2 * np.sqrt(2 * np.log(2)) * abs(gauss_fit[0][2])
+                r2_start = time.perf_counter()
+                cod_gauss = r2_score(data, data_gauss_fit)
+                record['r2_seconds'] = time.perf_counter() - r2_start
+                # append the parameters to val
+                val.append(fwhm_gauss)
+                val.append(max_gauss)
+                val.append(cod_gauss)
+                counts['fitted'] += 1
+                record['status'] = 'fitted'
+
+                plotting=True
+                if key[0]==15 and key[1]==610:
+                    import matplotlib.pyplot as plt
+                    plt.plot(t, data, '+:', label='DTM elevation', color='darkslategrey')
+                    plt.plot(t, data_gauss_fit, color='lightseagreen',
+                             label='fitted Gaussian')
+                    # , d={0}, w={1}, r2={2}'.format(round(max_gauss, 2),
+                    #                                                                     round(fwhm_gauss, 2),
+                    #                                                                     round(cod_gauss, 2)
+                    plt.legend(frameon=False)
+                    plt.ylabel("depth below ground [m]")
+                    plt.xlabel("transect length [m]")
+                    plt.xticks(np.arange(9), np.arange(1, 10))
+                    plt.text(0, 0.25, f'trough width: {round(fwhm_gauss, 2)} m', fontsize=8)
+                    plt.text(0, 0.235, f'trough depth: {round(max_gauss, 2)} m', fontsize=8)
+                    plt.text(0, 0.22, f'$r^2$ of fit: {round(cod_gauss, 2)}', fontsize=8)
+                    # plt.title("direction: {0}, category: {1}".format(val[2], val[3]))
+                    plt.savefig('./figures/fitted_to_coords_{0}_{1}.png'.format(key[0], key[1]), dpi=300)
+                    plt.close()
+        except Exception as err:
             # bad error handling:
+            record['reason'] = repr(err)
             if val[4]:
-                print("a water-filled trough can't be fitted: edge: {}".format(out_key))
+                counts['water_filled_unfitted'] += 1
+                record['status'] = 'water_filled_unfitted'
+                logger.debug("a water-filled trough can't be fitted: edge: {}".format(out_key))
             else:
-                print("something seriously wrong")
+                counts['fit_error'] += 1
+                record['status'] = 'fit_error'
+                logger.debug("something seriously wrong: edge: {0} coords {1}".format(out_key, key))
     else:
-        print(val)
+        counts['empty_transect'] += 1
+        logger.debug("empty transect: edge: {0} coords {1}".format(out_key, key))
+    if profile is not None:
+        record['nfev'] = nfev[0]
+        record['total_seconds'] = time.perf_counter() - start
+        profile.append(record)
+    return val
 
 
-def outer(out_key, inner_dict):
+def outer(out_key, inner_dict, profile=False, seeds=None):
     ''' iterate through all transects of a
     single trough and send to inner()
     where gaussian will be fitted.
 
-    :param out_key: current edge with (s, e)
+    :param out_key: current edge id (edge (s, e))
     :param inner_dict: dict of transects with:
     - inner_keys: pixel-coords of trough pixels (x, y)
     inbetween (s, e).
     - inner_values: list with transect coordinates
     and info on directionality/type
+    :param profile: bool; record a profile of each fit
+    :param seeds: dict with the screening result per
+    transect (see screen_transects())
     :return inner_dict: updated inner_dict with old
     inner_values + transect width, height, r2 in val
+    :return counts: Counter of the fit outcomes (the
+    workers can't update run_metrics of the main process)
+    :return records: list of fit profile records
+    (empty if profile is False)
     '''
+    counts = Counter()
+    records = [] if profile else None
     all_keys = []
     all_vals_upd = []
     # iterate through all transects of a trough
     for key, val in inner_dict.items():
         try:
             # fit gaussian to all transects
-            val_upd = inner(key, val, out_key)
+            val_upd = inner(key, val, out_key, counts, records, None if seeds is None else seeds.get(key))
             all_keys.append(key)
             all_vals_upd.append(val_upd)
         except ValueError as err:
-            print('{0} -- {1}'.format(out_key, err))
+            counts['value_error'] += 1
+            logger.debug('{0} -- {1}'.format(out_key, err))
     # recombine keys and vals to return the updated dict
     inner_dict = dict(zip(all_keys, all_vals_upd))
-    return inner_dict
+    return inner_dict, counts, records or []
+
+
+def screen_transects(dict_soil, min_amplitude=0.):
+    ''' screen all transects before fitting: for all
+    transects at once, compute the amplitude (depth)
+    and the moment-based sigma of the flipped height
+    profile. Transects that would be discarded after
+    fitting anyway (water-filled, flat, empty) are
+    marked to be skipped; the others get initial
+    guesses [amplitude, position of the minimum,
+    sigma] for the fit.
+
+    :param dict_soil: dictionary of transects
+    (see fit_gaussian_parallel())
+    :param min_amplitude: transects with a depth <= this
+    are considered flat [m]
+    :return seeds: dict with
+    - keys: edge id
+    - values: dict with pixel-coords of the trough
+    pixel as keys and (skip_reason, p0) as values,
+    skip_reason being 'water', 'flat', 'empty' or None
+    '''
+    seeds = {edge: {} for edge in dict_soil}
+    # group the transects by length to stack them into arrays
+    groups = {}
+    for edge, inner_dict in dict_soil.items():
+        for key, val in inner_dict.items():
+            if val[4]:
+                seeds[edge][key] = ('water', None)
+            elif len(val[0]) == 0:
+                seeds[edge][key] = ('empty', None)
+            else:
+                groups.setdefault(len(val[0]), []).append((edge, key, val))
+
+    for N, group in groups.items():
+        heights = np.stack([np.asarray(val[0], dtype=float) for (edge, key, val) in group])
+        # flip the transects along x-axis (like in inner())
+        data = heights.max(axis=1, keepdims=True) - heights
+        # diagonal transects are sqrt(2) times longer than straight transects
+        diagonal = np.array([val[2] == "diagonal" for (edge, key, val) in group])
+        t = np.where(diagonal[:, None], np.linspace(0, N * np.sqrt(2), N)[None, :],
+                     np.linspace(0, N - 1, N)[None, :])
+
+        amplitude = data.max(axis=1)
+        mean = t[np.arange(len(t)), data.argmax(axis=1)]
+        mass = data.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sigma = np.sqrt((data * (t - mean[:, None]) ** 2).sum(axis=1) / mass)
+        # keep the guesses within the bounds of the fit
+        sigma = np.clip(np.nan_to_num(sigma, nan=1.), 0.01, 8.5)
+        flat = amplitude <= min_amplitude
+
+        for i, (edge, key, val) in enumerate(group):
+            if flat[i]:
+                seeds[edge][key] = ('flat', None)
+            else:
+                seeds[edge][key] = (None, [amplitude[i], mean[i], sigma[i]])
+    return seeds
 
 
-def fit_gaussian_parallel(dict_soil):
+def fit_gaussian_parallel(dict_soil, n_jobs=20, profile=None, screen=True, min_amplitude=0.):
     '''iterate through edges of the graph (in dict
     form) and send each trough to a free CPU core
     --> prepare fitting a Gaussian function
@@ -163,7 +261,7 @@ def fit_gaussian_parallel(dict_soil):
     troughs can be distributed to multiple cores.
 
     :param dict_soil: a dictionary with
-    - outer_keys: edge (s, e) and
+    - outer_keys: edge id of the edge (s, e) and
     - outer_values: dict of transects
     with:
     - inner_keys: pixel-coords of trough pixels (x, y)
@@ -173,8 +271,18 @@ def fit_gaussian_parallel(dict_soil):
         - [1]: pixel coordinates of transect (xi, yi)
             --> len[1] == width*2 + 1
         - [2]: directionality of transect
-        - [3]: transect scenario (see publication)
+        - [3]: depends on the sampler: the transect scenario
+        (see publication) of get_transects(), the direction
+        of the trough in degrees of get_transects_interp()
         - [4]: presence of water
+    :param n_jobs: number of parallel jobs/CPU cores
+    :param profile: list; if given, it is extended
+    with one profile record per transect (see inner())
+    :param screen: skip transects that would be discarded
+    anyway (water-filled, flat) and seed the remaining
+    fits with data-driven guesses (see screen_transects())
+    :param min_amplitude: transects with a depth <= this
+    are considered flat when screening [m]
     :return dict_soil2: updated dict soil
     same as dict_soil with added:
     - inner_values:
@@ -182,23 +290,214 @@ def fit_gaussian_parallel(dict_soil):
         - val[6] = mean_gauss --> transect depth
         - val[7] = cod_gauss --> r2 of fit
     '''
+    from joblib import Parallel, delayed
     all_outer_keys = []
+    seeds = screen_transects(dict_soil, min_amplitude) if screen else {}
     # parallelize into n_jobs different jobs/CPU cores
-    out = Parallel(n_jobs=20)(delayed(outer)(out_key, inner_dict) for out_key, inner_dict in dict_soil.items())
+    out = Parallel(n_jobs=n_jobs)(delayed(outer)(out_key, inner_dict, profile is not None, seeds.get(out_key))
+                                  for out_key, inner_dict in dict_soil.items())
     # get all the outer_keys
     for out_key, inner_dict in dict_soil.items():
         all_outer_keys.append(out_key)
     # and recombine them with the updated inner_dict
-    dict_soil2 = dict(zip(all_outer_keys, out))
+    dict_soil2 = dict(zip(all_outer_keys, [inner_dict for inner_dict, counts, records in out]))
+    # gather the fit outcomes (and profiles) of all workers
+    for inner_dict, counts, records in out:
+        run_metrics.merge_counts('fit', counts)
+        if profile is not None:
+            profile.extend(records)
     return dict_soil2
 
 
+def fit_profiles_batched(dict_soil, models=('gauss', 'asym_gauss', 'lorentz', 'poly2'), criterion='aic',
+                         min_amplitude=0., chunk_size=20000):
+    ''' alternative to fit_gaussian_parallel(): fit
+    several trough profile models (see profile_models)
+    to all transects with batched, vectorized fitters
+    and keep the best model per transect by AIC/BIC.
+    Transects are screened like in fit_gaussian_parallel()
+    and processed in chunks of chunk_size to bound memory.
+
+    :param dict_soil: dictionary of transects
+    (see fit_gaussian_parallel())
+    :param models: names of the registered models to fit
+    :param criterion: 'aic' or 'bic' for the model selection
+    :param min_amplitude: transects with a depth <= this
+    are considered flat and skipped [m]
+    :param chunk_size: number of transects fitted at once
+    :return dict_soil2: updated dict soil, with the same
+    layout as from fit_gaussian_parallel() plus:
+    - inner_values:
+        - val[5] = width (fwhm) of the best model
+        - val[6] = depth of the best model
+        - val[7] = r2 of the best model
+        - val[8] = name of the best model
+    '''
+    seeds = screen_transects(dict_soil, min_amplitude)
+    dict_soil2 = {edge: {} for edge in dict_soil}
+    groups = {}
+    for edge, inner_dict in dict_soil.items():
+        for key, val in inner_dict.items():
+            skip_reason, p0 = seeds[edge][key]
+            if skip_reason is not None:
+                run_metrics.count('fit', 'screened_' + skip_reason)
+                dict_soil2[edge][key] = list(val[:5])
+            else:
+                groups.setdefault(len(val[0]), []).append((edge, key, val, p0))
+
+    for N, group in groups.items():
+        for c_start in range(0, len(group), chunk_size):
+            chunk = group[c_start:c_start + chunk_size]
+            heights = np.stack([np.asarray(val[0], dtype=float) for (edge, key, val, p0) in chunk])
+            # flip the transects along x-axis to be able to fit the profiles
+            data = heights.max(axis=1, keepdims=True) - heights
+            # diagonal transects are sqrt(2) times longer than straight transects
+            diagonal = np.array([val[2] == "diagonal" for (edge, key, val, p0) in chunk])
+            t = np.where(diagonal[:, None], np.linspace(0, N * np.sqrt(2), N)[None, :],
+                         np.linspace(0, N - 1, N)[None, :])
+            amplitude, mean, sigma = np.array([p0 for (edge, key, val, p0) in chunk]).T
+            sst = ((data - data.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+
+            best_ic = np.full(len(chunk), np.inf)
+            best_model = np.full(len(chunk), -1)
+            best = np.full((len(chunk), 3), np.nan)
+            for m, name in enumerate(models):
+                model = profile_models.MODELS[name]
+                p_init = model['init'](t, data, amplitude, mean, sigma)
+                p, sse, nit = profile_models.fit_batched(model['func'], t, data, p_init,
+                                                         model['lower'], model['upper'])
+                k = p.shape[1]
+                ic = profile_models.information_criterion(sse, N, k, criterion)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    r2 = 1 - sse / sst
+                width = model['width'](p)
+                depth = model['func'](t, p).max(axis=1)
+                # a model only counts if it describes a trough (finite, positive width)
+                better = (ic < best_ic) & np.isfinite(width) & (width > 0)
+                best_ic[better] = ic[better]
+                best_model[better] = m
+                best[better] = np.stack([width, depth, r2], axis=1)[better]
+
+            for i, (edge, key, val, p0) in enumerate(chunk):
+                if best_model[i] < 0:
+                    run_metrics.count('fit', 'fit_failed')
+                    dict_soil2[edge][key] = list(val[:5])
+                else:
+                    run_metrics.count('fit', 'model_' + models[best_model[i]])
+                    dict_soil2[edge][key] = list(val[:5]) + best[i].tolist() + [models[best_model[i]]]
+
+    # keep the order of the transects along the edges
+    for edge, inner_dict in dict_soil.items():
+        dict_soil2[edge] = {key: dict_soil2[edge][key] for key in inner_dict}
+    return dict_soil2
+
+
+def fit_profile_report(profile, wall_seconds=None, n_slowest=10, nfev_bins=20):
+    ''' aggregate the per-transect fit profile
+    records of fit_gaussian_parallel(profile=[...]).
+
+    :param profile: list of profile records
+    :param wall_seconds: wall time of the whole fitting
+    (to estimate the time spent outside of inner(),
+    e.g. for joblib scheduling and serialization)
+    :param n_slowest: number of slowest edges to report
+    :param nfev_bins: number of bins of the nfev histogram
+    :return report: dict with the number of transects,
+    outcomes, failure reasons, time split, nfev
+    percentiles and histogram, and the slowest edges
+    '''
+    report = {'num_transects': len(profile)}
+    if not profile:
+        return report
+    nfev = np.array([rec['nfev'] for rec in profile])
+    fit_seconds = np.array([rec['fit_seconds'] for rec in profile])
+    r2_seconds = np.array([rec['r2_seconds'] for rec in profile])
+    total_seconds = np.array([rec['total_seconds'] for rec in profile])
+
+    report['status'] = dict(Counter(rec['status'] for rec in profile))
+    report['reasons'] = dict(Counter(rec['reason'] for rec in profile if rec['reason']))
+    report['seconds'] = {'curve_fit': fit_seconds.sum(),
+                         'r2_score': r2_seconds.sum(),
+                         'other_inner': (total_seconds - fit_seconds - r2_seconds).sum(),
+                         'total_inner': total_seconds.sum()}
+    if wall_seconds is not None:
+        report['seconds']['wall'] = wall_seconds
+    report['nfev_percentiles'] = dict(zip([50, 90, 99, 100], np.percentile(nfev, [50, 90, 99, 100])))
+    hist, bin_edges = np.histogram(nfev, bins=nfev_bins)
+    report['nfev_hist'] = (hist.tolist(), bin_edges.tolist())
+
+    # sum up the fit times per edge
+    edge_seconds = Counter()
+    edge_transects = Counter()
+    edge_nfev = Counter()
+    for rec in profile:
+        edge_seconds[rec['edge']] += rec['total_seconds']
+        edge_transects[rec['edge']] += 1
+        edge_nfev[rec['edge']] += rec['nfev']
+    report['slowest_edges'] = [(edge, secs, edge_transects[edge], edge_nfev[edge] / edge_transects[edge])
+                               for edge, secs in edge_seconds.most_common(n_slowest)]
+    return report
+
+
+def print_fit_profile_report(report):
+    ''' print the report of fit_profile_report() '''
+    print("fitted transects: {}".format(report['num_transects']))
+    if report['num_transects'] == 0:
+        return
+    print("outcomes: {}".format(report['status']))
+    for reason, n in report['reasons'].items():
+        print("\t{0}x {1}".format(n, reason))
+    print("time [s]: " + ", ".join("{0}: {1:.2f}".format(k, v) for k, v in report['seconds'].items()))
+    print("nfev percentiles: " + ", ".join("p{0}: {1:.0f}".format(k, v) for k, v in report['nfev_percentiles'].items()))
+    hist, bin_edges = report['nfev_hist']
+    for n, lo, hi in zip(hist, bin_edges[:-1], bin_edges[1:]):
+        print("\tnfev {0:7.0f} - {1:7.0f}: {2}".format(lo, hi, n))
+    print("slowest edges (edge, seconds, transects, mean nfev):")
+    for edge, secs, num, mean_nfev in report['slowest_edges']:
+        print("\t{0}: {1:.3f} s, {2} transects, {3:.0f} nfev".format(edge, secs, num, mean_nfev))
+
+
 def save_obj(obj, name):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
 
 
-def get_trough_avgs_gauss(transect_dict_fitted):
+def transect_weights(coords):
+    ''' length of trough each transect of an
+    edge represents: half the distance to the
+    previous plus half the distance to the next
+    transect center (for decimated transects).
+
+    :param coords: pixel coords of the transect
+    centers of one edge, in order along the edge
+    :return weights: np.array with one weight per
+    transect [m]
+    '''
+    centers = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(centers) < 2:
+        return np.ones(len(centers))
+    steps = np.hypot(*np.diff(centers, axis=0).T)
+    weights = np.zeros(len(centers))
+    weights[:-1] += steps / 2
+    weights[1:] += steps / 2
+    # the first and last transect represent half a step to the edge end as well
+    weights[0] += steps[0] / 2
+    weights[-1] += steps[-1] / 2
+    return weights
+
+
+def weighted_median(values, weights):
+    ''' median of values where each value
+    counts with its weight '''
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.nan
+    order = np.argsort(values)
+    cum_weights = np.cumsum(np.asarray(weights)[order])
+    return values[order][np.searchsorted(cum_weights, cum_weights[-1] / 2)]
+
+
+def get_trough_avgs_gauss(transect_dict_fitted, weighted=False):
     ''' gather all width/depth/r2 parameters of
     each transect and compute mean/median
     parameter per trough. Add mean/median per
@@ -207,6 +506,11 @@ def get_trough_avgs_gauss(transect_dict_fitted):
     later network_analysis(.py).
 
     :param transect_dict_fitted:
+    :param weighted: weight every transect by the
+    length of trough it represents (see
+    transect_weights()). Use for transects
+    extracted with a stride/spacing, where the
+    remaining transects are not equally spaced.
     :return mean_trough_params: a copy of the
     transect_dict_fitted with added mean trough
     parameters to the outer dict as values.
@@ -219,12 +523,17 @@ def get_trough_avgs_gauss(transect_dict_fitted):
         gaus_width_sum = []
         gaus_depth_sum = []
         gaus_r2_sum = []
+        gaus_weights = []
         num_trans_cons = 0
         water = 0
         # check if an edge/trough is empty
         if trough != {}:
+            if weighted:
+                weights = transect_weights(list(trough.keys()))
+            else:
+                weights = np.ones(num_trans_tot)
             # then iterate through all transects of the current edge/trough
-            for coords, trans in trough.items():
+            for (coords, trans), weight in zip(trough.items(), weights):
                 # filter out all transects that:
                     # a) are not between 0 m and 15 m in width (unrealistic values)
                     # b) have been fitted with r2 <= 0.8
@@ -233,26 +542,41 @@ def get_trough_avgs_gauss(transect_dict_fitted):
                     pass
                 # now count number of water-filled transects per trough
                 elif trans[4]:
-                    water += 1
+                    water += weight
+                    run_metrics.count('avg', 'water_filled')
+                # transects whose fit failed don't have parameters
+                elif len(trans) < 8:
+                    run_metrics.count('avg', 'unfitted')
                 # pass
-                elif len(trans[0]) != 0 and 0 < trans[5] < 15 and trans[7] > 0.8 and not trans[4]:
+                elif is_good_transect(trans):
                     # append the parameters from "good" transects to the lists
                     gaus_width_sum.append(trans[5])
                     gaus_depth_sum.append(trans[6])
                     gaus_r2_sum.append(trans[7])
-                    num_trans_cons += 1
-
+                    gaus_weights.append(weight)
+                    num_trans_cons += weight
 
             # to then calculate the mean/median for each parameter
-            gaus_mean_width = np.mean(gaus_width_sum)
-            gaus_median_width = np.median(gaus_width_sum)
-            gaus_mean_depth = np.mean(gaus_depth_sum)
-            gaus_median_depth = np.median(gaus_depth_sum)
-            gaus_mean_r2 = np.mean(gaus_r2_sum)
-            gaus_median_r2 = np.median(gaus_r2_sum)
+            if weighted:
+                if gaus_weights:
+                    gaus_mean_width = np.average(gaus_width_sum, weights=gaus_weights)
+                    gaus_mean_depth = np.average(gaus_depth_sum, weights=gaus_weights)
+                    gaus_mean_r2 = np.average(gaus_r2_sum, weights=gaus_weights)
+                else:
+                    gaus_mean_width = gaus_mean_depth = gaus_mean_r2 = np.nan
+                gaus_median_width = weighted_median(gaus_width_sum, gaus_weights)
+                gaus_median_depth = weighted_median(gaus_depth_sum, gaus_weights)
+                gaus_median_r2 = weighted_median(gaus_r2_sum, gaus_weights)
+            else:
+                gaus_mean_width = np.mean(gaus_width_sum)
+                gaus_median_width = np.median(gaus_width_sum)
+                gaus_mean_depth = np.mean(gaus_depth_sum)
+                gaus_median_depth = np.median(gaus_depth_sum)
+                gaus_mean_r2 = np.mean(gaus_r2_sum)
+                gaus_median_r2 = np.median(gaus_r2_sum)
             # ratio of "good" transects considered for mean/median params compared to all transects available
-            perc_trans_cons = np.round(num_trans_cons/num_trans_tot, 2)
-            perc_water_fill = np.round(water/len(trough), 2)
+            perc_trans_cons = np.round(num_trans_cons/np.sum(weights), 2)
+            perc_water_fill = np.round(water/np.sum(weights), 2)
             # add all the mean/median parameters to the inner_dict
             mean_trough_params[edge] = [gaus_mean_width, gaus_median_width,
                                         gaus_mean_depth, gaus_median_depth,
@@ -261,11 +585,118 @@ def get_trough_avgs_gauss(transect_dict_fitted):
         # and if the trough is empty, append the edge to the list of empty edges
         else:
             empty_edges.append(edge)
+            run_metrics.count('avg', 'empty_edges')
             # print(transect_dict_fitted[edge])
     # print('empty edges ({0} in total): {1}'.format(len(empty_edges), empty_edges))
     return mean_trough_params
 
 
+def is_fitted(trans):
+    ''' check if a transect has fitted parameters
+    (width, depth, r2 at [5:8]); screened transects
+    and failed fits keep only the 5 transect values '''
+    return isinstance(trans, list) and len(trans) >= 8
+
+
+def is_good_transect(trans):
+    ''' check if a fitted transect is considered
+    for the per-trough parameters: not water-filled,
+    fitted, 0 m < width < 15 m and r2 > 0.8 '''
+    return (is_fitted(trans) and not trans[4] and len(trans[0]) != 0
+            and 0 < trans[5] < 15 and trans[7] > 0.8)
+
+
+def _bootstrap_chunk(values, counts, n_boot, ci, seed):
+    ''' bootstrap the per-edge means for a chunk of
+    edges at once.
+
+    :param values: np.array (num_transects, 3) of width,
+    depth and r2 of the good transects, sorted by edge
+    :param counts: number of good transects per edge
+    (all > 0)
+    :param n_boot: number of bootstrap resamples
+    :param ci: confidence level in percent
+    :param seed: seed of the random generator
+    :return bounds: np.array (num_edges, 3, 2) with the
+    lower/upper bound per edge and parameter
+    '''
+    rng = np.random.default_rng(seed)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    group_start = np.repeat(starts, counts)
+    group_size = np.repeat(counts, counts)
+    # resample within each edge: index = start of the edge + random offset < size of the edge
+    idx = group_start[None, :] + (rng.random((n_boot, len(group_start))) * group_size[None, :]).astype(np.int64)
+    # sum the resampled values per edge for all resamples at once --> (n_boot, num_edges, 3)
+    sums = np.add.reduceat(values[idx], starts, axis=1)
+    means = sums / counts[None, :, None]
+    alpha = (100 - ci) / 2
+    bounds = np.percentile(means, [alpha, 100 - alpha], axis=0)
+    return np.moveaxis(bounds, 0, -1)
+
+
+def get_trough_bootstrap_ci(transect_dict_fitted, n_boot=1000, ci=95, chunk_size=5000, n_jobs=1, seed=0):
+    ''' bootstrap confidence intervals of the mean
+    width, depth and r2 per trough, from the same
+    transects as get_trough_avgs_gauss() uses. All
+    edges of a chunk are resampled simultaneously
+    with grouped index arrays; the chunks are
+    distributed to n_jobs CPU cores.
+
+    :param transect_dict_fitted: fitted transect dict
+    :param n_boot: number of bootstrap resamples
+    :param ci: confidence level in percent
+    :param chunk_size: approx. number of transects per chunk
+    :param n_jobs: number of parallel jobs/CPU cores
+    :param seed: seed of the random generator
+    :return ci_dict: dictionary with
+    - key: edge id and
+    - value: list with
+        - lower/upper bound of mean width [m]
+        - lower/upper bound of mean depth [m]
+        - lower/upper bound of mean r2
+    (nan for troughs without any considered transects)
+    '''
+    from joblib import Parallel, delayed
+    edges = []
+    counts = []
+    values = []
+    for edge, trough in transect_dict_fitted.items():
+        good = [trans[5:8] for trans in trough.values() if is_good_transect(trans)]
+        if good:
+            edges.append(edge)
+            counts.append(len(good))
+            values.extend(good)
+    ci_dict = {edge: [np.nan] * 6 for edge in transect_dict_fitted}
+    if not edges:
+        return ci_dict
+    counts = np.array(counts)
+    values = np.array(values, dtype=float)
+
+    # split the edges into chunks of about chunk_size transects
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    chunk_ids = offsets[:-1] // chunk_size
+    chunks = []
+    for c in np.unique(chunk_ids):
+        sel = np.nonzero(chunk_ids == c)[0]
+        chunks.append((sel, values[offsets[sel[0]]:offsets[sel[-1] + 1]], counts[sel]))
+    out = Parallel(n_jobs=n_jobs)(delayed(_bootstrap_chunk)(chunk_values, chunk_counts, n_boot, ci, seed + i)
+                                  for i, (sel, chunk_values, chunk_counts) in enumerate(chunks))
+    for (sel, chunk_values, chunk_counts), bounds in zip(chunks, out):
+        for j, e in enumerate(sel):
+            ci_dict[edges[e]] = bounds[j].ravel().tolist()
+    return ci_dict
+
+
+def add_bootstrap_ci(edge_param_dict, ci_dict):
+    ''' append the bootstrap confidence intervals to
+    the eight-value records of get_trough_avgs_gauss():
+    values [8:14] are the lower/upper bounds of mean
+    width, mean depth and mean r2. '''
+    for edge, params in edge_param_dict.items():
+        edge_param_dict[edge] = list(params[:8]) + list(ci_dict.get(edge, [np.nan] * 6))
+    return edge_param_dict
+
+
 def plot_param_hists_box_width(transect_dict_orig_fitted_09, transect_dict_orig_fitted_19):
     ''' plot and save histogram and boxplot
     of all transect widths distribution for
@@ -278,13 +709,14 @@ def plot_param_hists_box_width(transect_dict_orig_fitted_09, transect_dict_orig_
     dictionary of 2019 situation
     :return: plot with hist and boxplot
     '''
+    import matplotlib.pyplot as plt
     all_widths_09 = []
     hi_widths_09 = []
 
     for edge, inner_dic in transect_dict_orig_fitted_09.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_widths_09.append(np.abs(trans_info[5]))
                 if trans_info[7] > 0.8:
                     hi_widths_09.append(np.abs(trans_info[5]))
@@ -295,7 +727,7 @@ def plot_param_hists_box_width(transect_dict_orig_fitted_09, transect_dict_orig_
     for edge, inner_dic in transect_dict_orig_fitted_19.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_widths_19.append(np.abs(trans_info[5]))
                 if trans_info[7] > 0.8:
                     hi_widths_19.append(np.abs(trans_info[5]))
@@ -410,13 +842,14 @@ def plot_param_hists_box_depth(transect_dict_orig_fitted_09, transect_dict_orig_
     dictionary of 2019 situation
     :return: plot with hist and boxplot
     '''
+    import matplotlib.pyplot as plt
     all_depths_09 = []
     hi_depths_09 = []
 
     for edge, inner_dic in transect_dict_orig_fitted_09.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_depths_09.append(trans_info[6])
                 if trans_info[7] > 0.8:
                     hi_depths_09.append(trans_info[6])
@@ -427,7 +860,7 @@ def plot_param_hists_box_depth(transect_dict_orig_fitted_09, transect_dict_orig_
     for edge, inner_dic in transect_dict_orig_fitted_19.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_depths_19.append(trans_info[6])
                 if trans_info[7] > 0.8:
                     hi_depths_19.append(trans_info[6])
@@ -547,6 +980,7 @@ def plot_param_hists_box_cod(transect_dict_orig_fitted_09, transect_dict_orig_fi
     dictionary of 2019 situation
     :return: plot with hist and boxplot
     '''
+    import matplotlib.pyplot as plt
     all_cods_09 = []
     hi_cods_09 = []
     cod_neg_09 = 0
@@ -554,11 +988,14 @@ def plot_param_hists_box_cod(transect_dict_orig_fitted_09, transect_dict_orig_fi
 
     for edge, inner_dic in transect_dict_orig_fitted_09.items():
         for skel_pix, trans_info in inner_dic.items():
+            # transects without a fit have no r2
+            if not is_fitted(trans_info):
+                continue
             if trans_info[7] < 0:
                 cod_neg_09 += 1
             else:
                 cod_pos_09 += 1
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_cods_09.append(trans_info[7])
                 if trans_info[7] > 0.8:
                     hi_cods_09.append(trans_info[7])
@@ -572,12 +1009,15 @@ def plot_param_hists_box_cod(transect_dict_orig_fitted_09, transect_dict_orig_fi
 
     for edge, inner_dic in transect_dict_orig_fitted_19.items():
         for skel_pix, trans_info in inner_dic.items():
+            # transects without a fit have no r2
+            if not is_fitted(trans_info):
+                continue
             if trans_info[7] < 0:
                 cod_neg_19 += 1
             else:
                 cod_pos_19 += 1
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_cods_19.append(trans_info[7])
                 if trans_info[7] > 0.8:
                     hi_cods_19.append(trans_info[7])
@@ -698,13 +1138,14 @@ def plot_legend(transect_dict_orig_fitted_09, transect_dict_orig_fitted_19):
     dictionary of 2019 situation
     :return: plot with hist and boxplot
     '''
+    import matplotlib.pyplot as plt
     all_depths_09 = []
     hi_depths_09 = []
 
     for edge, inner_dic in transect_dict_orig_fitted_09.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_depths_09.append(trans_info[6])
                 if trans_info[7] > 0.8:
                     hi_depths_09.append(trans_info[6])
@@ -715,7 +1156,7 @@ def plot_legend(transect_dict_orig_fitted_09, transect_dict_orig_fitted_19):
     for edge, inner_dic in transect_dict_orig_fitted_19.items():
         for skel_pix, trans_info in inner_dic.items():
             # print(trans_info)
-            if -30 < trans_info[5] < 30:
+            if is_fitted(trans_info) and -30 < trans_info[5] < 30:
                 all_depths_19.append(trans_info[6])
                 if trans_info[7] > 0.8:
                     hi_depths_19.append(trans_info[6])
@@ -800,32 +1241,128 @@ def plot_legend(transect_dict_orig_fitted_09, transect_dict_orig_fitted_19):
     plt.savefig('./figures/legend.png')
 
 
-def do_analysis(fit_gaussian=True):
+def update_fitted(transect_dict_fitted, transect_dict, delta):
+    ''' patch a previously fitted transect dict
+    with the delta of an incremental transect
+    extraction: only the updated edges are fitted,
+    removed edges are dropped. transect_dict_fitted
+    is patched in place.
+
+    :param transect_dict_fitted: fitted transect dict
+    of the previous run
+    :param transect_dict: (patched) transect dict of
+    the current run
+    :param delta: dict with lists of 'updated',
+    'removed' and 'kept' edges (see b_extract_trough_transects.update_transects)
+    :return transect_dict_fitted: the patched dict
+    '''
+    from b_extract_trough_transects import apply_delta
+    # the unchanged edges keep their fits under their new edge ids
+    apply_delta(transect_dict_fitted, delta)
+    dict_delta = {edge: transect_dict[edge] for edge in delta['updated']}
+    if dict_delta:
+        transect_dict_fitted.update(fit_gaussian_parallel(dict_delta))
+    return transect_dict_fitted
+
+
+def update_trough_avgs(edge_param_dict, transect_dict_fitted, delta, weighted=False):
+    ''' patch the per-trough mean/median
+    parameters for the edges of a delta only.
+    edge_param_dict is patched in place.
+    '''
+    from b_extract_trough_transects import apply_delta
+    apply_delta(edge_param_dict, delta)
+    edge_param_dict.update(get_trough_avgs_gauss({edge: transect_dict_fitted[edge] for edge in delta['updated']},
+                                                weighted=weighted))
+    return edge_param_dict
+
+
+def update_analysis(year, weighted=False):
+    ''' fit and average only the transects of
+    edges that changed since the last run (as
+    saved by b_extract_trough_transects.do_analysis
+    with a previous edgelist) and patch the stored
+    fitted and averaged dicts.
+    '''
+    if year == 2009:
+        loc = './data/a_2009/arf_transect_{0}_2009'
+    elif year == 2019:
+        loc = './data/b_2019/arf_transect_{0}_2019'
+    else:
+        print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
+        return None, None
+
+    delta = load_obj(loc.format('delta'))
+    transect_dict = load_obj(loc.format('dict'))
+    transect_dict_fitted = update_fitted(load_obj(loc.format('dict_fitted')), transect_dict, delta)
+    save_obj(transect_dict_fitted, loc.format('dict_fitted'))
+    edge_param_dict = update_trough_avgs(load_obj(loc.format('dict_avg')), transect_dict_fitted, delta, weighted)
+    save_obj(edge_param_dict, loc.format('dict_avg'))
+    return transect_dict_fitted, edge_param_dict
+
+
+def do_analysis(fit_gaussian=True, incremental=False, weighted=False, profile=False, models=None, bootstrap=False):
+    if incremental:
+        transect_dict_fitted_09, edge_param_dict_09 = update_analysis(2009, weighted)
+        transect_dict_fitted_19, edge_param_dict_19 = update_analysis(2019, weighted)
+        return transect_dict_fitted_09, transect_dict_fitted_19, edge_param_dict_09, edge_param_dict_19
+
     # 2009
     if fit_gaussian:
         transect_dict_09 = load_obj('./data/a_2009/arf_transect_dict_2009')
 
-        transect_dict_fitted_09 = fit_gaussian_parallel(transect_dict_09)
+        fit_profile_09 = [] if profile else None
+        fit_start = time.perf_counter()
+        with run_metrics.stage_timer('fit'):
+            if models:
+                transect_dict_fitted_09 = fit_profiles_batched(transect_dict_09, models)
+            else:
+                transect_dict_fitted_09 = fit_gaussian_parallel(transect_dict_09, profile=fit_profile_09)
+        if profile and not models:
+            save_obj(fit_profile_09, './data/a_2009/arf_fit_profile_2009')
+            print_fit_profile_report(fit_profile_report(fit_profile_09, time.perf_counter() - fit_start))
         # save_obj(transect_dict_fitted_09, './data/a_2009/arf_transect_dict_fitted_2009')
-
-    transect_dict_fitted_09 = load_obj('./data/a_2009/arf_transect_dict_fitted_2009')
-    edge_param_dict_09 = get_trough_avgs_gauss(transect_dict_fitted_09)
+    else:
+        # without fitting, average the stored fits
+        transect_dict_fitted_09 = load_obj('./data/a_2009/arf_transect_dict_fitted_2009')
+
+    with run_metrics.stage_timer('avg'):
+        edge_param_dict_09 = get_trough_avgs_gauss(transect_dict_fitted_09, weighted)
+    if bootstrap:
+        with run_metrics.stage_timer('bootstrap'):
+            add_bootstrap_ci(edge_param_dict_09, get_trough_bootstrap_ci(transect_dict_fitted_09, n_jobs=-1))
     save_obj(edge_param_dict_09, './data/a_2009/arf_transect_dict_avg_2009')
 
     # 2019
     if fit_gaussian:
         transect_dict_19 = load_obj('./data/b_2019/arf_transect_dict_2019')
-        transect_dict_fitted_19 = fit_gaussian_parallel(transect_dict_19)
+        fit_profile_19 = [] if profile else None
+        fit_start = time.perf_counter()
+        with run_metrics.stage_timer('fit'):
+            if models:
+                transect_dict_fitted_19 = fit_profiles_batched(transect_dict_19, models)
+            else:
+                transect_dict_fitted_19 = fit_gaussian_parallel(transect_dict_19, profile=fit_profile_19)
+        if profile and not models:
+            save_obj(fit_profile_19, './data/b_2019/arf_fit_profile_2019')
+            print_fit_profile_report(fit_profile_report(fit_profile_19, time.perf_counter() - fit_start))
         # save_obj(transect_dict_fitted_19, './data/b_2019/arf_transect_dict_fitted_2019')
-
-    transect_dict_fitted_19 = load_obj('./data/b_2019/arf_transect_dict_fitted_2019')
-    edge_param_dict_19 = get_trough_avgs_gauss(transect_dict_fitted_19)
+    else:
+        # without fitting, average the stored fits
+        transect_dict_fitted_19 = load_obj('./data/b_2019/arf_transect_dict_fitted_2019')
+
+    with run_metrics.stage_timer('avg'):
+        edge_param_dict_19 = get_trough_avgs_gauss(transect_dict_fitted_19, weighted)
+    if bootstrap:
+        with run_metrics.stage_timer('bootstrap'):
+            add_bootstrap_ci(edge_param_dict_19, get_trough_bootstrap_ci(transect_dict_fitted_19, n_jobs=-1))
     save_obj(edge_param_dict_19, './data/b_2019/arf_transect_dict_avg_2019')
 
     return transect_dict_fitted_09, transect_dict_fitted_19, edge_param_dict_09, edge_param_dict_19
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
     transect_dict_fitted_09, transect_dict_fitted_19, edge_param_dict_09, edge_param_dict_19 = do_analysis(True)
 
     # plot_param_hists_box_width(transect_dict_fitted_09, transect_dict_fitted_19)
@@ -833,6 +1370,8 @@ if __name__ == '__main__':
     # plot_param_hists_box_cod(transect_dict_fitted_09, transect_dict_fitted_19)
     # plot_legend(transect_dict_fitted_09, transect_dict_fitted_19)
 
+    run_metrics.print_summary()
+    run_metrics.save_summary('./data/run_summary_transect_analysis.json')
     print(datetime.now() - startTime)
 
     # plt.show()
@@ -1,25 +1,60 @@
+import os
 import pickle
+import hashlib
+from dataclasses import dataclass, fields
+from typing import Optional
 import numpy as np
 import networkx as nx
-import matplotlib.pyplot as plt
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 from collections import Counter, OrderedDict
 from b_extract_trough_transects import read_graph
 from datetime import datetime
+import logging
+import run_metrics
+
+logger = logging.getLogger(__name__)
 
 def load_obj(name):
     with open(name + '.pkl', 'rb') as f:
         return pickle.load(f)
 
 
+# the per-trough parameters of get_trough_avgs_gauss (+ bootstrap bounds), in order
+EDGE_PARAMS = ('mean_width', 'median_width', 'mean_depth', 'median_depth', 'mean_r2', 'median_r2',
+               'considered_trans', 'water_filled',
+               'mean_width_ci_low', 'mean_width_ci_high', 'mean_depth_ci_low', 'mean_depth_ci_high',
+               'mean_r2_ci_low', 'mean_r2_ci_high')
+
+
+def edge_param_array(edge_param_dict, num_edges):
+    ''' the per-trough parameters as array, indexed
+    by edge id
+
+    :param edge_param_dict: dictionary edge id --> list
+    of parameters (see add_params_graph())
+    :param num_edges: number of edge ids of the graph
+    :return params: np.array (num_edges, len(EDGE_PARAMS));
+    nan for the troughs without parameters
+    '''
+    params = np.full((num_edges, len(EDGE_PARAMS)), np.nan)
+    for eid, values in edge_param_dict.items():
+        if 0 <= eid < num_edges:
+            values = values[:len(EDGE_PARAMS)]
+            params[eid, :len(values)] = values
+    return params
+
+
 def add_params_graph(G, edge_param_dict):
     ''' take entire transect dictionary and
     the original graph G and add the mean/median
     parameter values to the graph edges.
 
     :param G: trough network graph created
-    from skeleton
+    from skeleton, with edge ids 'eid'
     :param edge_param_dict: dictionary with
-    - key: edge (s, e) and
+    - key: edge id (or edge (s, e), if saved
+    before the edges were numbered) and
     - value: list with
         - mean width [m]
         - median width [m]
@@ -29,29 +64,31 @@ def add_params_graph(G, edge_param_dict):
         - median r2
         - ratio of considered transects/trough
         - ratio of water-filled troughs
-    :return : graph with added edge_param_dict
-    parameters added as edge weights.
+        - optional: lower/upper bootstrap bounds of
+        mean width, mean depth and mean r2
+    :return params: np.array of the parameters
+    per edge id (see edge_param_array()); the
+    parameters are added as edge attributes.
+    Troughs without any transect (shorter than
+    3 pixels or at the image border) have no
+    averages and get nan.
     '''
-    num_emp = 0
-    num_full = 0
-
-    # iterate through all graph edges
-    for (s, e) in G.edges():
-        # and retrieve information on the corresponding edges from the dictionary
-        if (s, e) in edge_param_dict:  # TODO: apparently some (xx) edges aren't in the edge_param_dict. check out why
-            G[s][e]['mean_width'] = edge_param_dict[(s, e)][0]
-            G[s][e]['median_width'] = edge_param_dict[(s, e)][1]
-            G[s][e]['mean_depth'] = edge_param_dict[(s, e)][2]
-            G[s][e]['median_depth'] = edge_param_dict[(s, e)][3]
-            G[s][e]['mean_r2'] = edge_param_dict[(s, e)][4]
-            G[s][e]['median_r2'] = edge_param_dict[(s, e)][5]
-            G[s][e]['considered_trans'] = edge_param_dict[(s, e)][6]
-            G[s][e]['water_filled'] = edge_param_dict[(s, e)][7]
-            num_full += 1
-        else:
-            print("{} doesn't exist in the edge_param_dict, but only in the Graph.".format(str((s, e))))
-            num_emp += 1
-    print(num_emp, num_full)
+    from b_extract_trough_transects import key_by_edge_id
+    edge_param_dict = key_by_edge_id(edge_param_dict, G)
+    num_edges = max((eid + 1 for (s, e, eid) in G.edges(data='eid')), default=0)
+    params = edge_param_array(edge_param_dict, num_edges)
+    # the bootstrap bounds only if they were computed
+    has_ci = any(len(values) >= len(EDGE_PARAMS) for values in edge_param_dict.values())
+    names = EDGE_PARAMS if has_ci else EDGE_PARAMS[:8]
+    # iterate through all graph edges and look up their parameters by edge id
+    for (s, e, eid) in G.edges(data='eid'):
+        G[s][e].update(zip(names, params[eid].tolist()))
+    matched = int((~np.isnan(params[:, 6])).sum())
+    run_metrics.count('network', 'matched_edges', matched)
+    if matched < G.number_of_edges():
+        logger.debug("{} troughs have no transects and get nan parameters.".format(G.number_of_edges() - matched))
+        run_metrics.count('network', 'unmatched_edges', G.number_of_edges() - matched)
+    return params
 
 
 def sink_source_analysis(graph):
@@ -126,6 +163,18 @@ def network_density(graph):
     print(f"Absolute network density is: \n\t{dens}")
 
 
+def betweenness_stats(graph):
+    ''' mean, min and max of the (normalized,
+    length-weighted) betweenness centrality of
+    all nodes.
+
+    :param graph: an nx.DiGraph
+    :return stats: dict with 'mean', 'min', 'max'
+    '''
+    bet_cent = np.array(list(nx.betweenness_centrality(graph, normalized=True, weight='weight').values()))
+    return {'mean': float(np.mean(bet_cent)), 'min': float(np.min(bet_cent)), 'max': float(np.max(bet_cent))}
+
+
 def betweenness_centrality(graph):
     '''calculate average betweenness centrality
     for all edges.
@@ -134,9 +183,58 @@ def betweenness_centrality(graph):
     :return null: only prints average
     betweenness centrality.
     '''
-    bet_cent = nx.betweenness_centrality(graph, normalized=True, weight='weight')
-    print(f"Average betweenness centrality is: \n\t{np.mean(list(bet_cent.values()))}\n "
-          f"min: {np.min(list(bet_cent.values()))}; max: {np.max(list(bet_cent.values()))}")
+    stats = betweenness_stats(graph)
+    print(f"Average betweenness centrality is: \n\t{stats['mean']}\n "
+          f"min: {stats['min']}; max: {stats['max']}")
+
+
+def _shortest_path_lengths(graph):
+    ''' all non-zero shortest path lengths of a graph '''
+    short_path_length = []
+    for i in nx.shortest_path_length(graph, weight='weight'):
+        for key, val in i[1].items():
+            if val != 0:
+                short_path_length.append(val)
+    return short_path_length
+
+
+def shortest_path_stats_largest(graph):
+    ''' mean/median shortest path length and
+    diameter of the largest connected component.
+
+    :param graph: an nx.DiGraph
+    :return stats: dict with 'mean', 'median', 'diameter' [m]
+    '''
+    # Next, use nx.connected_components to get the list of components,
+    components = nx.connected_components(nx.to_undirected(graph))
+    # then use the max() command to find the largest one:
+    largest_component = max(components, key=len)
+    G_largest_sub = nx.subgraph(graph, largest_component)
+
+    short_path_length = _shortest_path_lengths(G_largest_sub)
+    return {'mean': float(np.mean(short_path_length)), 'median': float(np.median(short_path_length)),
+            'diameter': float(np.max(short_path_length))}
+
+
+def shortest_path_stats_components(graph):
+    ''' average shortest path length and diameter
+    of each connected component.
+
+    :param graph: an nx.DiGraph
+    :return stats: dict with lists 'avg_lengths' and
+    'diameters' [m] (nan for components without paths)
+    '''
+    avg_short_path_length = []
+    diameter = []
+    for c in nx.connected_components(nx.to_undirected(graph)):
+        short_path_length = _shortest_path_lengths(graph.subgraph(c))
+        if short_path_length:
+            avg_short_path_length.append(float(np.mean(short_path_length)))
+            diameter.append(float(np.max(short_path_length)))
+        else:
+            avg_short_path_length.append(np.nan)
+            diameter.append(np.nan)
+    return {'avg_lengths': avg_short_path_length, 'diameters': diameter}
 
 
 def shortest_path_lengths_connected(graph):
@@ -149,21 +247,10 @@ def shortest_path_lengths_connected(graph):
     length and the network diameter (longest shortest
     path length)
     '''
-    # Next, use nx.connected_components to get the list of components,
-    components = nx.connected_components(nx.to_undirected(graph))
-    # then use the max() command to find the largest one:
-    largest_component = max(components, key=len)
-    G_largest_sub = nx.subgraph(graph, largest_component)
-
-    short_path_length = []
-    for i in nx.shortest_path_length(G_largest_sub, weight='weight'):
-        for key, val in i[1].items():
-            if val != 0:
-                short_path_length.append(val)
-    mean = np.mean(short_path_length)
-    median = np.median(short_path_length)
-    print("The average shortest path length of the largest component is:\n\t{0} m (median: {1} m)".format(mean, median))
-    print("The diameter of the graph is:\n\t{} m".format(np.max(short_path_length)))
+    stats = shortest_path_stats_largest(graph)
+    print("The average shortest path length of the largest component is:\n\t{0} m (median: {1} m)".format(
+        stats['mean'], stats['median']))
+    print("The diameter of the graph is:\n\t{} m".format(stats['diameter']))
 
 
 def shortest_path_lengths_not_connected(graph):
@@ -177,17 +264,9 @@ def shortest_path_lengths_not_connected(graph):
     path length), and the number of connected
     components.
     '''
-    avg_short_path_length = []
-    diameter = []
-    for c in nx.connected_components(nx.to_undirected(graph)):
-        G_sub = graph.subgraph(c)
-        short_path_length = []
-        for i in nx.shortest_path_length(G_sub, weight='weight'):
-            for key, val in i[1].items():
-                if val != 0:
-                    short_path_length.append(val)
-        avg_short_path_length.append(np.mean(short_path_length))
-        diameter.append(np.max(short_path_length))
+    stats = shortest_path_stats_components(graph)
+    avg_short_path_length = stats['avg_lengths']
+    diameter = stats['diameters']
     print(f"Average shortest path lengths per component (median={np.median(avg_short_path_length)}):\n\t{sorted(avg_short_path_length, reverse=True)} m")
     print(f"Diameter of each connected component (median={np.median(diameter)}):\n\t{sorted(diameter, reverse=True)} m")
     print("Number of connected components in the graph:\n\t{}".format(len(avg_short_path_length)))
@@ -209,28 +288,569 @@ def get_total_channel_length(graph):
     print("The total length of all channels in the network of the study area is:\n\t{} m".format(round(total_length, 2)))
 
 
-def do_analysis(graph):
-    # general info on number of edges and nodes
-    print(nx.info(graph))
-    # get sinks and sources
-    sink_source_analysis(graph)
-    # number of connected components
-    connected_comp_analysis(graph)
-    # average shortest path lengths
-    # for all:
-    shortest_path_lengths_not_connected(graph)
-    # for largest component only:
-    shortest_path_lengths_connected(graph)
-    # betweenness centrality
-    betweenness_centrality(graph)
-    # network density
-    network_density(graph)
-    # length of all channels in the network
-    get_total_channel_length(graph)
+def graph_to_arrays(graph):
+    ''' convert a graph once to arrays for the
+    sparse network metrics.
+
+    :param graph: an nx.DiGraph with the length
+    of the troughs as edge weight 'weight'
+    :return arrays: dictionary with
+    - 'nodes': list of node ids (index = node index)
+    - 'src', 'dst': node indices of all edges
+    - 'weight': np.array of edge lengths
+    - 'adj': scipy.sparse.csr_matrix adjacency
+    with the edge lengths as values
+    '''
+    nodes = list(graph.nodes())
+    node_idx = {n: i for i, n in enumerate(nodes)}
+    num_edges = graph.number_of_edges()
+    src = np.empty(num_edges, dtype=np.int64)
+    dst = np.empty(num_edges, dtype=np.int64)
+    weight = np.empty(num_edges)
+    for i, (s, e, w) in enumerate(graph.edges(data='weight', default=0)):
+        src[i] = node_idx[s]
+        dst[i] = node_idx[e]
+        weight[i] = w
+    adj = scipy.sparse.csr_matrix((weight, (src, dst)), shape=(len(nodes), len(nodes)))
+    return {'nodes': nodes, 'src': src, 'dst': dst, 'weight': weight, 'adj': adj}
+
+
+def network_metrics(graph, arrays=None):
+    ''' compute the basic network metrics with array
+    operations on the sparse form of the graph.
+    Returns the same numbers as sink_source_analysis(),
+    connected_comp_analysis(), network_density() and
+    get_total_channel_length() print.
+
+    :param graph: an nx.DiGraph
+    :param arrays: result of graph_to_arrays(graph), if
+    already available
+    :return metrics: dictionary with
+    - 'num_nodes', 'num_edges'
+    - 'in_degree', 'out_degree', 'degree': np.arrays per node
+    - 'sources': nodes without incoming edges
+    - 'sinks': nodes with incoming, but without outgoing edges
+    - 'num_components': number of (weakly) connected components
+    - 'component_labels': component index per node
+    - 'component_sizes': Counter of the number of nodes
+    per component
+    - 'component_edges': number of (undirected) edges
+    per component
+    - 'e_pot', 'density': potential edges and network density
+    - 'total_length': total length of all channels [m]
+    '''
+    if arrays is None:
+        arrays = graph_to_arrays(graph)
+    num_nodes = len(arrays['nodes'])
+    src, dst = arrays['src'], arrays['dst']
+    num_edges = len(src)
+
+    in_degree = np.bincount(dst, minlength=num_nodes)
+    out_degree = np.bincount(src, minlength=num_nodes)
+    # a node is a source if nothing flows in, else a sink if nothing flows out
+    sources = int((in_degree == 0).sum())
+    sinks = int(((in_degree != 0) & (out_degree == 0)).sum())
+
+    num_components, labels = connected_components(arrays['adj'], directed=True, connection='weak')
+    node_size = np.bincount(labels, minlength=num_components)
+    # the undirected graph merges (s, e) and (e, s) to one edge
+    pairs = np.unique(np.stack([np.minimum(src, dst), np.maximum(src, dst)], axis=1), axis=0)
+    edge_size = np.bincount(labels[pairs[:, 0]], minlength=num_components) if len(pairs) else np.zeros(num_components)
+
+    e_pot = 3/2 * (num_nodes+1)
+    metrics = {'num_nodes': num_nodes,
+               'num_edges': num_edges,
+               'in_degree': in_degree,
+               'out_degree': out_degree,
+               'degree': in_degree + out_degree,
+               'sources': sources,
+               'sinks': sinks,
+               'num_components': int(num_components),
+               'component_labels': labels,
+               'component_sizes': Counter(node_size.tolist()),
+               'component_edges': edge_size.astype(int).tolist(),
+               'e_pot': e_pot,
+               'density': num_edges / e_pot,
+               'total_length': float(arrays['weight'].sum())}
+    return metrics
+
+
+def print_network_metrics(metrics):
+    ''' print the results of network_metrics() like
+    the individual analysis functions do '''
+    print("sources: {}".format(metrics['sources']))
+    print("sinks: {}".format(metrics['sinks']))
+    print(f'number of connected components is: {metrics["num_components"]}')
+    print(f'their sizes are: {metrics["component_sizes"]}')
+    print(f'they have {metrics["component_edges"]} edges')
+    print(f"num_nodes is: \n\t{metrics['num_nodes']}")
+    print(f"e_exist is: \n\t{metrics['num_edges']}")
+    print(f"e_pot is: \n\t{metrics['e_pot']}")
+    print(f"Absolute network density is: \n\t{metrics['density']}")
+    print("The total length of all channels in the network of the study area is:\n\t{} m".format(
+        round(metrics['total_length'], 2)))
+
+
+def _is_chain_node(graph, n):
+    ''' a node can be contracted if it only passes
+    flow through between its two neighbours: one
+    edge in and one out, or a flat trough in both
+    directions to both neighbours '''
+    pred, succ = set(graph.predecessors(n)), set(graph.successors(n))
+    if len(pred | succ) != 2:
+        return False
+    return (len(pred) == 1 and len(succ) == 1 and pred != succ) or (len(pred) == 2 and pred == succ)
+
+
+def _join_pts(segments):
+    ''' concatenate the pixels of consecutive edges.
+    The pixels of an edge aren't necessarily ordered
+    along the flow, so each segment is oriented to
+    continue where the previous one ended. '''
+    segments = [np.asarray(seg).reshape(-1, 2) for seg in segments]
+    if len(segments) > 1:
+        # orient the first segment towards the second one
+        first, second = segments[0], segments[1]
+        d_end = np.abs(first[-1] - second[[0, -1]]).sum(axis=1).min()
+        d_start = np.abs(first[0] - second[[0, -1]]).sum(axis=1).min()
+        if d_start < d_end:
+            segments[0] = first[::-1]
+    pts = [segments[0]]
+    for seg in segments[1:]:
+        if np.abs(pts[-1][-1] - seg[-1]).sum() < np.abs(pts[-1][-1] - seg[0]).sum():
+            seg = seg[::-1]
+        pts.append(seg)
+    return np.concatenate(pts).tolist()
+
+
+def condense_graph(graph):
+    ''' contract chains of degree-2 nodes (which only
+    split one physical trough into several edges) into
+    single edges, to shrink the graph before the
+    expensive network metrics.
+
+    Only nodes that pass the flow through are contracted
+    (see _is_chain_node), so sources, sinks and the flow
+    directions stay the same. A chain is not contracted
+    if its merged edge would duplicate an existing edge
+    (e.g. two troughs between the same junctions).
+
+    The merged edges get
+    - 'weight': the summed length of the chain
+    - 'pts': the concatenated pixels of the chain
+    - all other numeric attributes (e.g. from
+    add_params_graph) as length-weighted mean over the
+    edges of the chain that have them
+    - 'orig_edges': list of the original edges (s, e)
+
+    :param graph: an nx.DiGraph with the length
+    of the troughs as edge weight 'weight'
+    :return G_c: the condensed nx.DiGraph
+    :return edge_map: dictionary original edge (s, e)
+    --> edge of G_c it was merged into
+    '''
+    chain_nodes = {n for n in graph.nodes() if _is_chain_node(graph, n)}
+    undirected = graph.to_undirected(as_view=True)
+
+    # walk every chain once, from a kept node to the next kept node
+    chains = []
+    visited = set()
+
+    def walk(start, nxt):
+        seq = [start, nxt]
+        while seq[-1] in chain_nodes and seq[-1] != start:
+            visited.add(seq[-1])
+            seq.append(next(n for n in undirected.neighbors(seq[-1]) if n != seq[-2]))
+        return seq
+
+    kept = [n for n in graph.nodes() if n not in chain_nodes]
+    for n in kept:
+        for nb in undirected.neighbors(n):
+            if nb in chain_nodes and nb not in visited:
+                chains.append(walk(n, nb))
+    # closed rings of chain nodes: keep one node of each ring
+    for n in graph.nodes():
+        if n in chain_nodes and n not in visited:
+            visited.add(n)
+            chains.append(walk(n, next(iter(undirected.neighbors(n)))))
+
+    G_c = nx.DiGraph()
+    G_c.add_nodes_from(kept)
+    G_c.add_nodes_from((chain[0] for chain in chains))
+    edge_map = {}
+    for (s, e, data) in graph.edges(data=True):
+        if s not in chain_nodes and e not in chain_nodes:
+            G_c.add_edge(s, e, **data, orig_edges=[(s, e)])
+            edge_map[(s, e)] = (s, e)
+
+    for chain in chains:
+        start, end = chain[0], chain[-1]
+        directions = [seq for seq in (chain, chain[::-1])
+                      if all(graph.has_edge(a, b) for a, b in zip(seq[:-1], seq[1:]))]
+        if start == end or undirected.has_edge(start, end) or G_c.has_edge(start, end) \
+                or G_c.has_edge(end, start) or not directions:
+            # keep the chain as it is
+            for a, b in zip(chain[:-1], chain[1:]):
+                for (s, e) in ((a, b), (b, a)):
+                    if graph.has_edge(s, e):
+                        G_c.add_edge(s, e, **graph[s][e], orig_edges=[(s, e)])
+                        edge_map[(s, e)] = (s, e)
+            continue
+        for seq in directions:
+            orig_edges = list(zip(seq[:-1], seq[1:]))
+            lengths = np.array([graph[s][e].get('weight', 0) for (s, e) in orig_edges])
+            data = {'weight': float(lengths.sum()),
+                    'pts': _join_pts([graph[s][e]['pts'] for (s, e) in orig_edges])}
+            # (the edge ids of the chain aren't averaged, the merged edge has none)
+            keys = {k for (s, e) in orig_edges for k, v in graph[s][e].items()
+                    if k not in data and k != 'eid' and isinstance(v, (int, float)) and not isinstance(v, bool)}
+            for k in keys:
+                vals = np.array([graph[s][e].get(k, np.nan) for (s, e) in orig_edges], dtype=float)
+                valid = ~np.isnan(vals)
+                data[k] = float(np.average(vals[valid], weights=lengths[valid])) \
+                    if valid.any() and lengths[valid].sum() > 0 else np.nan
+            G_c.add_edge(seq[0], seq[-1], **data, orig_edges=orig_edges)
+            for edge in orig_edges:
+                edge_map[edge] = (seq[0], seq[-1])
+    return G_c, edge_map
+
+
+def _csr_gather(indptr, rows):
+    ''' indices of all entries of the given rows
+    of a csr-like index pointer '''
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum()) + offsets
+
+
+def flow_accumulation(graph, arrays=None):
+    ''' route flow through the directed trough network
+    (edges oriented downslope by make_directed) and
+    accumulate, for every node and edge, the upstream
+    contributing trough length and the number of
+    contributing sources.
+
+    Flat edges (elev_start == elev_end) exist in both
+    directions and form cycles, so strongly connected
+    components are condensed to one node first: all
+    their nodes share one accumulation, their internal
+    troughs count once to it. On the resulting DAG the
+    accumulation runs level by level in topological
+    order (each edge is visited once). Where the flow
+    splits, a node passes an equal share of its
+    accumulation to each outgoing edge, so the sinks
+    together receive the total trough length (on
+    branching networks lengths and source counts are
+    shares, on trees they are exact).
+
+    Every node is assigned to the drainage basin of
+    one sink, following the downstream neighbour with
+    the largest accumulation (the main stem).
+
+    :param graph: an nx.DiGraph with the length
+    of the troughs as edge weight 'weight'
+    :param arrays: result of graph_to_arrays(graph), if
+    already available
+    :return flow: dictionary with
+    - 'nodes': list of node ids (index = node index)
+    - 'node_length', 'node_sources': upstream contributing
+    length [m] and number of sources per node, incl. the
+    troughs of the node's flat component
+    - 'edge_length', 'edge_sources': the same per edge (in
+    the order of arrays['src'] / arrays['dst']), incl. the
+    edge itself
+    - 'basin': node index of the sink each node drains to
+    - 'basin_length': dictionary sink node id --> total
+    trough length of its basin [m]
+    '''
+    if arrays is None:
+        arrays = graph_to_arrays(graph)
+    num_nodes = len(arrays['nodes'])
+    src, dst, weight = arrays['src'], arrays['dst'], arrays['weight']
+
+    # condense the flat cycles: strongly connected components
+    num_comp, comp = connected_components(arrays['adj'], directed=True, connection='strong')
+    c_src, c_dst = comp[src], comp[dst]
+    internal = c_src == c_dst
+    # troughs within a component exist in both directions, count them once
+    pairs, first = np.unique(np.stack([np.minimum(src, dst), np.maximum(src, dst)], axis=1)[internal],
+                             axis=0, return_index=True)
+    own_length = np.bincount(comp[pairs[:, 0]], weights=weight[internal][first],
+                             minlength=num_comp) if len(pairs) else np.zeros(num_comp)
+
+    # edges of the condensed DAG, sorted by their upstream component
+    ext = np.nonzero(~internal)[0]
+    ext = ext[np.argsort(c_src[ext], kind='stable')]
+    e_src, e_dst, e_weight = c_src[ext], c_dst[ext], weight[ext]
+    indptr = np.searchsorted(e_src, np.arange(num_comp + 1))
+    out_degree = np.diff(indptr)
+    in_degree = np.bincount(e_dst, minlength=num_comp)
+
+    comp_length = np.zeros(num_comp)
+    comp_sources = np.zeros(num_comp)
+    e_length = np.zeros(len(ext))
+    e_sources = np.zeros(len(ext))
+    # components without inflow are the sources of the condensed DAG
+    comp_sources[in_degree == 0] = 1
+
+    # topological order, one level at a time
+    levels = []
+    remaining = in_degree.copy()
+    frontier = np.nonzero(remaining == 0)[0]
+    while len(frontier):
+        levels.append(frontier)
+        comp_length[frontier] += own_length[frontier]
+        idx = _csr_gather(indptr, frontier)
+        if len(idx) == 0:
+            break
+        share = 1 / out_degree[e_src[idx]]
+        e_length[idx] = comp_length[e_src[idx]] * share + e_weight[idx]
+        e_sources[idx] = comp_sources[e_src[idx]] * share
+        np.add.at(comp_length, e_dst[idx], e_length[idx])
+        np.add.at(comp_sources, e_dst[idx], e_sources[idx])
+        np.subtract.at(remaining, e_dst[idx], 1)
+        frontier = np.unique(e_dst[idx][remaining[e_dst[idx]] == 0])
+
+    # drainage basins, against the flow: follow the main stem down to a sink
+    sinks = np.nonzero(out_degree == 0)[0]
+    # representative (first) node of each component
+    comp_node = np.full(num_comp, num_nodes)
+    np.minimum.at(comp_node, comp, np.arange(num_nodes))
+    comp_basin = np.full(num_comp, -1)
+    comp_basin[sinks] = comp_node[sinks]
+    for frontier in reversed(levels):
+        frontier = frontier[out_degree[frontier] > 0]
+        idx = _csr_gather(indptr, frontier)
+        if len(idx) == 0:
+            continue
+        # per upstream component, the last edge after sorting by accumulation is the main stem
+        order = np.lexsort((comp_length[e_dst[idx]], e_src[idx]))
+        last = np.r_[e_src[idx][order][1:] != e_src[idx][order][:-1], True]
+        main = idx[order][last]
+        comp_basin[e_src[main]] = comp_basin[e_dst[main]]
+
+    edge_length = np.empty(len(src))
+    edge_sources = np.empty(len(src))
+    edge_length[ext] = e_length
+    edge_sources[ext] = e_sources
+    edge_length[internal] = comp_length[c_src[internal]]
+    edge_sources[internal] = comp_sources[c_src[internal]]
+
+    basin = comp_basin[comp]
+    basin_length = np.bincount(comp_basin, weights=own_length, minlength=num_nodes)
+    basin_length += np.bincount(comp_basin[e_src], weights=e_weight, minlength=num_nodes)
+    nodes = arrays['nodes']
+    return {'nodes': nodes,
+            'node_length': comp_length[comp],
+            'node_sources': comp_sources[comp],
+            'edge_length': edge_length,
+            'edge_sources': edge_sources,
+            'basin': basin,
+            'basin_length': {nodes[b]: float(basin_length[b]) for b in np.unique(comp_basin)}}
+
+
+def add_flow_graph(graph, flow, arrays=None):
+    ''' add the results of flow_accumulation() to
+    the graph as node and edge attributes
+    ('upstream_length', 'upstream_sources' and
+    the sink node 'basin' of the nodes) '''
+    if arrays is None:
+        arrays = graph_to_arrays(graph)
+    nodes = flow['nodes']
+    for i, n in enumerate(nodes):
+        graph.nodes[n]['upstream_length'] = float(flow['node_length'][i])
+        graph.nodes[n]['upstream_sources'] = float(flow['node_sources'][i])
+        graph.nodes[n]['basin'] = nodes[flow['basin'][i]]
+    for i, (s, e) in enumerate(zip(arrays['src'], arrays['dst'])):
+        graph[nodes[s]][nodes[e]]['upstream_length'] = float(flow['edge_length'][i])
+        graph[nodes[s]][nodes[e]]['upstream_sources'] = float(flow['edge_sources'][i])
+
+
+def print_flow_summary(flow, n_largest=5):
+    ''' print the number of drainage basins
+    and the largest basins by trough length '''
+    basins = sorted(flow['basin_length'].items(), key=lambda b: b[1], reverse=True)
+    print(f"number of drainage basins is: {len(basins)}")
+    print(f"the {n_largest} largest basins (sink: trough length) are:\n\t"
+          + ", ".join("{0}: {1:.2f} m".format(sink, length) for sink, length in basins[:n_largest]))
+    print(f"maximum upstream contributing length is: \n\t{flow['node_length'].max():.2f} m")
+
+
+@dataclass
+class NetworkReport:
+    ''' all network metrics of a trough graph.
+    The expensive metrics (betweenness, shortest
+    paths) are None until they are requested. '''
+    fingerprint: str
+    num_nodes: int
+    num_edges: int
+    sources: int
+    sinks: int
+    num_components: int
+    component_sizes: dict
+    component_edges: list
+    e_pot: float
+    density: float
+    total_length: float
+    betweenness: Optional[dict] = None
+    shortest_paths_largest: Optional[dict] = None
+    shortest_paths_components: Optional[dict] = None
+
+
+# expensive metrics of the NetworkReport and the functions computing them
+EXPENSIVE_METRICS = {'betweenness': betweenness_stats,
+                     'shortest_paths_largest': shortest_path_stats_largest,
+                     'shortest_paths_components': shortest_path_stats_components}
+
+# version of the cached reports and statistics: bump it whenever network_metrics(),
+# the EXPENSIVE_METRICS, the NetworkReport fields or topology_stats change
+REPORT_VERSION = 1
+
+
+def graph_fingerprint(graph):
+    ''' hash of the nodes and the weighted edges of
+    a graph (and of REPORT_VERSION), to recognize
+    unchanged graphs and outdated cached reports '''
+    h = hashlib.sha1()
+    h.update('report version {}'.format(REPORT_VERSION).encode())
+    h.update(repr(sorted(map(str, graph.nodes()))).encode())
+    h.update(repr(sorted((str(s), str(e), round(w, 6)) for (s, e, w) in graph.edges(data='weight', default=0))).encode())
+    return h.hexdigest()
+
+
+def get_network_report(graph, expensive=(), cache_dir=None):
+    ''' get the network report of a graph. Reports are
+    cached on disk by graph fingerprint, so unchanged
+    graphs are not analysed again; expensive metrics are
+    only computed when requested (and then cached, too).
+
+    :param graph: an nx.DiGraph
+    :param expensive: names of the expensive metrics to
+    include (see EXPENSIVE_METRICS); 'all' for all of them
+    :param cache_dir: directory of the cache (e.g. the
+    cache in the output directory of iwd.py); None (default)
+    disables caching
+    :return report: NetworkReport
+    '''
+    if expensive == 'all':
+        expensive = tuple(EXPENSIVE_METRICS)
+    fingerprint = graph_fingerprint(graph)
+    cache_loc = None if cache_dir is None else os.path.join(cache_dir, 'network_report_' + fingerprint)
+
+    report = None
+    if cache_loc is not None and os.path.exists(cache_loc + '.pkl'):
+        report = load_obj(cache_loc)
+    updated = report is None
+    if report is None:
+        metrics = network_metrics(graph)
+        report = NetworkReport(fingerprint=fingerprint,
+                               **{f.name: metrics[f.name] for f in fields(NetworkReport)
+                                  if f.name in metrics})
+        report.component_sizes = dict(report.component_sizes)
+    for name in expensive:
+        if getattr(report, name) is None:
+            setattr(report, name, EXPENSIVE_METRICS[name](graph))
+            updated = True
+
+    if cache_loc is not None and updated:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_loc + '.pkl', 'wb') as f:
+            pickle.dump(report, f, pickle.HIGHEST_PROTOCOL)
+    return report
+
+
+def print_network_report(report):
+    ''' print all available metrics of a NetworkReport '''
+    print(f"Number of nodes: {report.num_nodes}\nNumber of edges: {report.num_edges}")
+    print("sources: {}".format(report.sources))
+    print("sinks: {}".format(report.sinks))
+    print(f'number of connected components is: {report.num_components}')
+    print(f'their sizes are: {report.component_sizes}')
+    print(f'they have {report.component_edges} edges')
+    if report.shortest_paths_components is not None:
+        avg_lengths = report.shortest_paths_components['avg_lengths']
+        diameters = report.shortest_paths_components['diameters']
+        print(f"Average shortest path lengths per component (median={np.median(avg_lengths)}):\n\t{sorted(avg_lengths, reverse=True)} m")
+        print(f"Diameter of each connected component (median={np.median(diameters)}):\n\t{sorted(diameters, reverse=True)} m")
+    if report.shortest_paths_largest is not None:
+        print("The average shortest path length of the largest component is:\n\t{0} m (median: {1} m)".format(
+            report.shortest_paths_largest['mean'], report.shortest_paths_largest['median']))
+        print("The diameter of the graph is:\n\t{} m".format(report.shortest_paths_largest['diameter']))
+    if report.betweenness is not None:
+        print(f"Average betweenness centrality is: \n\t{report.betweenness['mean']}\n "
+              f"min: {report.betweenness['min']}; max: {report.betweenness['max']}")
+    print(f"Absolute network density is: \n\t{report.density}")
+    print("The total length of all channels in the network of the study area is:\n\t{} m".format(
+        round(report.total_length, 2)))
+
+
+def report_scalars(report):
+    ''' flatten the scalar metrics of a report
+    (incl. those of the expensive metrics) '''
+    scalars = {}
+    for f in fields(NetworkReport):
+        val = getattr(report, f.name)
+        if isinstance(val, (int, float)) and not isinstance(val, bool):
+            scalars[f.name] = val
+        elif isinstance(val, dict) and f.name in EXPENSIVE_METRICS:
+            for key, v in val.items():
+                if isinstance(v, (int, float)):
+                    scalars[f.name + '.' + key] = v
+                else:
+                    scalars[f.name + '.median_' + key] = float(np.nanmedian(v))
+    return scalars
+
+
+def compare_reports(report_a, report_b, labels=('a', 'b')):
+    ''' compare two network reports (e.g. 2009 vs. 2019)
+    side-by-side and print the table.
+
+    :param report_a: NetworkReport
+    :param report_b: NetworkReport
+    :param labels: column names of the two reports
+    :return rows: list of (metric, value_a, value_b,
+    difference b - a); metrics missing in one of the
+    reports are None there
+    '''
+    scalars_a = report_scalars(report_a)
+    scalars_b = report_scalars(report_b)
+    rows = []
+    for name in list(scalars_a) + [n for n in scalars_b if n not in scalars_a]:
+        val_a = scalars_a.get(name)
+        val_b = scalars_b.get(name)
+        diff = None if val_a is None or val_b is None else val_b - val_a
+        rows.append((name, val_a, val_b, diff))
+
+    print("{0:<48}{1:>16}{2:>16}{3:>16}".format('metric', labels[0], labels[1], 'difference'))
+    for name, val_a, val_b, diff in rows:
+        print("{0:<48}{1:>16}{2:>16}{3:>16}".format(name, *['-' if v is None else '{:.6g}'.format(v)
+                                                          for v in (val_a, val_b, diff)]))
+    return rows
+
+
+def do_analysis(graph, cache_dir=None, condense=False):
+    if condense:
+        # merge the degree-2 chains before the (expensive) metrics
+        graph, _ = condense_graph(graph)
+        print(f"condensed graph: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges")
+    # all metrics of the network (from the cache, if the graph didn't change)
+    report = get_network_report(graph, expensive='all', cache_dir=cache_dir)
+    print_network_report(report)
+    # routing of the flow along the downslope directed troughs
+    arrays = graph_to_arrays(graph)
+    flow = flow_accumulation(graph, arrays)
+    add_flow_graph(graph, flow, arrays)
+    print_flow_summary(flow)
     print("_______________________")
+    return report
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    logging.basicConfig(level=logging.WARNING)
     startTime = datetime.now()
 
     # read in 2009 data
@@ -250,9 +870,12 @@ if __name__ == '__main__':
     add_params_graph(G_19, transect_dict_fitted_2019)
 
     # graph analysis 2009
-    do_analysis(G_09)
+    report_09 = do_analysis(G_09)
     # graph analysis 2019
-    do_analysis(G_19)
+    report_19 = do_analysis(G_19)
+    compare_reports(report_09, report_19, labels=('2009', '2019'))
 
+    run_metrics.print_summary()
+    run_metrics.save_summary('./data/run_summary_network_analysis.json')
     print(datetime.now() - startTime)
     plt.show()
@@ -0,0 +1,297 @@
+import os
+import pickle
+import numpy as np
+from scipy import ndimage
+from datetime import datetime
+import logging
+import run_metrics
+import raster_store
+from b_extract_trough_transects import read_graph
+from d_network_analysis import add_params_graph, load_obj, EDGE_PARAMS
+
+logger = logging.getLogger(__name__)
+
+startTime = datetime.now()
+
+
+def get_skeleton(year, graph=None):
+    ''' load the final skeleton raster of the
+    trough network (stored by a_dem_to_graph) or,
+    if it isn't on disk yet, segment the DEM again
+    (with the settings the graphs in ./data were made
+    with).
+
+    With a graph, only a skeleton containing all of its
+    trough pixels is used (the stored one may come from
+    a different segmentation, e.g. of the closed image);
+    if none does, the troughs are rasterized from the
+    graph (see edge_raster()).
+
+    :param year: 2009 or 2019
+    :param graph: nx.DiGraph the skeleton has to match
+    :return skel: skeleton raster, 1 for trough pixels
+    '''
+    if year == 2009:
+        store_loc = './data/a_2009/arf_substeps_2009/skel_clu_elim_25'
+        skel_loc = './data/a_2009/arf_skeleton_2009.tif'
+        dem_loc = './data/a_2009/arf_dtm_2009.tif'
+        its = 1
+    elif year == 2019:
+        store_loc = './data/b_2019/arf_substeps_2019/skel_clu_elim_25'
+        skel_loc = './data/b_2019/arf_skeleton_2019.tif'
+        dem_loc = './data/b_2019/arf_dtm_2019.tif'
+        its = 2
+    else:
+        print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
+        return
+
+    def candidates():
+        if raster_store.is_raster(store_loc):
+            yield store_loc, raster_store.read_raster(store_loc)
+        from a_dem_to_graph import read_data, detrender, segment_troughs
+        if os.path.exists(skel_loc):
+            yield skel_loc, read_data(skel_loc)
+        logger.info("segmenting %s again", dem_loc)
+        img_det = detrender(read_data(dem_loc), 16)
+        # the same segmentation the graphs in ./data were made with
+        yield 'segmentation', segment_troughs(img_det, its=its, skeleton_of='dilated', keep_steps=False)[-1]
+
+    shape = None
+    for source, skel in candidates():
+        if graph is None:
+            return skel
+        shape = skel.shape
+        missing = int(((edge_raster(graph, shape) >= 0) & (skel == 0)).sum())
+        if missing == 0:
+            return skel
+        logger.warning("skeleton from %s does not match the graph (%d trough pixels missing)", source, missing)
+    # troughs the graph doesn't hold (parallel edges between two nodes, rings) are missing
+    # from this raster, so some neighbouring polygons merge
+    logger.warning("no matching skeleton, rasterizing the troughs of the graph")
+    return edge_raster(graph, shape, connect=True) >= 0
+
+
+def label_polygons(skel, min_pixels=2):
+    ''' label the polygons (cells) enclosed by the
+    troughs: the connected components of the
+    complement of the skeleton. As the skeleton is
+    8-connected, the polygons are 4-connected.
+
+    :param skel: skeleton raster, trough pixels != 0
+    :param min_pixels: smaller regions (holes within
+    the skeleton lines) are not counted as polygons
+    :return labels: np.array with the polygon id per
+    pixel (0 for trough pixels)
+    :return num_polygons: number of polygons
+    '''
+    four = ndimage.generate_binary_structure(2, 1)
+    labels, num_polygons = ndimage.label(skel == 0, structure=four)
+    # drop the holes and number the remaining polygons consecutively
+    keep = np.bincount(labels.ravel(), minlength=num_polygons + 1) >= min_pixels
+    keep[0] = False
+    new_ids = np.where(keep, np.cumsum(keep), 0)
+    return new_ids[labels], int(keep.sum())
+
+
+def _line_pixels(starts, ends):
+    ''' the pixels of the straight (8-connected) lines
+    from starts[i] to ends[i], without the end pixels
+
+    :param starts: np.array (N, 2) of pixel coordinates
+    :param ends: np.array (N, 2) of pixel coordinates
+    :return line_idx: index i of the line of each pixel
+    :return pixels: np.array (M, 2) of the line pixels
+    '''
+    steps = np.abs(ends - starts).max(axis=1)
+    line_idx = np.repeat(np.arange(len(starts)), steps)
+    # position of each pixel within its line: 0, 1, ..., steps - 1
+    t = np.arange(len(line_idx)) - np.repeat(np.cumsum(steps) - steps, steps)
+    frac = t / np.maximum(steps[line_idx], 1)
+    pixels = np.round(starts[line_idx] + frac[:, None] * (ends - starts)[line_idx]).astype(np.int64)
+    return line_idx, pixels
+
+
+def edge_raster(graph, shape, connect=False):
+    ''' rasterize the edges of the graph: each trough
+    pixel gets the id 'eid' of its (undirected) edge.
+
+    :param graph: nx.DiGraph with 'pts' and 'eid' per edge
+    :param shape: shape of the skeleton raster
+    :param connect: also draw straight lines between
+    consecutive pts (the steps from the node centers to
+    the trough pixels can be longer than one pixel), so
+    that the edges alone enclose the polygons
+    :return edge_ids: np.array (shape) with the edge
+    id per trough pixel, -1 elsewhere; a flat trough
+    existing in both directions gets the id of the
+    first of its two edges
+    '''
+    eids = []
+    pts = []
+    seen = set()
+    for (s, e, data) in graph.edges(data=True):
+        if (e, s) in seen or data.get('pts') is None or len(data['pts']) == 0:
+            continue
+        seen.add((s, e))
+        eids.append(data['eid'])
+        pts.append(np.asarray(data['pts'], dtype=np.int64).reshape(-1, 2))
+    edge_ids = np.full(shape, -1, dtype=np.int64)
+    if pts:
+        lengths = [len(p) for p in pts]
+        pts_eid = np.repeat(eids, lengths)
+        pts = np.concatenate(pts)
+        if connect:
+            # lines between consecutive pts of the same edge
+            same_edge = np.ones(len(pts) - 1, dtype=bool)
+            same_edge[np.cumsum(lengths)[:-1] - 1] = False
+            line_idx, pixels = _line_pixels(pts[:-1][same_edge], pts[1:][same_edge])
+            edge_ids[pixels[:, 0], pixels[:, 1]] = pts_eid[:-1][same_edge][line_idx]
+        edge_ids[pts[:, 0], pts[:, 1]] = pts_eid
+    return edge_ids
+
+
+def polygon_stats(labels, num_polygons, edge_ids=None, edge_params=None, pixel_size=1.):
+    ''' compute per-polygon statistics with reductions
+    over the labeled array (no loop over polygons).
+
+    The bounding troughs of a polygon are those whose
+    pixels touch it (8-neighbourhood). Their parameters
+    are averaged weighted by the number of touching
+    pixels, i.e. by the length they bound the polygon.
+
+    :param labels: polygon labels from label_polygons()
+    :param num_polygons: number of polygons
+    :param edge_ids: edge id per pixel from edge_raster()
+    :param edge_params: dictionary parameter name -->
+    np.array of values per edge id (nan if unknown),
+    e.g. {'mean_depth': ..., 'mean_width': ...}
+    :param pixel_size: edge length of a pixel [m]
+    :return stats: dictionary with np.arrays of length
+    num_polygons (index = polygon label - 1)
+    - 'area' [m²], 'perimeter' [m] (along the pixel borders)
+    - 'centroid_row', 'centroid_col' [px]
+    - 'closed': False for polygons touching the image border
+    (those are cut off and not fully enclosed)
+    - 'num_edges': number of bounding troughs
+    - per parameter of edge_params: weighted mean of the
+    bounding troughs
+    '''
+    index = np.arange(1, num_polygons + 1)
+    n = num_polygons + 1
+    flat = labels.ravel()
+    area = np.bincount(flat, minlength=n)
+
+    rows, cols = np.indices(labels.shape)
+    centroid_row = np.bincount(flat, weights=rows.ravel(), minlength=n)[index] / area[index]
+    centroid_col = np.bincount(flat, weights=cols.ravel(), minlength=n)[index] / area[index]
+
+    # perimeter: pixel sides between a polygon and anything else
+    padded = np.pad(labels, 1, mode='constant', constant_values=0)
+    perimeter = np.zeros(n)
+    center = padded[1:-1, 1:-1]
+    for shifted in (padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]):
+        border = (center > 0) & (shifted != center)
+        perimeter += np.bincount(center[border], minlength=n)
+
+    border_labels = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    closed = np.ones(n, dtype=bool)
+    closed[border_labels] = False
+
+    stats = {'area': area[index] * pixel_size ** 2,
+             'perimeter': perimeter[index] * pixel_size,
+             'centroid_row': centroid_row,
+             'centroid_col': centroid_col,
+             'closed': closed[index]}
+
+    if edge_ids is not None:
+        # (polygon, edge) pairs of all touching pixels, in all 8 directions
+        padded_edges = np.pad(edge_ids, 1, mode='constant', constant_values=-1)
+        poly_touch = []
+        edge_touch = []
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                if dr == 0 and dc == 0:
+                    continue
+                shifted = padded_edges[1 + dr:padded_edges.shape[0] - 1 + dr,
+                                       1 + dc:padded_edges.shape[1] - 1 + dc]
+                touch = (labels > 0) & (shifted >= 0)
+                poly_touch.append(labels[touch])
+                edge_touch.append(shifted[touch])
+        poly_touch = np.concatenate(poly_touch)
+        edge_touch = np.concatenate(edge_touch)
+
+        # number of distinct troughs per polygon
+        n_e = max(int(edge_ids.max()) + 1, 1)
+        pairs = np.unique(poly_touch * n_e + edge_touch)
+        stats['num_edges'] = np.bincount(pairs // n_e, minlength=n)[index]
+
+        for name, values in (edge_params or {}).items():
+            vals = np.asarray(values, dtype=float)[edge_touch]
+            valid = ~np.isnan(vals)
+            total = np.bincount(poly_touch[valid], weights=vals[valid], minlength=n)
+            weight = np.bincount(poly_touch[valid], minlength=n)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                stats[name] = (total / weight)[index]
+    return stats
+
+
+def print_polygon_stats(stats):
+    ''' print a summary of the closed polygons '''
+    closed = stats['closed']
+    print(f"number of polygons: {len(closed)} ({closed.sum()} closed, {(~closed).sum()} cut off at the border)")
+    print(f"median area of the closed polygons: {np.median(stats['area'][closed]):.1f} m²")
+    print(f"median perimeter of the closed polygons: {np.median(stats['perimeter'][closed]):.1f} m")
+    for name in ('mean_depth', 'mean_width'):
+        if name in stats:
+            print(f"median {name} of the bounding troughs: {np.nanmedian(stats[name][closed]):.3f} m")
+
+
+def save_obj(obj, name):
+    with open(name + '.pkl', 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+
+def do_analysis(year):
+    ''' extract the polygons enclosed by the troughs
+    of the given year and compute their statistics '''
+    if year == 2009:
+        edgelist_loc = './data/a_2009/arf_graph_2009.edgelist'
+        coord_dict_loc = './data/a_2009/arf_graph_2009_node-coords.npy'
+        avg_loc = './data/a_2009/arf_transect_dict_avg_2009'
+        polygon_loc = './data/a_2009/arf_polygon_stats_2009'
+    elif year == 2019:
+        edgelist_loc = './data/b_2019/arf_graph_2019.edgelist'
+        coord_dict_loc = './data/b_2019/arf_graph_2019_node-coords.npy'
+        avg_loc = './data/b_2019/arf_transect_dict_avg_2019'
+        polygon_loc = './data/b_2019/arf_polygon_stats_2019'
+    else:
+        print('we do not have data from this year. please select a different year (i.e., 2009, 2019).')
+        return
+
+    G, coords = read_graph(edgelist_loc=edgelist_loc, coord_dict_loc=coord_dict_loc)
+    params = add_params_graph(G, load_obj(avg_loc))
+    skel = get_skeleton(year, G)
+
+    with run_metrics.stage_timer('polygons') as counts:
+        labels, num_polygons = label_polygons(skel)
+        edge_ids = edge_raster(G, skel.shape)
+        edge_params = {name: params[:, EDGE_PARAMS.index(name)] for name in ('mean_depth', 'mean_width')}
+        stats = polygon_stats(labels, num_polygons, edge_ids, edge_params)
+        counts['polygons'] += num_polygons
+        counts['closed_polygons'] += int(stats['closed'].sum())
+
+    print_polygon_stats(stats)
+    save_obj(stats, polygon_loc)
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    stats_09 = do_analysis(2009)
+    print("_______________________")
+    stats_19 = do_analysis(2019)
+
+    run_metrics.print_summary()
+    run_metrics.save_summary('./data/run_summary_polygon_analysis.json')
+    print(datetime.now() - startTime)
@@ -0,0 +1,351 @@
+''' command line interface of the ice-wedge trough analysis.
+
+All paths and tunables come from a site configuration
+file (TOML, or YAML if PyYAML is installed), e.g.
+
+    python iwd.py run sites/anaktuvuk_river_fire.toml --jobs 8
+    python iwd.py network sites/anaktuvuk_river_fire.toml --epochs 2009 2019
+
+Commands:
+    run      all stages for all (selected) epochs
+    graph    DTM --> trough network graph
+    extract  graph --> transects
+    fit      transects --> fitted and averaged trough parameters
+    network  network analysis of the graphs (and comparison of the epochs)
+'''
+import os
+import sys
+import copy
+import pickle
+import argparse
+import logging
+from contextlib import nullcontext
+from datetime import datetime
+from functools import partial
+import numpy as np
+import run_metrics
+import raster_store
+import tile_io
+
+# the stage modules are imported by the stages, so a
+# command only loads the dependencies it needs
+
+logger = logging.getLogger(__name__)
+
+# the bundled data of the publication (the reference of regression_check.py)
+BUNDLED_DIRS = tuple(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', d)
+                     for d in ('a_2009', 'b_2019'))
+
+# defaults of all tunables; the site config overrides them
+DEFAULT_CONFIG = {
+    'site': {'name': 'site', 'output_dir': './output'},
+    'epochs': [],
+    'segmentation': {'trend_size': 16, 'block_size': 133, 'c': 11, 'cluster_size_thresh': 15, 'its': 2,
+                     'cluster_size_skel': 25, 'method': 'lee', 'skeleton_of': 'closed', 'builder': 'native'},
+    'transects': {'width': 4, 'interpolate': False, 'stride': 1, 'spacing': None},
+    'fit': {'models': [], 'min_amplitude': 0., 'weighted': False, 'bootstrap': False, 'n_boot': 1000},
+    # 'expensive': expensive metrics of the tile reports of batch.py
+    'network': {'condense': False, 'expensive': []},
+}
+
+
+def load_config(location, require_epochs=True):
+    ''' read a site configuration and fill in
+    the defaults of all missing tunables.
+
+    :param location: path of a .toml or .yaml/.yml file
+    :param require_epochs: raise a ValueError if the
+    config lists no epochs
+    :raises ImportError: naming the package (tomli or
+    pyyaml) needed to read the config
+    :return config: dictionary with the sections of
+    DEFAULT_CONFIG; every epoch has a 'name', the 'dtm'
+    path and optional per-epoch overrides of the
+    'segmentation', 'transects' and 'fit' sections
+    '''
+    if location.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("reading the YAML config {} needs the package pyyaml "
+                              "(pip install pyyaml)".format(location)) from None
+        with open(location) as f:
+            user_config = yaml.safe_load(f)
+    else:
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError("reading the TOML config {} needs the package tomli on Python < 3.11 "
+                                  "(pip install tomli)".format(location)) from None
+        with open(location, 'rb') as f:
+            user_config = tomllib.load(f)
+
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    for section, values in user_config.items():
+        if isinstance(values, dict) and section in config:
+            config[section].update(values)
+        else:
+            config[section] = values
+    if require_epochs and not config['epochs']:
+        raise ValueError("the site config {} lists no epochs".format(location))
+    for epoch in config['epochs']:
+        epoch['name'] = str(epoch['name'])
+        if 'dtm' not in epoch:
+            raise ValueError("epoch {} has no input 'dtm'".format(epoch['name']))
+    return config
+
+
+def epoch_settings(config, epoch, section):
+    ''' the settings of a config section for
+    one epoch (incl. the epoch's overrides) '''
+    settings = dict(config[section])
+    settings.update(epoch.get(section, {}))
+    return settings
+
+
+def epoch_paths(config, epoch):
+    ''' paths of all inputs and outputs of an epoch.
+    The outputs go to <output_dir>/<epoch dir>/ and are
+    named like the files in ./data, e.g.
+    <prefix>_graph_<epoch>.edgelist '''
+    out_dir = os.path.join(config['site']['output_dir'], epoch.get('dir', epoch['name']))
+    prefix = os.path.join(out_dir, '{0}_{{0}}_{1}'.format(config['site'].get('prefix', config['site']['name']),
+                                                          epoch['name']))
+    return {'dir': out_dir,
+            'dtm': epoch['dtm'],
+            'microtopo': prefix.format('microtopo') + '.npz',
+            'skeleton': prefix.format('skeleton') + '.npz',
+            'graph': prefix.format('graph'),
+            'edgelist': prefix.format('graph') + '.edgelist',
+            'node_coords': prefix.format('graph') + '_node-coords.npy',
+            'transects': prefix.format('transect_dict'),
+            'fitted': prefix.format('transect_dict_fitted'),
+            'avg': prefix.format('transect_dict_avg')}
+
+
+def writes_bundled_data(config, epochs):
+    ''' the epochs whose outputs would overwrite
+    the bundled data (see BUNDLED_DIRS) '''
+    bundled = {os.path.normcase(d) for d in BUNDLED_DIRS}
+    return [epoch['name'] for epoch in epochs
+            if os.path.normcase(os.path.abspath(epoch_paths(config, epoch)['dir'])) in bundled]
+
+
+def save_obj(obj, name):
+    with open(name + '.pkl', 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_obj(name):
+    with open(name + '.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+def load_stage_input(config, epoch, stage):
+    ''' read the input raster or dictionary of a stage
+    (the DTM for graph and extract, the transects for fit);
+    this is what the Prefetcher loads ahead of time '''
+    paths = epoch_paths(config, epoch)
+    if stage == 'fit':
+        return load_obj(paths['transects'])
+    from PIL import Image
+    return np.array(Image.open(paths['dtm']))
+
+
+def stage_graph(config, epoch, args, dem=None, writer=None):
+    ''' DTM --> microtopography --> skeleton --> directed graph
+
+    :param dem: the DTM, if already read (else it's read here)
+    :param writer: tile_io.AsyncWriter for the outputs; if None,
+    a writer is used for this stage only
+    '''
+    import a_dem_to_graph
+    paths = epoch_paths(config, epoch)
+    seg = epoch_settings(config, epoch, 'segmentation')
+    os.makedirs(paths['dir'], exist_ok=True)
+    if dem is None:
+        dem = load_stage_input(config, epoch, 'graph')
+
+    with tile_io.AsyncWriter() if writer is None else nullcontext(writer) as writer:
+        with run_metrics.stage_timer('detrend'):
+            img_det = a_dem_to_graph.detrender(dem, seg['trend_size'])
+        # the outputs are written while the next steps run
+        writer.submit(raster_store.save_raster, paths['microtopo'], img_det)
+
+        with run_metrics.stage_timer('segment'):
+            skel = a_dem_to_graph.segment_troughs(img_det, block_size=seg['block_size'], c=seg['c'],
+                                                  cluster_size_thresh=seg['cluster_size_thresh'], its=seg['its'],
+                                                  cluster_size_skel=seg['cluster_size_skel'], method=seg['method'],
+                                                  skeleton_of=seg['skeleton_of'], keep_steps=False)[-1]
+        writer.submit(raster_store.save_raster, paths['skeleton'], skel)
+
+        with run_metrics.stage_timer('graph') as counts:
+            G = a_dem_to_graph.skeleton_to_graph(skel, builder=seg['builder'], tile_size=args.tile_size)
+            H = a_dem_to_graph.make_directed(G, dem)
+            counts.update(a_dem_to_graph.get_graph_stats(H))
+        writer.submit(a_dem_to_graph.save_graph_with_coords, H, a_dem_to_graph.get_node_coords(H),
+                      paths['graph'])
+    print("{0}: graph with {1} nodes and {2} edges".format(epoch['name'], H.number_of_nodes(),
+                                                            H.number_of_edges()))
+
+
+def stage_extract(config, epoch, args, dem=None, writer=None):
+    ''' graph + DTM --> transects
+
+    :param dem: the DTM, if already read (else it's read here)
+    :param writer: tile_io.AsyncWriter for the outputs
+    '''
+    import b_extract_trough_transects
+    paths = epoch_paths(config, epoch)
+    settings = epoch_settings(config, epoch, 'transects')
+    H, coord_dict = b_extract_trough_transects.read_graph(edgelist_loc=paths['edgelist'],
+                                                          coord_dict_loc=paths['node_coords'])
+    if dem is None:
+        dem = load_stage_input(config, epoch, 'extract')
+    sampler = (b_extract_trough_transects.get_transects_interp if settings['interpolate']
+               else b_extract_trough_transects.get_transects)
+    with run_metrics.stage_timer('extract'):
+        transect_dict = sampler(H, dem, settings['width'], stride=settings['stride'], spacing=settings['spacing'])
+    with tile_io.AsyncWriter() if writer is None else nullcontext(writer) as writer:
+        writer.submit(save_obj, transect_dict, paths['transects'])
+    print("{0}: transects of {1} troughs extracted".format(epoch['name'], len(transect_dict)))
+
+
+def stage_fit(config, epoch, args, transect_dict=None, writer=None):
+    ''' transects --> fitted transects --> averaged trough parameters
+
+    :param transect_dict: the transects, if already read
+    :param writer: tile_io.AsyncWriter for the outputs
+    '''
+    import c_transect_analysis
+    paths = epoch_paths(config, epoch)
+    settings = epoch_settings(config, epoch, 'fit')
+    if transect_dict is None:
+        transect_dict = load_stage_input(config, epoch, 'fit')
+    with tile_io.AsyncWriter() if writer is None else nullcontext(writer) as writer:
+        with run_metrics.stage_timer('fit'):
+            if settings['models']:
+                transect_dict_fitted = c_transect_analysis.fit_profiles_batched(
+                    transect_dict, settings['models'], min_amplitude=settings['min_amplitude'])
+            else:
+                transect_dict_fitted = c_transect_analysis.fit_gaussian_parallel(
+                    transect_dict, n_jobs=args.jobs, min_amplitude=settings['min_amplitude'])
+        writer.submit(save_obj, transect_dict_fitted, paths['fitted'])
+
+        with run_metrics.stage_timer('avg'):
+            edge_param_dict = c_transect_analysis.get_trough_avgs_gauss(transect_dict_fitted, settings['weighted'])
+        if settings['bootstrap']:
+            with run_metrics.stage_timer('bootstrap'):
+                c_transect_analysis.add_bootstrap_ci(edge_param_dict, c_transect_analysis.get_trough_bootstrap_ci(
+                    transect_dict_fitted, n_boot=settings['n_boot'], n_jobs=args.jobs))
+        writer.submit(save_obj, edge_param_dict, paths['avg'])
+    print("{0}: parameters of {1} troughs".format(epoch['name'], len(edge_param_dict)))
+
+
+def load_epoch_graph(config, epoch):
+    ''' the graph of an epoch, with the averaged
+    trough parameters if the fit stage has run '''
+    import b_extract_trough_transects
+    import d_network_analysis
+    paths = epoch_paths(config, epoch)
+    G, coord_dict = b_extract_trough_transects.read_graph(edgelist_loc=paths['edgelist'],
+                                                          coord_dict_loc=paths['node_coords'])
+    if os.path.exists(paths['avg'] + '.pkl'):
+        d_network_analysis.add_params_graph(G, load_obj(paths['avg']))
+    return G
+
+
+def stage_network(config, epochs, args):
+    ''' network analysis of all epochs and the
+    comparison of consecutive epochs '''
+    import d_network_analysis
+    reports = []
+    for epoch in epochs:
+        G = load_epoch_graph(config, epoch)
+        print("{0}:".format(epoch['name']))
+        reports.append(d_network_analysis.do_analysis(G, cache_dir=args.cache_dir,
+                                                      condense=config['network']['condense']))
+    for (epoch_a, report_a), (epoch_b, report_b) in zip(zip(epochs, reports), zip(epochs[1:], reports[1:])):
+        d_network_analysis.compare_reports(report_a, report_b, labels=(epoch_a['name'], epoch_b['name']))
+    return reports
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='iwd', description="ice-wedge trough network analysis")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in (('run', 'run all stages'),
+                               ('graph', 'extract the trough network graphs from the DTMs'),
+                               ('extract', 'extract the transects of the troughs'),
+                               ('fit', 'fit the transects and average the trough parameters'),
+                               ('network', 'analyse and compare the trough networks')):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('config', help="site configuration (.toml, .yaml)")
+        sub.add_argument('--epochs', nargs='+', help="only these epochs of the config (default: all)")
+        sub.add_argument('--jobs', type=int, default=-1, help="number of parallel jobs (default: all cores)")
+        sub.add_argument('--tile-size', type=int, default=None,
+                         help="read the skeleton in tiles of this size when building the graph")
+        sub.add_argument('--cache-dir', default=None,
+                         help="cache of the network reports (default: <output_dir>/cache)")
+        sub.add_argument('--prefetch', type=int, default=1,
+                         help="number of epochs whose inputs are read ahead (default: 1)")
+        sub.add_argument('--max-pending', type=int, default=4,
+                         help="maximum number of outputs queued for writing (default: 4)")
+        sub.add_argument('--summary', default=None, help="save the run summary (json) to this path")
+        sub.add_argument('--overwrite-bundled', action='store_true',
+                         help="allow writing the outputs into the bundled ./data/a_2009 and ./data/b_2019")
+        sub.add_argument('-v', '--verbose', action='store_true', help="log progress")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    start_time = datetime.now()
+
+    try:
+        config = load_config(args.config)
+    except ImportError as err:
+        print(err)
+        return 1
+    epochs = config['epochs']
+    if args.epochs:
+        unknown = set(args.epochs) - {epoch['name'] for epoch in epochs}
+        if unknown:
+            print("unknown epochs: {}".format(', '.join(sorted(unknown))))
+            return 1
+        epochs = [epoch for epoch in epochs if epoch['name'] in args.epochs]
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(config['site']['output_dir'], 'cache')
+
+    commands = ['graph', 'extract', 'fit', 'network'] if args.command == 'run' else [args.command]
+    overwritten = writes_bundled_data(config, epochs)
+    if overwritten and set(commands) != {'network'} and not args.overwrite_bundled:
+        print("the outputs of the epochs {} would overwrite the bundled data; set another output_dir "
+              "in the site config (or use --overwrite-bundled)".format(', '.join(overwritten)))
+        return 1
+
+    stages = {'graph': stage_graph, 'extract': stage_extract, 'fit': stage_fit}
+    with tile_io.AsyncWriter(max_pending=args.max_pending) as writer:
+        for command in commands:
+            if command == 'network':
+                stage_network(config, epochs, args)
+                continue
+            # the inputs of the next epochs are read while the current one is processed
+            for epoch, data in tile_io.Prefetcher(epochs, partial(load_stage_input, config, stage=command),
+                                                  depth=args.prefetch):
+                stages[command](config, epoch, args, data, writer)
+            # the next stage reads these outputs
+            writer.flush()
+
+    run_metrics.print_summary()
+    if args.summary:
+        run_metrics.save_summary(args.summary)
+    print(datetime.now() - start_time)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import numpy as np
+
+# registry of trough profile models, see register_model()
+MODELS = {}
+
+
+def register_model(name, func, init, width, lower, upper):
+    ''' add a trough profile model to the registry.
+
+    All functions work on a batch of M transects
+    with N points each at once.
+
+    :param name: name of the model
+    :param func: func(t, p) --> modelled (flipped) heights,
+    t: np.array (M, N), p: np.array (M, k) of parameters
+    :param init: init(t, data, amplitude, mean, sigma) -->
+    initial parameters (M, k), from the data and the
+    moment-based guesses of the screening (each (M,))
+    :param width: width(p) --> full width at half
+    maximum of the fitted profile (M,) [m]
+    :param lower: lower bounds of the k parameters
+    :param upper: upper bounds of the k parameters
+    '''
+    MODELS[name] = {'func': func, 'init': init, 'width': width,
+                    'lower': np.asarray(lower, dtype=float), 'upper': np.asarray(upper, dtype=float)}
+
+
+def _gauss(t, p):
+    return p[:, 0, None] * np.exp(-(t - p[:, 1, None]) ** 2 / (2 * p[:, 2, None] ** 2))
+
+
+def _asym_gauss(t, p):
+    # different sigma left and right of the trough center
+    sigma = np.where(t < p[:, 1, None], p[:, 2, None], p[:, 3, None])
+    return p[:, 0, None] * np.exp(-(t - p[:, 1, None]) ** 2 / (2 * sigma ** 2))
+
+
+def _lorentz(t, p):
+    return p[:, 0, None] / (1 + ((t - p[:, 1, None]) / p[:, 2, None]) ** 2)
+
+
+def _poly2(t, p):
+    return p[:, 0, None] + p[:, 1, None] * t + p[:, 2, None] * t ** 2
+
+
+def _poly2_width(p):
+    # width at half the height of the vertex (nan if the parabola doesn't open downwards)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        height = p[:, 0] - p[:, 1] ** 2 / (4 * p[:, 2])
+        width = 2 * np.sqrt(height / (-2 * p[:, 2]))
+    return np.where((p[:, 2] < 0) & (height > 0), width, np.nan)
+
+
+def _poly2_init(t, data, amplitude, mean, sigma):
+    # the model is linear in its parameters, so solve the least squares problem directly
+    design = np.stack([np.ones_like(t), t, t ** 2], axis=2)
+    return np.linalg.solve(np.einsum('mnk,mnl->mkl', design, design),
+                           np.einsum('mnk,mn->mk', design, data)[..., None])[..., 0]
+
+
+FWHM_FACTOR = 2 * np.sqrt(2 * np.log(2))
+
+register_model('gauss', _gauss,
+               lambda t, data, amplitude, mean, sigma: np.stack([amplitude, mean, sigma], axis=1),
+               lambda p: FWHM_FACTOR * np.abs(p[:, 2]),
+               (-np.inf, -np.inf, 0.01), (np.inf, np.inf, 8.5))
+register_model('asym_gauss', _asym_gauss,
+               lambda t, data, amplitude, mean, sigma: np.stack([amplitude, mean, sigma, sigma], axis=1),
+               lambda p: FWHM_FACTOR / 2 * (np.abs(p[:, 2]) + np.abs(p[:, 3])),
+               (-np.inf, -np.inf, 0.01, 0.01), (np.inf, np.inf, 8.5, 8.5))
+register_model('lorentz', _lorentz,
+               lambda t, data, amplitude, mean, sigma: np.stack([amplitude, mean, sigma * FWHM_FACTOR / 2], axis=1),
+               lambda p: 2 * np.abs(p[:, 2]),
+               (-np.inf, -np.inf, 0.01), (np.inf, np.inf, 10.))
+register_model('poly2', _poly2, _poly2_init, _poly2_width,
+               (-np.inf, -np.inf, -np.inf), (np.inf, np.inf, np.inf))
+
+
+def fit_batched(func, t, data, p, lower, upper, max_iter=200, tol=1e-10):
+    ''' least squares fit of a model to a batch of
+    transects at once (Levenberg-Marquardt with a
+    finite difference jacobian, parameters clipped
+    to the bounds). Transects drop out of the
+    iteration as soon as they have converged.
+
+    :param func: model function func(t, p)
+    :param t: np.array (M, N) of transect positions
+    :param data: np.array (M, N) of flipped heights
+    :param p: np.array (M, k) of initial parameters
+    :param lower: lower bounds (k,)
+    :param upper: upper bounds (k,)
+    :param max_iter: maximum number of iterations
+    :param tol: relative decrease of the sum of squared
+    residuals below which a transect has converged
+    :return p: fitted parameters (M, k)
+    :return sse: sum of squared residuals (M,)
+    :return nit: number of iterations per transect (M,)
+    '''
+    p = np.clip(np.array(p, dtype=float), lower, upper)
+    M, k = p.shape
+    sse = ((data - func(t, p)) ** 2).sum(axis=1)
+    lam = np.full(M, 1e-3)
+    nit = np.zeros(M, dtype=int)
+    active = np.isfinite(sse)
+    for it in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        p_a, t_a, y_a = p[idx], t[idx], data[idx]
+        f_a = func(t_a, p_a)
+        # forward difference jacobian, one model evaluation per parameter
+        step = 1e-6 * np.maximum(np.abs(p_a), 1e-3)
+        jac = np.empty((len(idx), t.shape[1], k))
+        for j in range(k):
+            p_j = p_a.copy()
+            p_j[:, j] += step[:, j]
+            jac[:, :, j] = (func(t_a, p_j) - f_a) / step[:, j, None]
+        jtj = np.einsum('mnk,mnl->mkl', jac, jac)
+        grad = np.einsum('mnk,mn->mk', jac, y_a - f_a)
+        diag = np.einsum('mkk->mk', jtj)
+        damped = jtj + (lam[idx, None] * diag + 1e-12)[:, :, None] * np.eye(k)[None]
+        delta = np.linalg.solve(damped, grad[..., None])[..., 0]
+
+        p_new = np.clip(p_a + delta, lower, upper)
+        sse_new = ((y_a - func(t_a, p_new)) ** 2).sum(axis=1)
+        better = sse_new < sse[idx]
+        improvement = (sse[idx] - sse_new) / np.maximum(sse[idx], 1e-300)
+
+        p[idx[better]] = p_new[better]
+        sse[idx[better]] = sse_new[better]
+        lam[idx] = np.where(better, lam[idx] / 3, lam[idx] * 3)
+        nit[idx] += 1
+        done = (better & (improvement < tol)) | (lam[idx] > 1e10) | (~np.isfinite(sse_new) & ~better)
+        active[idx[done]] = False
+    return p, sse, nit
+
+
+def information_criterion(sse, n, k, criterion='aic'):
+    ''' AIC or BIC of least squares fits
+    with n points and k parameters '''
+    with np.errstate(divide='ignore'):
+        log_likelihood_term = n * np.log(np.maximum(sse, 1e-300) / n)
+    if criterion == 'aic':
+        return log_likelihood_term + 2 * k
+    elif criterion == 'bic':
+        return log_likelihood_term + k * np.log(n)
+    raise ValueError("unknown criterion: {}".format(criterion))
@@ -0,0 +1,102 @@
+''' compressed, chunked storage of the intermediate
+rasters (microtopography, threshold, closed, skeleton ...).
+
+A raster is saved as one .npz file (zip, deflate) with
+one member per chunk of chunk_size x chunk_size pixels,
+so a window is read by decompressing only the chunks it
+overlaps. Binary masks are bit-packed (1 bit per pixel),
+all other rasters keep their dtype (e.g. uint8 for the
+microtopography).
+'''
+import os
+import json
+import numpy as np
+
+DEFAULT_CHUNK = 256
+
+
+def _is_mask(arr):
+    ''' whether arr has at most one value besides 0 '''
+    if arr.dtype == bool:
+        return True
+    if arr.dtype.kind not in 'uif' or arr.size == 0:
+        return False
+    top = arr.max()
+    return bool(np.all((arr == 0) | (arr == top)))
+
+
+def save_raster(location, arr, chunk_size=DEFAULT_CHUNK, mask=None):
+    ''' save a raster in chunks, compressed.
+
+    :param location: path of the .npz file (the
+    extension is added if missing)
+    :param arr: 2D np.array
+    :param chunk_size: edge length of the chunks [px]
+    :param mask: store as bit-packed binary mask; None
+    to detect it (bool arrays and arrays of 0 and one
+    other value, e.g. 0/1 or 0/255). Dtype and value of
+    masks are restored when read.
+    '''
+    arr = np.asarray(arr)
+    if arr.ndim != 2:
+        raise ValueError("only 2D rasters can be stored, got shape {}".format(arr.shape))
+    if mask is None:
+        mask = _is_mask(arr)
+    if not location.endswith('.npz'):
+        location += '.npz'
+    meta = {'shape': list(arr.shape), 'dtype': arr.dtype.str, 'chunk_size': int(chunk_size), 'mask': bool(mask),
+            'mask_value': arr.max().item() if mask and arr.size else 1}
+    chunks = {'meta': np.array(json.dumps(meta))}
+    for r in range(0, arr.shape[0], chunk_size):
+        for c in range(0, arr.shape[1], chunk_size):
+            chunk = arr[r:r + chunk_size, c:c + chunk_size]
+            chunks['{0}_{1}'.format(r // chunk_size, c // chunk_size)] = (np.packbits(chunk != 0, axis=1) if mask
+                                                                          else np.ascontiguousarray(chunk))
+    os.makedirs(os.path.dirname(os.path.abspath(location)), exist_ok=True)
+    # write to a temporary file first, so a half written raster is never read
+    np.savez_compressed(location + '.part.npz', **chunks)
+    os.replace(location + '.part.npz', location)
+
+
+def raster_info(location):
+    ''' shape, dtype, chunk size and mask flag of a stored raster '''
+    with np.load(location if location.endswith('.npz') else location + '.npz') as store:
+        return json.loads(str(store['meta']))
+
+
+def read_raster(location, window=None):
+    ''' read a stored raster, or a window of it
+
+    :param location: path of the .npz file
+    :param window: (row_start, row_stop, col_start, col_stop)
+    in pixels, or None for the whole raster
+    :return arr: np.array of the window
+    '''
+    if not location.endswith('.npz'):
+        location += '.npz'
+    with np.load(location) as store:
+        meta = json.loads(str(store['meta']))
+        rows, cols = meta['shape']
+        size = meta['chunk_size']
+        r0, r1, c0, c1 = (0, rows, 0, cols) if window is None else window
+        r0, r1, c0, c1 = max(r0, 0), min(r1, rows), max(c0, 0), min(c1, cols)
+        dtype = np.dtype(meta['dtype'])
+        out = np.zeros((max(r1 - r0, 0), max(c1 - c0, 0)), dtype=dtype)
+        for i in range(r0 // size, (r1 - 1) // size + 1 if r1 > r0 else 0):
+            for j in range(c0 // size, (c1 - 1) // size + 1 if c1 > c0 else 0):
+                chunk = store['{0}_{1}'.format(i, j)]
+                # chunk extent and the part of it within the window
+                cr0, cc0 = i * size, j * size
+                cr1, cc1 = min(cr0 + size, rows), min(cc0 + size, cols)
+                if meta['mask']:
+                    chunk = np.unpackbits(chunk, axis=1, count=cc1 - cc0).astype(dtype)
+                    chunk *= dtype.type(meta['mask_value'])
+                wr0, wr1 = max(r0, cr0), min(r1, cr1)
+                wc0, wc1 = max(c0, cc0), min(c1, cc1)
+                out[wr0 - r0:wr1 - r0, wc0 - c0:wc1 - c0] = chunk[wr0 - cr0:wr1 - cr0, wc0 - cc0:wc1 - cc0]
+    return out
+
+
+def is_raster(location):
+    ''' whether a stored raster exists at location '''
+    return os.path.exists(location if location.endswith('.npz') else location + '.npz')
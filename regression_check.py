@@ -0,0 +1,506 @@
+''' regression harness: runs the legacy and the new
+implementations of the pipeline steps on the bundled
+datasets (./data/a_2009, ./data/b_2019) and on
+synthetic DEMs, checks that they agree (exactly or
+within a tolerance) and reports the speedups.
+
+    python regression_check.py
+    python regression_check.py --datasets 2009 synthetic --fit-edges 200 --json regression.json
+
+The checks:
+    cluster_elim   small cluster removal: pixel loop vs. connected components
+    builder        skeleton --> graph: sknw vs. skeleton_graph (incl. skeletons without troughs)
+    graph          segmentation + graph vs. the bundled edgelist (undirected troughs)
+    segment default segmentation with iwd.DEFAULT_CONFIG vs. the original implementation
+    graph default  graph of the default segmentation vs. the original implementation
+    transects      get_transects vs. the bundled transect dict
+    orientation    get_transects_interp on reversed, vertical and horizontal edges
+    fit            inner() (unseeded) vs. the bundled fitted dict, and the
+                   seeded and the batched gaussian fits vs. inner(): same
+                   is_good_transect classification, good fits within the
+                   tolerance (differences of rejected transects are reported)
+    averages       get_trough_avgs_gauss vs. the bundled averages
+    incremental    update_transects after editing a local window of the
+                   skeleton vs. extracting all transects again: the troughs
+                   outside the window are kept, the patched dict is the same
+    network        networkx analysis vs. network_metrics / topology_stats
+
+Exit code 1 if any check fails.
+'''
+import os
+import sys
+import copy
+import json
+import time
+import pickle
+import argparse
+import logging
+from collections import Counter
+import numpy as np
+import networkx as nx
+import a_dem_to_graph
+import b_extract_trough_transects
+import c_transect_analysis
+import d_network_analysis
+import topology_stats
+import iwd
+
+logger = logging.getLogger(__name__)
+
+DATASETS = {'2009': {'dir': './data/a_2009', 'prefix': 'arf', 'its': 1},
+            '2019': {'dir': './data/b_2019', 'prefix': 'arf', 'its': 2}}
+
+# tolerances of the fitted width [m], depth [m] and r2
+FIT_ATOL = (1e-2, 1e-3, 1e-3)
+
+
+def synthetic_dem(shape=(512, 512), num_polygons=150, trough_depth=0.3, seed=0):
+    ''' a DEM of an ice-wedge polygon field: troughs
+    along the borders of random (Voronoi) polygons on
+    a tilted, noisy surface.
+
+    :param shape: size of the DEM [px]
+    :param num_polygons: number of polygon centers
+    :param trough_depth: depth of the troughs [m]
+    :param seed: seed of the random generator
+    :return dem: np.float32 array
+    '''
+    from scipy.spatial import cKDTree
+    rng = np.random.default_rng(seed)
+    centers = rng.random((num_polygons, 2)) * shape
+    rows, cols = np.indices(shape)
+    dist, _ = cKDTree(centers).query(np.stack([rows.ravel(), cols.ravel()], axis=1), k=2)
+    # distance to the polygon border (half the difference to the two nearest centers)
+    border = ((dist[:, 1] - dist[:, 0]) / 2).reshape(shape)
+    dem = 100 + 0.01 * rows + 0.005 * cols
+    dem -= trough_depth * np.exp(-border ** 2 / (2 * 1.5 ** 2))
+    dem += rng.normal(0, 0.02, shape)
+    return dem.astype(np.float32)
+
+
+def legacy_small_cluster_elim(in_img, cluster_size):
+    ''' the original small_cluster_elim(): label the
+    clusters and copy the large ones pixel by pixel '''
+    from scipy import ndimage
+    s = ndimage.generate_binary_structure(2, 2)
+    labeled_array, num_features = ndimage.label(in_img, structure=s)
+    cluster_sizes = np.unique(labeled_array, return_index=False, return_inverse=False, return_counts=True)
+    result = np.zeros_like(labeled_array)
+    trough_bool = []
+    for i in cluster_sizes[1]:
+        if i > cluster_size:
+            trough_bool.append(True)
+        else:
+            trough_bool.append(False)
+    for i in range(labeled_array.shape[0]):
+        for j in range(labeled_array.shape[1]):
+            if trough_bool[labeled_array[i][j]] and labeled_array[i][j] != 0:
+                result[i][j] = 1
+            else:
+                result[i][j] = 0
+    return result
+
+
+def legacy_segment_troughs(img_det, seg):
+    ''' the original segmentation of do_analysis (threshold
+    to 0/max, pixel loop cluster elimination, closing and
+    skimage's lee skeleton), of the closed or the dilated
+    image as seg['skeleton_of'] says '''
+    import cv2
+    from skimage.morphology import skeletonize
+    thresh2 = cv2.adaptiveThreshold(img_det, img_det.max(), cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                    cv2.THRESH_BINARY_INV, seg['block_size'], seg['c'])
+    thresh_unclustered = legacy_small_cluster_elim(thresh2, seg['cluster_size_thresh'])
+    kernel = np.ones((5, 5), np.uint8)
+    img = cv2.dilate(np.uint8(thresh_unclustered), kernel, iterations=seg['its'])
+    closed = cv2.erode(img, kernel, iterations=1)
+    img_skel = skeletonize(closed if seg['skeleton_of'] == 'closed' else img, method='lee')
+    return legacy_small_cluster_elim(img_skel, seg['cluster_size_skel']) != 0
+
+
+def legacy_network_metrics(graph):
+    ''' the numbers the original analysis functions
+    (sink_source_analysis, connected_comp_analysis,
+    network_density, get_total_channel_length) print,
+    computed with networkx '''
+    sources = sinks = 0
+    for n in graph.nodes():
+        if graph.in_degree(n) == 0:
+            sources += 1
+        elif graph.out_degree(n) == 0:
+            sinks += 1
+    undirected = graph.to_undirected()
+    components = list(nx.connected_components(undirected))
+    e_pot = 3/2 * (graph.number_of_nodes() + 1)
+    return {'sources': sources,
+            'sinks': sinks,
+            'num_components': len(components),
+            'component_sizes': Counter(len(c) for c in components),
+            'component_edges': sorted(undirected.subgraph(c).number_of_edges() for c in components),
+            'density': graph.number_of_edges() / e_pot,
+            'total_length': sum(w for (s, e, w) in graph.edges(data='weight'))}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def result(check, dataset, ok, detail, legacy_s=None, new_s=None):
+    return {'check': check, 'dataset': dataset, 'ok': bool(ok), 'detail': detail,
+            'legacy_s': legacy_s, 'new_s': new_s}
+
+
+def _graph_key(graph, coords):
+    ''' the troughs of a graph as set of
+    (undirected) pairs of node coordinates '''
+    return {frozenset((tuple(np.round(coords[s]).astype(int)), tuple(np.round(coords[e]).astype(int))))
+            for (s, e) in graph.edges()}
+
+
+def _same_graph(G_a, G_b):
+    ''' same nodes, edges, pts and weights '''
+    return (set(G_a.nodes()) == set(G_b.nodes()) and set(G_a.edges()) == set(G_b.edges())
+            and all(np.array_equal(G_a[s][e]['pts'], G_b[s][e]['pts'])
+                    and np.isclose(G_a[s][e]['weight'], G_b[s][e]['weight']) for (s, e) in G_a.edges()))
+
+
+def check_segmentation(name, dem, its, reference=None):
+    ''' cluster_elim, builder and (with the bundled
+    graph as reference) graph checks of one DEM, and
+    the checks of the default settings (iwd.DEFAULT_CONFIG,
+    i.e. the configuration users get) '''
+    results = []
+    img_det = a_dem_to_graph.detrender(dem, 16)
+    thresh2 = a_dem_to_graph.segment_troughs(img_det, its=its, keep_steps=True)[0]
+
+    old, legacy_s = timed(legacy_small_cluster_elim, thresh2, 15)
+    new, new_s = timed(a_dem_to_graph.small_cluster_elim, thresh2, 15)
+    same = np.array_equal(old != 0, new)
+    results.append(result('cluster_elim', name, same, '{} px kept'.format(int(new.sum())) if same
+                          else '{} px differ'.format(int(((old != 0) != new).sum())), legacy_s, new_s))
+
+    skel = a_dem_to_graph.segment_troughs(img_det, its=its, skeleton_of='dilated', keep_steps=False)[-1]
+    a_dem_to_graph.skeleton_to_graph(skel[:64, :64], builder='sknw')  # compile sknw's numba functions
+    G_old, legacy_s = timed(a_dem_to_graph.skeleton_to_graph, skel, builder='sknw')
+    G_new, new_s = timed(a_dem_to_graph.skeleton_to_graph, skel, builder='native')
+    results.append(result('builder', name, _same_graph(G_old, G_new),
+                          '{} nodes, {} edges'.format(G_new.number_of_nodes(), G_new.number_of_edges()),
+                          legacy_s, new_s))
+
+    if reference is not None:
+        H = a_dem_to_graph.make_directed(G_new, dem)
+        G_ref, coords_ref = reference
+        new_troughs = _graph_key(H, a_dem_to_graph.get_node_coords(H))
+        ref_troughs = _graph_key(G_ref, coords_ref)
+        results.append(result('graph', name, new_troughs == ref_troughs,
+                              '{0} of {1} bundled troughs reproduced, {2} new'.format(
+                                  len(new_troughs & ref_troughs), len(ref_troughs),
+                                  len(new_troughs - ref_troughs))))
+
+    # the default settings: segmentation and graph vs. the original implementation
+    seg = dict(iwd.DEFAULT_CONFIG['segmentation'], its=its)
+    legacy_skel, legacy_s = timed(legacy_segment_troughs, img_det, seg)
+    new_skel, new_s = timed(a_dem_to_graph.segment_troughs, img_det, block_size=seg['block_size'], c=seg['c'],
+                            cluster_size_thresh=seg['cluster_size_thresh'], its=seg['its'],
+                            cluster_size_skel=seg['cluster_size_skel'], method=seg['method'],
+                            skeleton_of=seg['skeleton_of'], keep_steps=False)
+    new_skel = new_skel[-1]
+    differ = int((legacy_skel != new_skel).sum())
+    results.append(result('segment default', name, differ == 0,
+                          'skeleton of the {0} image, {1} px, {2} px differ'.format(
+                              seg['skeleton_of'], int(new_skel.sum()), differ), legacy_s, new_s))
+    G_legacy = a_dem_to_graph.skeleton_to_graph(legacy_skel, builder='sknw')
+    H_legacy = a_dem_to_graph.make_directed(G_legacy, dem)
+    G_default, new_s = timed(a_dem_to_graph.skeleton_to_graph, new_skel, builder=seg['builder'])
+    H_default = a_dem_to_graph.make_directed(G_default, dem)
+    G_other = a_dem_to_graph.skeleton_to_graph(new_skel, builder='native' if seg['builder'] == 'sknw' else 'sknw')
+    legacy_troughs = _graph_key(H_legacy, a_dem_to_graph.get_node_coords(H_legacy))
+    new_troughs = _graph_key(H_default, a_dem_to_graph.get_node_coords(H_default))
+    results.append(result('graph default', name, new_troughs == legacy_troughs and _same_graph(G_default, G_other),
+                          '{0} of {1} troughs reproduced, {2} new, builders agree: {3}'.format(
+                              len(new_troughs & legacy_troughs), len(legacy_troughs),
+                              len(new_troughs - legacy_troughs), _same_graph(G_default, G_other))))
+    return results, G_new
+
+
+def check_transects(name, graph, dem, reference):
+    ''' get_transects on the bundled graph vs. the bundled transects '''
+    transect_dict, new_s = timed(b_extract_trough_transects.get_transects, graph, dem, 4)
+    reference = b_extract_trough_transects.key_by_edge_id(reference, graph)
+    differ = 0
+    for edge, ref_inner in reference.items():
+        new_inner = transect_dict.get(edge, {})
+        for key, ref_val in ref_inner.items():
+            val = new_inner.get(key)
+            if (val is None or not np.array_equal(val[0], ref_val[0]) or list(val[1]) != list(ref_val[1])
+                    or list(val[2:5]) != list(ref_val[2:5])):
+                differ += 1
+    total = sum(len(inner) for inner in reference.values())
+    return [result('transects', name, differ == 0, '{0} of {1} transects differ'.format(differ, total),
+                   None, new_s)]
+
+
+def check_transect_orientation(width=4):
+    ''' get_transects_interp on single straight edges,
+    each in both orientations: the transects of the
+    reversed edge are the same, and along rows and
+    columns the same as the ones of get_transects '''
+    rng = np.random.default_rng(0)
+    dem = rng.normal(size=(64, 64))
+    line = np.arange(10, 51)
+    edges = {'horizontal edge': np.stack([np.full_like(line, 30), line], axis=1),
+             'vertical edge': np.stack([line, np.full_like(line, 30)], axis=1),
+             'diagonal edge': np.stack([line, line], axis=1)}
+    results = []
+    for label, pts in edges.items():
+        transects = []
+        for ps in (pts, pts[::-1]):
+            G = nx.DiGraph()
+            G.add_edge(0, 1, pts=ps, weight=len(ps) - 1, eid=0)
+            transects.append(b_extract_trough_transects.get_transects_interp(G, dem, width)[0])
+            if label != 'diagonal edge':
+                # the diagonal transects of get_transects are sqrt(2) longer
+                transects.append(b_extract_trough_transects.get_transects(G, dem, width)[0])
+        ref = transects[0]
+        differ = sum(any(key not in other or not np.allclose(other[key][0], ref[key][0])
+                         or not np.allclose(other[key][1], ref[key][1]) for other in transects[1:])
+                     for key in ref)
+        results.append(result('orientation', label, differ == 0 and len(ref) > 0,
+                              '{0} of {1} transects differ (reversed{2})'.format(
+                                  differ, len(ref), '' if label == 'diagonal edge' else ', get_transects')))
+    return results
+
+
+def _compare_fits(ref, new, atol=FIT_ATOL):
+    ''' compare width, depth and r2 of two fitted dicts
+
+    :return counts: Counter with the number of transects
+    - 'agree': within the tolerance, or unfitted in both
+    - 'flipped': considered for the averages
+    (is_good_transect) in one fit only
+    - 'better', 'worse': good in both, but outside the
+    tolerance with a higher/lower r2 of the new fit
+    - 'rejected': rejected in both, but outside the tolerance
+    (or fitted in one only); these never reach the averages
+    '''
+    good = c_transect_analysis.is_good_transect
+    fitted = c_transect_analysis.is_fitted
+    counts = Counter()
+    for edge, ref_inner in ref.items():
+        for key, ref_val in ref_inner.items():
+            val = new[edge][key]
+            if good(ref_val) != good(val):
+                counts['flipped'] += 1
+            elif not fitted(ref_val) and not fitted(val):
+                counts['agree'] += 1
+            elif not (fitted(ref_val) and fitted(val)):
+                counts['rejected'] += 1
+            elif np.all(np.abs(np.array(val[5:8], dtype=float) - np.array(ref_val[5:8], dtype=float)) <= atol):
+                counts['agree'] += 1
+            elif not good(val):
+                counts['rejected'] += 1
+            else:
+                counts['better' if val[7] > ref_val[7] else 'worse'] += 1
+    return counts
+
+
+def check_fit(name, transects, reference, num_edges):
+    ''' the gaussian fits on the first num_edges troughs.
+    The seeded and the batched fits pass if every transect
+    is classified by is_good_transect like in inner() and
+    the good ones are within the tolerance; differences
+    of rejected transects are reported, too '''
+    edges = list(transects)[:num_edges]
+    subset = {edge: transects[edge] for edge in edges}
+    ref = {edge: reference[edge] for edge in edges}
+    results = []
+
+    legacy, legacy_s = timed(c_transect_analysis.fit_gaussian_parallel, copy.deepcopy(subset), n_jobs=1,
+                             screen=False)
+    counts = _compare_fits(ref, legacy)
+    results.append(result('fit inner', name, sum(counts.values()) == counts['agree'],
+                          '{0} agree, {1} differ with the bundled fits'.format(
+                              counts['agree'], sum(counts.values()) - counts['agree']), legacy_s))
+
+    for label, func, kwargs in (('fit seeded', c_transect_analysis.fit_gaussian_parallel, {'n_jobs': 1}),
+                                ('fit batched', c_transect_analysis.fit_profiles_batched, {'models': ('gauss',)})):
+        new, new_s = timed(func, copy.deepcopy(subset), **kwargs)
+        counts = _compare_fits(legacy, new)
+        results.append(result(label, name, counts['flipped'] == counts['better'] == counts['worse'] == 0,
+                              '{0} agree, {1} flipped good/rejected, {2} better, {3} worse, '
+                              '{4} rejected in both but differ'.format(counts['agree'], counts['flipped'],
+                                                                        counts['better'], counts['worse'],
+                                                                        counts['rejected']),
+                              legacy_s, new_s))
+    return results
+
+
+def check_averages(name, fitted, reference):
+    ''' get_trough_avgs_gauss on the bundled fits vs. the bundled averages '''
+    avgs, new_s = timed(c_transect_analysis.get_trough_avgs_gauss, fitted)
+    differ = sum(1 for edge, ref in reference.items()
+                 if not np.allclose(np.array(avgs[edge][:len(ref)], dtype=float), np.array(ref, dtype=float),
+                                    equal_nan=True))
+    return [result('averages', name, differ == 0, '{0} of {1} troughs differ'.format(differ, len(reference)),
+                   None, new_s)]
+
+
+def _same_values(x, y):
+    if isinstance(x, dict):
+        return x.keys() == y.keys() and all(_same_values(x[k], y[k]) for k in x)
+    if isinstance(x, (list, tuple)):
+        return len(x) == len(y) and all(_same_values(i, j) for i, j in zip(x, y))
+    return np.array_equal(np.asarray(x), np.asarray(y))
+
+
+def check_incremental(name, dem, its, margin=3):
+    ''' re-skeletonize after clearing the top left
+    window of the skeleton (renumbers the nodes) and
+    update the transects: all troughs farther than
+    margin px from the window have to be kept, and the
+    patched dict has to match a full extraction '''
+    img_det = a_dem_to_graph.detrender(dem, 16)
+    skel = a_dem_to_graph.segment_troughs(img_det, its=its, skeleton_of='dilated', keep_steps=False)[-1]
+    H_old = a_dem_to_graph.make_directed(a_dem_to_graph.skeleton_to_graph(skel), dem)
+    h, w = skel.shape
+    edited = skel.copy()
+    edited[:h // 8, :w // 8] = 0
+    H_new = a_dem_to_graph.make_directed(a_dem_to_graph.skeleton_to_graph(edited), dem)
+
+    added, changed, removed, kept = b_extract_trough_transects.diff_graphs(H_old, H_new)
+    far = set()
+    for (s, e, data) in H_old.edges(data=True):
+        pts = np.asarray(data['pts'])
+        if not ((pts[:, 0] < h // 8 + margin) & (pts[:, 1] < w // 8 + margin)).any():
+            far.add(data['eid'])
+    kept_far = far & {eid_old for (s, e, eid_old, eid_new) in kept}
+    consistent = (len(kept) + len(changed) + len(removed) == H_old.number_of_edges() and
+                  len(kept) + len(changed) + len(added) == H_new.number_of_edges())
+
+    transects = b_extract_trough_transects.get_transects(H_old, dem, 4)
+    full, legacy_s = timed(b_extract_trough_transects.get_transects, H_new, dem, 4)
+    (patched, delta), new_s = timed(b_extract_trough_transects.update_transects, transects, H_old, H_new, dem, 4)
+    same = _same_values(patched, full)
+    return [result('incremental', name, consistent and kept_far == far and same,
+                   '{0} of {1} troughs outside the window kept, {2} updated, {3} removed, same transects: {4}'.format(
+                       len(kept_far), len(far), len(delta['updated']), len(delta['removed']), same),
+                   legacy_s, new_s)]
+
+
+def check_empty_skeletons():
+    ''' both builders on skeletons without troughs
+    (an empty tile, a single pixel, a pixel cluster) '''
+    results = []
+    skeletons = {'empty': np.zeros((64, 64), dtype=bool),
+                 'single pixel': np.pad(np.ones((1, 1), dtype=bool), 8),
+                 'pixel cluster': np.pad(np.ones((2, 2), dtype=bool), 8)}
+    for label, skel in skeletons.items():
+        graphs = []
+        for kwargs in ({'builder': 'sknw'}, {'builder': 'native'}, {'builder': 'native', 'tile_size': 4}):
+            try:
+                G = a_dem_to_graph.skeleton_to_graph(skel, **kwargs)
+                graphs.append((G.number_of_nodes(), G.number_of_edges()))
+            except Exception as e:
+                graphs.append(repr(e))
+        results.append(result('builder', label, graphs[1] == graphs[2] == graphs[0],
+                              'sknw {0}, native {1}, tiled {2} (nodes, edges)'.format(*graphs)))
+    return results
+
+
+def check_network(name, graph):
+    ''' networkx analysis vs. the array based metrics '''
+    old, legacy_s = timed(legacy_network_metrics, graph)
+    new, new_s = timed(d_network_analysis.network_metrics, graph)
+    differ = [key for key in old if not (np.isclose(old[key], new[key]) if isinstance(old[key], float)
+                                         else (sorted(new[key]) if isinstance(old[key], list) else new[key])
+                                         == old[key])]
+    results = [result('network', name, not differ, 'differ: ' + ', '.join(differ) if differ
+                      else '{} sources, {} sinks'.format(new['sources'], new['sinks']), legacy_s, new_s)]
+
+    simple = nx.Graph(graph.to_undirected())
+    simple.remove_edges_from(nx.selfloop_edges(simple))
+    cycles, legacy_s = timed(lambda g: len(nx.cycle_basis(g)), simple)
+    stats, new_s = timed(topology_stats.topology_stats, graph)
+    results.append(result('cycles', name, cycles == stats['num_cycles'],
+                          '{0} vs. {1} cycles'.format(cycles, stats['num_cycles']), legacy_s, new_s))
+    return results
+
+
+def load_if_exists(location):
+    if os.path.exists(location + '.pkl'):
+        with open(location + '.pkl', 'rb') as f:
+            return pickle.load(f)
+    return None
+
+
+def run_checks(datasets, fit_edges=100, synthetic_sizes=(512, 1024)):
+    results = []
+    for name in datasets:
+        if name == 'synthetic':
+            results.extend(check_empty_skeletons())
+            results.extend(check_transect_orientation())
+            for i, size in enumerate(synthetic_sizes):
+                label = 'synthetic {0}x{0}'.format(size)
+                dem = synthetic_dem((size, size), num_polygons=size * size // 2000, seed=i)
+                res, G = check_segmentation(label, dem, its=1)
+                results.extend(res)
+                results.extend(check_network(label, a_dem_to_graph.make_directed(G, dem)))
+            continue
+
+        info = DATASETS[name]
+        prefix = os.path.join(info['dir'], '{0}_{{0}}_{1}'.format(info['prefix'], name))
+        dem = a_dem_to_graph.read_data(prefix.format('dtm') + '.tif')
+        G_ref, coords_ref = b_extract_trough_transects.read_graph(prefix.format('graph') + '.edgelist',
+                                                                  prefix.format('graph') + '_node-coords.npy')
+        res, _ = check_segmentation(name, dem, info['its'], reference=(G_ref, coords_ref))
+        results.extend(res)
+        results.extend(check_incremental(name, dem, info['its']))
+
+        transects = load_if_exists(prefix.format('transect_dict'))
+        fitted = load_if_exists(prefix.format('transect_dict_fitted'))
+        avgs = load_if_exists(prefix.format('transect_dict_avg'))
+        if transects is not None:
+            results.extend(check_transects(name, G_ref, dem, transects))
+            if fitted is not None and fit_edges:
+                results.extend(check_fit(name, transects, fitted, fit_edges))
+        if fitted is not None and avgs is not None:
+            results.extend(check_averages(name, fitted, avgs))
+        results.extend(check_network(name, G_ref))
+    return results
+
+
+def print_results(results):
+    print("{0:<17}{1:<20}{2:<6}{3:>10}{4:>10}{5:>9}  {6}".format('check', 'dataset', 'ok', 'legacy s', 'new s',
+                                                                 'speedup', 'detail'))
+    for r in results:
+        speedup = r['legacy_s'] / r['new_s'] if r['legacy_s'] and r['new_s'] else None
+        print("{0:<17}{1:<20}{2:<6}{3:>10}{4:>10}{5:>9}  {6}".format(
+            r['check'], r['dataset'], 'ok' if r['ok'] else 'FAIL',
+            *['-' if v is None else '{:.3f}'.format(v) for v in (r['legacy_s'], r['new_s'])],
+            '-' if speedup is None else '{:.1f}x'.format(speedup), r['detail']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="compare the legacy and the new implementations")
+    parser.add_argument('--datasets', nargs='+', default=['2009', '2019', 'synthetic'],
+                        choices=list(DATASETS) + ['synthetic'])
+    parser.add_argument('--fit-edges', type=int, default=100,
+                        help="number of troughs to fit (0 to skip the fit checks)")
+    parser.add_argument('--json', default=None, help="save the results (json) to this path")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run_checks(args.datasets, fit_edges=args.fit_edges)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = [r for r in results if not r['ok']]
+    print("{0} of {1} checks passed".format(len(results) - len(failed), len(results)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
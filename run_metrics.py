@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import logging
+import tracemalloc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+try:
+    # unix only
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# counters and timings of the current run, per stage:
+# {stage: {'counts': Counter, 'seconds': float, 'process_peak_rss_mb': float or None,
+#          'peak_traced_mb': float}}
+_stages = OrderedDict()
+
+
+def _get_stage(stage):
+    if stage not in _stages:
+        _stages[stage] = {'counts': Counter()}
+    return _stages[stage]
+
+
+def reset():
+    ''' forget all counters and timings
+    of the previous run '''
+    _stages.clear()
+
+
+def count(stage, key, n=1):
+    ''' increment the counter key of a stage
+    by n (e.g. count('fit', 'fit_failed')) '''
+    _get_stage(stage)['counts'][key] += n
+
+
+def merge_counts(stage, counts):
+    ''' add a dict of counts to a stage, e.g.
+    counts returned from joblib workers (which
+    cannot update the counters of the main process) '''
+    _get_stage(stage)['counts'].update(counts)
+
+
+def process_peak_rss_mb():
+    ''' the peak resident memory of the process
+    so far (its high-water mark, not the peak of
+    the current stage) in MB; None where the
+    resource module is unavailable (Windows) '''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+@contextmanager
+def stage_timer(stage, trace_memory=False):
+    ''' record wall time and memory of a stage of
+    the pipeline. The memory is the peak of the
+    whole process up to the end of the stage, so a
+    stage after a bigger one shows the peak of that
+    one; use trace_memory for the peak of the stage.
+
+    :param stage: name of the stage
+    :param trace_memory: also trace the peak of
+    python/numpy allocations within the stage
+    with tracemalloc (slows down the stage)
+    '''
+    info = _get_stage(stage)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield info['counts']
+    finally:
+        info['seconds'] = info.get('seconds', 0) + time.perf_counter() - start
+        info['process_peak_rss_mb'] = process_peak_rss_mb()
+        if trace_memory:
+            info['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+        logger.info("stage %s finished after %.2f s", stage, info['seconds'])
+
+
+def summary():
+    ''' get the machine-readable summary of the run
+
+    :return summary: dict with one entry per stage,
+    holding its counts, wall time and the peak
+    memory of the process up to the end of the stage
+    '''
+    summ = OrderedDict()
+    for stage, info in _stages.items():
+        summ[stage] = dict(info)
+        summ[stage]['counts'] = dict(info['counts'])
+    return summ
+
+
+def save_summary(location):
+    ''' write the run summary as json to disk '''
+    with open(location, 'w') as f:
+        json.dump(summary(), f, indent=2, default=float)
+
+
+def print_summary():
+    ''' print counts, wall time and peak
+    memory (of the process, up to the end of
+    the stage) per stage of the run '''
+    for stage, info in summary().items():
+        rss = info.get('process_peak_rss_mb')
+        print("{0}: {1:.2f} s, process peak rss {2}".format(
+            stage, info.get('seconds', 0), 'n/a' if rss is None else '{:.0f} MB'.format(rss)))
+        for key, n in sorted(info['counts'].items()):
+            print("\t{0}: {1}".format(key, n))
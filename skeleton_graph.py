@@ -0,0 +1,346 @@
+import gc
+import time
+import numpy as np
+import networkx as nx
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+
+# (row, col) offsets of the 8 neighbours of a pixel
+_OFFSETS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+
+
+def skeleton_pixels(skel, tile_size=None):
+    ''' get the coordinates of all skeleton pixels.
+    With tile_size, the raster is read one tile at a
+    time (e.g. from a np.memmap), so only the pixel
+    lists of the tiles are held in memory; they are
+    stitched at the seams by build_graph_arrays(),
+    which resolves the neighbours across tiles.
+
+    :param skel: skeleton raster (array-like that
+    supports 2D slicing), trough pixels != 0
+    :param tile_size: edge length of the tiles [px],
+    None to read the whole raster at once
+    :return rows, cols: np.arrays of the pixel
+    coordinates, in raster order
+    '''
+    if tile_size is None:
+        rows, cols = np.nonzero(np.asarray(skel))
+        return rows.astype(np.int64), cols.astype(np.int64)
+    rows, cols = [], []
+    for r0 in range(0, skel.shape[0], tile_size):
+        for c0 in range(0, skel.shape[1], tile_size):
+            r, c = np.nonzero(np.asarray(skel[r0:r0 + tile_size, c0:c0 + tile_size]))
+            rows.append(r.astype(np.int64) + r0)
+            cols.append(c.astype(np.int64) + c0)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    # back to raster order
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+
+def _neighbours(lin, width, size=None):
+    ''' index of the 8 neighbours of every pixel
+    in the sorted linear pixel ids (-1 if empty).
+
+    With size (number of linear ids), the neighbours
+    are looked up in a raster of pixel indices, which
+    is faster; without, they are searched in lin, which
+    needs no memory beyond the pixel lists (tiles). '''
+    nbs = np.empty((len(lin), 8), dtype=np.int64)
+    if size is not None:
+        # index + 1, so that the (lazily) zeroed raster means empty
+        index = np.zeros(size, dtype=np.int32 if len(lin) < 2 ** 31 - 1 else np.int64)
+        index[lin] = np.arange(1, len(lin) + 1)
+        for k, (dr, dc) in enumerate(_OFFSETS):
+            nbs[:, k] = index[lin + dr * width + dc]
+        nbs -= 1
+        return nbs
+    for k, (dr, dc) in enumerate(_OFFSETS):
+        target = lin + dr * width + dc
+        pos = np.minimum(np.searchsorted(lin, target), len(lin) - 1)
+        nbs[:, k] = np.where(lin[pos] == target, pos, -1)
+    return nbs
+
+
+def _label_pairs(mask_a, mask_b, pairs):
+    ''' the neighbouring pixel pairs (i, j) with
+    i in mask_a and j in mask_b '''
+    i, j = pairs
+    keep = mask_a[i] & mask_b[j]
+    return i[keep], j[keep]
+
+
+def _components(n, i, j):
+    ''' connected components of the pixel pairs (i, j) '''
+    adj = scipy.sparse.csr_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    return connected_components(adj, directed=False)
+
+
+def _no_edges(node_coords):
+    ''' the graph arrays of a graph without edges '''
+    return {'node_coords': node_coords,
+            'edge_nodes': np.zeros((0, 2), dtype=np.int64),
+            'edge_offsets': np.zeros(1, dtype=np.int64),
+            'edge_pts': np.zeros((0, 2), dtype=np.int64),
+            'edge_length': np.zeros(0)}
+
+
+def build_graph_arrays(skel, tile_size=None):
+    ''' build the graph of a skeleton (nodes at the
+    end and junction pixels, edges along the chains of
+    pixels with exactly two neighbours; same graph as
+    sknw.build_sknw) as compact arrays, with array
+    operations on the list of skeleton pixels instead
+    of tracing pixel by pixel.
+
+    - junction/end pixels (not exactly 2 neighbours) are
+    grouped into nodes by connected components
+    - chains of pixels with 2 neighbours are connected
+    components, too; chains without a node (closed
+    rings) get a node at their first pixel
+    - the pixels of each chain are ordered from one of
+    its ends (one breadth-first search for all chains
+    at once)
+
+    :param skel: skeleton raster, trough pixels != 0
+    :param tile_size: read the raster in tiles of this
+    size (see skeleton_pixels())
+    :return graph_arrays: dictionary with
+    - 'node_coords': np.array (N, 2) of the rounded node centers
+    - 'edge_nodes': np.array (E, 2) of the nodes of each edge
+    - 'edge_offsets': np.array (E + 1,), the pts of edge i
+    are edge_pts[edge_offsets[i]:edge_offsets[i + 1]]
+    - 'edge_pts': np.array (P, 2) of all edge pixels, from
+    the start node center over the chain to the end node center
+    - 'edge_length': np.array (E,) of the edge lengths [px]
+    '''
+    rows, cols = skeleton_pixels(skel, tile_size)
+    n = len(rows)
+    if n == 0:
+        # no troughs (e.g. an empty tile): empty graph, like sknw
+        return _no_edges(np.zeros((0, 2), dtype=np.int64))
+    # linear ids with a margin, so that neighbours never wrap around a row
+    width = skel.shape[1] + 2
+    lin = (rows + 1) * width + (cols + 1)
+    nbs = _neighbours(lin, width, size=None if tile_size else (skel.shape[0] + 2) * width)
+    is_node = (nbs >= 0).sum(axis=1) != 2
+    # all pairs of neighbouring pixels
+    has_nb = nbs.ravel() >= 0
+    pairs = (np.repeat(np.arange(n), 8)[has_nb], nbs.ravel()[has_nb])
+
+    # closed rings of chain pixels get a node at their first pixel
+    i, j = _label_pairs(~is_node, ~is_node, pairs)
+    num_chains, chain_labels = _components(n, i, j)
+    i, j = _label_pairs(~is_node, is_node, pairs)
+    touches_node = np.zeros(num_chains, dtype=bool)
+    touches_node[chain_labels[i]] = True
+    ring = ~is_node & ~touches_node[chain_labels]
+    first = np.full(num_chains, n)
+    np.minimum.at(first, chain_labels[ring], np.nonzero(ring)[0])
+    ring_nodes = np.zeros(n, dtype=bool)
+    ring_nodes[first[first < n]] = True
+    is_node |= ring_nodes
+
+    # nodes: connected components of the node pixels (numbered like sknw, rings last)
+    i, j = _label_pairs(is_node, is_node, pairs)
+    _, node_labels = _components(n, i, j)
+    node_idx = np.nonzero(is_node)[0]
+    node_first = np.full(n, n)
+    np.minimum.at(node_first, node_labels[node_idx], node_idx)
+    cluster_ids = np.unique(node_labels[node_idx])
+    order = np.lexsort((node_first[cluster_ids], ring_nodes[node_first[cluster_ids]]))
+    node_id = np.full(n, -1)
+    node_id[cluster_ids[order]] = np.arange(len(cluster_ids))
+    node_of = np.where(is_node, node_id[node_labels], -1)
+    num_nodes = len(cluster_ids)
+    count = np.bincount(node_of[node_idx], minlength=num_nodes)
+    node_coords = np.stack([np.bincount(node_of[node_idx], weights=rows[node_idx], minlength=num_nodes),
+                            np.bincount(node_of[node_idx], weights=cols[node_idx], minlength=num_nodes)],
+                           axis=1) / count[:, None]
+    node_coords = np.round(node_coords).astype(np.int64)
+
+    # chains: connected components of the remaining pixels; these are the ones
+    # labeled above, a ring without its node pixel is still connected
+    is_chain = ~is_node
+    chain_pairs = _label_pairs(is_chain, is_chain, pairs)
+    chain_idx = np.nonzero(is_chain)[0]
+    chain_id = np.full(n, -1)
+    labels_used, chain_id[chain_idx] = np.unique(chain_labels[chain_idx], return_inverse=True)
+    num_edges = len(labels_used)
+    if num_edges == 0:
+        # only isolated nodes (e.g. single pixels left by the cluster elimination)
+        return _no_edges(node_coords)
+    # every chain starts at the node pixel touching it that comes first in raster
+    # order (as sknw traces it), then its pixels are ordered by the distance from there
+    i, j = _label_pairs(is_chain, is_node, pairs)
+    contact_edge = chain_id[i]
+    order = np.lexsort((i, j, contact_edge))
+    first_contact = order[np.r_[True, contact_edge[order][1:] != contact_edge[order][:-1]]]
+    # number the edges in the order sknw traces them (start pixel, then its
+    # neighbour, rings last): of parallel edges between two nodes, nx.Graph
+    # keeps the last one added
+    edge_order = np.lexsort((i[first_contact], j[first_contact], ring_nodes[j[first_contact]]))
+    rank = np.empty(num_edges, dtype=np.int64)
+    rank[edge_order] = np.arange(num_edges)
+    chain_id[chain_idx] = rank[chain_id[chain_idx]]
+    contact_edge = rank[contact_edge]
+    first_contact = first_contact[edge_order]
+    start = i[first_contact]
+    # one search from a virtual pixel n, connected to the starts of all chains; a chain
+    # is a path, so the search visits its pixels in order and sorting the visits by
+    # chain (stable) gives the pixels of each chain from its start
+    pi = np.concatenate([chain_pairs[0], np.full(num_edges, n)])
+    pj = np.concatenate([chain_pairs[1], start])
+    adj = scipy.sparse.csr_matrix((np.ones(len(pi), dtype=np.int8), (pi, pj)), shape=(n + 1, n + 1))
+    visits = breadth_first_order(adj, n, directed=False, return_predecessors=False)[1:]
+    order = visits[np.argsort(chain_id[visits], kind='stable')]
+    chain_len = np.bincount(chain_id[chain_idx], minlength=num_edges)
+    depth = np.zeros(n, dtype=np.int64)
+    depth[order] = np.arange(len(order)) - np.repeat(np.cumsum(chain_len) - chain_len, chain_len)
+
+    # the end node touches the last pixel of the chain (for a single pixel, the other contact)
+    is_first = np.zeros(len(i), dtype=bool)
+    is_first[first_contact] = True
+    contacts = np.lexsort((j, ~is_first, depth[i], contact_edge))
+    last_contact = contacts[np.r_[contact_edge[contacts][1:] != contact_edge[contacts][:-1], True]]
+    edge_nodes = np.stack([node_of[j[first_contact]], node_of[j[last_contact]]], axis=1)
+
+    # pts: start node center, the ordered chain pixels, end node center
+    edge_offsets = np.r_[0, np.cumsum(chain_len + 2)]
+    edge_pts = np.empty((edge_offsets[-1], 2), dtype=np.int64)
+    edge_pts[edge_offsets[:-1]] = node_coords[edge_nodes[:, 0]]
+    edge_pts[edge_offsets[1:] - 1] = node_coords[edge_nodes[:, 1]]
+    inner = np.ones(edge_offsets[-1], dtype=bool)
+    inner[edge_offsets[:-1]] = False
+    inner[edge_offsets[1:] - 1] = False
+    edge_pts[inner] = np.stack([rows[order], cols[order]], axis=1)
+
+    steps = np.linalg.norm(np.diff(edge_pts, axis=0), axis=1)
+    # sum of the steps within each edge (not between consecutive edges)
+    cum = np.r_[0, np.cumsum(steps)]
+    edge_length = cum[edge_offsets[1:] - 1] - cum[edge_offsets[:-1]]
+    return {'node_coords': node_coords,
+            'edge_nodes': edge_nodes,
+            'edge_offsets': edge_offsets,
+            'edge_pts': edge_pts,
+            'edge_length': edge_length}
+
+
+def arrays_to_graph(graph_arrays):
+    ''' convert the compact array graph to a nx.Graph
+    like the one of sknw.build_sknw(), but with the
+    edge 'pts' as lists already
+
+    :param graph_arrays: result of build_graph_arrays()
+    :return graph: nx.Graph with node attribute 'o'
+    (node center) and edge attributes 'pts' and 'weight'
+    '''
+    # the pts lists are tens of thousands of new objects that all survive, which
+    # triggers full collections of everything alive; they can't form cycles, so
+    # the collector is paused while they are created
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        graph = nx.Graph()
+        node_coords = graph_arrays['node_coords']
+        graph.add_nodes_from((i, {'o': node_coords[i]}) for i in range(len(node_coords)))
+        offsets = graph_arrays['edge_offsets'].tolist()
+        pts = graph_arrays['edge_pts'].tolist()
+        lengths = graph_arrays['edge_length'].tolist()
+        for k, (s, e) in enumerate(graph_arrays['edge_nodes'].tolist()):
+            graph.add_edge(s, e, pts=pts[offsets[k]:offsets[k + 1]], weight=lengths[k])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return graph
+
+
+def assign_edge_ids(graph):
+    ''' number the edges of the graph: each edge
+    gets its index in graph.edges() as integer
+    attribute 'eid'. The id is saved with the
+    edgelist and keys the transect, fitted and
+    averaged dicts, so the per-edge results of all
+    stages can be looked up by array index.
+
+    :param graph: nx.DiGraph, numbered in place
+    :return graph: the same graph
+    '''
+    for i, (s, e) in enumerate(graph.edges()):
+        graph[s][e]['eid'] = i
+    return graph
+
+
+def get_node_coords(graph):
+    ''' array of the node coordinates, indexed
+    by node ID
+
+    :param graph: nx.DiGraph with integer node IDs
+    (as built by skeleton_to_graph())
+    :return coords: np.array (max node ID + 1, 2)
+    with the pixel coordinates of node i in row i
+    '''
+    nodes = graph.nodes()
+    coords = np.zeros((max(nodes, default=-1) + 1, 2))
+    for i in nodes:
+        coords[i] = nodes[i]['o']
+    return coords
+
+
+def compare_builders(skel, tile_size=None):
+    ''' benchmark the native builder against
+    sknw.build_sknw on a skeleton raster and check
+    that both give the same graph.
+
+    :param skel: skeleton raster, trough pixels != 0
+    :param tile_size: tile size for the native builder
+    :return result: dictionary with the run times [s]
+    (incl. the conversion to networkx), number of
+    nodes/edges and total length of both graphs, the
+    run time of the array graph alone and whether the
+    edges (by node coordinates) agree
+    '''
+    import sknw
+
+    # compile sknw's numba functions before timing it
+    sknw.build_sknw(np.zeros((3, 3), dtype=np.uint8))
+
+    start = time.perf_counter()
+    G_sknw = sknw.build_sknw(skel, multi=False)
+    for (s, e) in G_sknw.edges():
+        G_sknw[s][e]['pts'] = G_sknw[s][e]['pts'].tolist()
+    time_sknw = time.perf_counter() - start
+
+    start = time.perf_counter()
+    graph_arrays = build_graph_arrays(skel, tile_size)
+    time_arrays = time.perf_counter() - start
+    G_native = arrays_to_graph(graph_arrays)
+    time_native = time.perf_counter() - start
+
+    def edge_set(graph):
+        o = {n: tuple(int(v) for v in graph.nodes[n]['o']) for n in graph.nodes()}
+        return {frozenset((o[s], o[e])): round(w, 6) for (s, e, w) in graph.edges(data='weight')}
+
+    result = {}
+    for name, graph, seconds in (('sknw', G_sknw, time_sknw), ('native', G_native, time_native)):
+        result[name] = {'seconds': seconds,
+                        'num_nodes': graph.number_of_nodes(),
+                        'num_edges': graph.number_of_edges(),
+                        'total_length': sum(w for (s, e, w) in graph.edges(data='weight'))}
+    result['native']['seconds_arrays'] = time_arrays
+    result['same_edges'] = edge_set(G_sknw) == edge_set(G_native)
+    return result
+
+
+if __name__ == '__main__':
+    from e_polygon_analysis import get_skeleton
+
+    for year in (2009, 2019):
+        skel = get_skeleton(year)
+        for tile_size in (None, 256):
+            res = compare_builders(skel, tile_size)
+            print("{0} (tiles: {1}): sknw {2:.3f} s, native {3:.3f} s ({4:.3f} s without networkx), "
+                  "same graph: {5}".format(year, tile_size, res['sknw']['seconds'], res['native']['seconds'],
+                                           res['native']['seconds_arrays'], res['same_edges']))
+            print("\tsknw: {0}\n\tnative: {1}".format(res['sknw'], res['native']))
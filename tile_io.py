@@ -0,0 +1,120 @@
+''' background I/O of the pipeline: reading the
+next rasters ahead of time and writing the outputs
+on a writer thread, so that decoding and writing
+files overlap with the computations.
+
+Both are bounded: the Prefetcher keeps at most
+'depth' rasters in memory ahead of the consumer and
+the AsyncWriter blocks the producer as soon as
+'max_pending' writes are queued.
+'''
+import queue
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    ''' iterate over the results of loader(item) for
+    all items (in order), loading the next 'depth'
+    items on background threads.
+
+        for path, dem in Prefetcher(paths, read_data, depth=2):
+            ...
+
+    Errors of the loader are raised when the failed
+    item is reached.
+    '''
+
+    def __init__(self, items, loader, depth=2):
+        self.items = list(items)
+        self.loader = loader
+        self.depth = max(int(depth), 1)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix='prefetch') as pool:
+            pending = {}
+            for i, item in enumerate(self.items):
+                # this item and the next 'depth' ones are loading
+                for j in range(i, min(i + self.depth + 1, len(self.items))):
+                    if j not in pending:
+                        pending[j] = pool.submit(self.loader, self.items[j])
+                yield item, pending.pop(i).result()
+
+
+class AsyncWriter:
+    ''' write files on a background thread.
+
+        with AsyncWriter(max_pending=4) as writer:
+            writer.submit(np.save, location, arr)
+
+    submit() blocks while max_pending writes are queued
+    (backpressure), so queued outputs never hold more
+    than max_pending objects in memory. The objects must
+    not be modified after they are submitted. After a
+    failed write, the remaining queued writes are skipped
+    and the error is raised by the next submit(), flush()
+    or close().
+    '''
+
+    def __init__(self, max_pending=4):
+        self._queue = queue.Queue(maxsize=max(int(max_pending), 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            func, args, kwargs = task
+            try:
+                if self._error is None:
+                    func(*args, **kwargs)
+            except Exception as e:
+                logger.warning("writing with %s failed: %r", getattr(func, '__name__', func), e)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, func, *args, **kwargs):
+        ''' queue the call func(*args, **kwargs) '''
+        self._raise()
+        if not self._thread.is_alive():
+            raise RuntimeError("the writer is closed")
+        self._queue.put((func, args, kwargs))
+
+    def flush(self):
+        ''' wait until all queued writes are done '''
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        ''' finish the queued writes and stop the thread '''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the original error behind one of the writer
+            try:
+                self.close()
+            except Exception as e:
+                logger.warning("writer error after %r: %r", exc, e)
+        return False
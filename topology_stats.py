@@ -0,0 +1,168 @@
+import os
+import pickle
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from d_network_analysis import graph_to_arrays, graph_fingerprint
+from b_extract_trough_transects import read_graph
+
+
+def topology_stats(graph, arrays=None):
+    ''' compute the topology statistics of a trough
+    network with array operations on its edge arrays.
+
+    The degree of a node is the number of troughs it
+    connects (its neighbours in the undirected graph,
+    so a flat trough existing in both directions
+    counts once). Junctions are classified by their
+    degree: T junctions (3 troughs), which dominate
+    in ice-wedge polygon networks, X junctions
+    (4 troughs) and junctions of more troughs.
+
+    The number of independent cycles (the size of a
+    cycle basis of the undirected graph) is its
+    cyclomatic number E - N + C. As the trough network
+    is planar, this is also the number of closed
+    polygons it encloses.
+
+    :param graph: an nx.DiGraph
+    :param arrays: result of graph_to_arrays(graph), if
+    already available
+    :return stats: dictionary with
+    - 'fingerprint': graph_fingerprint of the graph
+    - 'num_nodes', 'num_troughs': number of nodes and
+    of (undirected) troughs
+    - 'degree', 'in_degree', 'out_degree': np.arrays per node
+    - 'degree_counts', 'in_degree_counts', 'out_degree_counts':
+    dictionaries degree --> number of nodes
+    - 'degree_freq': dictionary degree --> share of the nodes
+    - 'mean_degree': mean (undirected) degree
+    - 'junctions': dictionary with the number of trough
+    ends (degree 1), T, X and higher junctions
+    - 'num_cycles': number of independent cycles (polygons)
+    '''
+    if arrays is None:
+        arrays = graph_to_arrays(graph)
+    num_nodes = len(arrays['nodes'])
+    src, dst = arrays['src'], arrays['dst']
+
+    in_degree = np.bincount(dst, minlength=num_nodes)
+    out_degree = np.bincount(src, minlength=num_nodes)
+    # the troughs of the undirected graph: (s, e) and (e, s) are one trough, no self loops
+    pairs = np.stack([np.minimum(src, dst), np.maximum(src, dst)], axis=1)
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+    degree = np.bincount(pairs.ravel(), minlength=num_nodes)
+
+    troughs = scipy.sparse.csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                      shape=(num_nodes, num_nodes))
+    num_components, _ = connected_components(troughs, directed=False)
+
+    def counts(deg):
+        values, n = np.unique(deg, return_counts=True)
+        return dict(zip(values.tolist(), n.tolist()))
+
+    stats = {'fingerprint': graph_fingerprint(graph),
+             'num_nodes': num_nodes,
+             'num_troughs': len(pairs),
+             'degree': degree,
+             'in_degree': in_degree,
+             'out_degree': out_degree,
+             'degree_counts': counts(degree),
+             'in_degree_counts': counts(in_degree),
+             'out_degree_counts': counts(out_degree),
+             'degree_freq': {d: n / num_nodes for d, n in counts(degree).items()},
+             'mean_degree': float(degree.mean()) if num_nodes else np.nan,
+             'junctions': {'end': int((degree == 1).sum()),
+                           'T': int((degree == 3).sum()),
+                           'X': int((degree == 4).sum()),
+                           'higher': int((degree > 4).sum())},
+             'num_cycles': int(len(pairs) - num_nodes + num_components)}
+    return stats
+
+
+def get_topology_stats(graph, cache_dir=None):
+    ''' get the topology statistics of a graph; they
+    are cached on disk by graph fingerprint, so the
+    plotting layer can reuse them.
+
+    :param graph: an nx.DiGraph
+    :param cache_dir: directory of the cache; None (default)
+    disables caching
+    :return stats: see topology_stats()
+    '''
+    if cache_dir is not None:
+        cache_loc = os.path.join(cache_dir, 'topology_stats_' + graph_fingerprint(graph) + '.pkl')
+        if os.path.exists(cache_loc):
+            with open(cache_loc, 'rb') as f:
+                return pickle.load(f)
+    stats = topology_stats(graph)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_loc, 'wb') as f:
+            pickle.dump(stats, f, pickle.HIGHEST_PROTOCOL)
+    return stats
+
+
+def print_topology_stats(stats):
+    ''' print degree distribution, junction
+    types and number of polygons '''
+    print(f"Number of nodes: {stats['num_nodes']}\nNumber of troughs: {stats['num_troughs']}")
+    print(f"degree distribution (degree: nodes): {stats['degree_counts']}")
+    print(f"mean degree: {stats['mean_degree']:.2f}")
+    print("trough ends: {end}, T junctions: {T}, X junctions: {X}, higher junctions: {higher}".format(
+        **stats['junctions']))
+    print(f"number of independent cycles (polygons): {stats['num_cycles']}")
+
+
+def plot_node_degree_hist(stats_09, stats_19, save_loc=None):
+    ''' plot the node degree histograms of
+    2009 and 2019 side by side. Degree-2 nodes
+    (neither trough ends nor junctions) are left
+    out of the bars.
+
+    :param stats_09: topology stats of 2009
+    :param stats_19: topology stats of 2019
+    :param save_loc: path to save the figure
+    to, or None to only show it
+    '''
+    import matplotlib.pyplot as plt
+    degrees = sorted((set(stats_09['degree_freq']) | set(stats_19['degree_freq'])) - {2})
+    fig, ax = plt.subplots(figsize=(4.5, 4.5))
+    width = 0.25
+    for stats, year, color, shift in ((stats_09, '2009', 'salmon', -width/2),
+                                      (stats_19, '2019', 'teal', width/2)):
+        freq = [stats['degree_freq'].get(d, 0) for d in degrees]
+        ax.bar(np.array(degrees) + shift, freq, width=width, color=color, label=year)
+        for d, f in zip(degrees, freq):
+            # label the bars too small to see
+            if f < 0.03:
+                ax.text(d + shift, f + 0.01, str(round(f, 4)), rotation=90, ha='center', va='bottom', fontsize=8)
+        ax.axvline(stats['mean_degree'], color=color, linestyle='--', linewidth=0.8)
+        ax.text(stats['mean_degree'] - 0.05, 0.02, 'mean {0} = {1:.2f}'.format(year, stats['mean_degree']),
+                rotation=90, ha='right', va='bottom', fontsize=8)
+    ax.set_xticks(degrees)
+    ax.set_xlabel('degree')
+    ax.set_ylabel('nodes frequency')
+    ax.grid(color='grey', linestyle='-', linewidth=0.2)
+    ax.legend(frameon=False)
+    plt.tight_layout()
+    if save_loc is not None:
+        plt.savefig(save_loc, dpi=300)
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    # read in 2009 and 2019 data
+    G_09, coord_dict_09 = read_graph(edgelist_loc='./data/a_2009/arf_graph_2009.edgelist',
+                                     coord_dict_loc='./data/a_2009/arf_graph_2009_node-coords.npy')
+    G_19, coord_dict_19 = read_graph(edgelist_loc='./data/b_2019/arf_graph_2019.edgelist',
+                                     coord_dict_loc='./data/b_2019/arf_graph_2019_node-coords.npy')
+
+    stats_09 = get_topology_stats(G_09)
+    stats_19 = get_topology_stats(G_19)
+    print_topology_stats(stats_09)
+    print("_______________________")
+    print_topology_stats(stats_19)
+
+    plot_node_degree_hist(stats_09, stats_19)
+    plt.show()